@@ -0,0 +1,139 @@
+"""
+Shared fixtures for the pytest-benchmark suite.
+
+The xrt_sim and caproto_servers modules use flat imports (i.e. 'from
+custom_devices import ...'), so their directories are added to sys.path
+here. The IOC benchmarks start the IOCs in subprocesses serving on the
+local host only, which makes the channel access round trips comparable
+between runs on the same machine. Run the suite with:
+
+    nox -s benchmarks
+
+or, to compare against the last stored run:
+
+    nox -s benchmarks -- --benchmark-compare
+"""
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+# The directories holding the (flat imported) modules.
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src', 'ari_sxn_simbeamline')
+xrt_sim_dir = os.path.abspath(os.path.join(src_dir, 'xrt_sim'))
+caproto_dir = os.path.abspath(os.path.join(src_dir, 'caproto_servers'))
+for path in (xrt_sim_dir, caproto_dir):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+
+def ioc_environment():
+    """
+    Return the environment used for the IOC subprocesses and CA clients.
+
+    Channel access is restricted to the local host so that the benchmarks
+    neither depend on, nor disturb, the network.
+    """
+    env = dict(os.environ)
+    env.update({'EPICS_CA_AUTO_ADDR_LIST': 'NO',
+                'EPICS_CA_ADDR_LIST': '127.0.0.1',
+                'EPICS_CAS_INTF_ADDR_LIST': '127.0.0.1',
+                'EPICS_CAS_BEACON_ADDR_LIST': '127.0.0.1',
+                'PYTHONPATH': os.pathsep.join(
+                    [caproto_dir, xrt_sim_dir, env.get('PYTHONPATH', '')])})
+
+    return env
+
+
+def start_ioc(module, prefix, pv, timeout=30):
+    """
+    Start an IOC in a subprocess and wait for one of its PVs to connect.
+
+    Parameters
+    ----------
+    module : str
+        The (flat) module name to run, i.e. 'diagnostic'.
+    prefix : str
+        The PV prefix passed to the IOC.
+    pv : str
+        The suffix of a PV that is read to check that the IOC is serving.
+    timeout : float
+        The time to wait for the IOC, in seconds.
+
+    Returns
+    -------
+    process, elapsed : subprocess.Popen, float
+        The IOC process and the time, in seconds, until pv could be read.
+    """
+    from caproto.sync.client import read
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', module,
+                                '--prefix', prefix, '--interfaces',
+                                '127.0.0.1'], env=ioc_environment(),
+                               cwd=caproto_dir, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f'The {module} IOC exited with code '
+                               f'{process.returncode}')
+        try:
+            read(prefix + pv, timeout=0.5)
+            return process, time.perf_counter() - start
+        except TimeoutError:
+            if time.perf_counter() - start > timeout:
+                stop_ioc(process)
+                raise
+
+
+def stop_ioc(process):
+    """
+    Stop an IOC subprocess started by start_ioc.
+    """
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+@pytest.fixture(scope='session', autouse=True)
+def _local_channel_access():
+    """
+    Restrict the channel access clients of the benchmarks to the local host.
+    """
+    original = dict(os.environ)
+    os.environ.update({key: value for key, value in ioc_environment().items()
+                       if key.startswith('EPICS')})
+    yield
+    os.environ.clear()
+    os.environ.update(original)
+
+
+@pytest.fixture(scope='session')
+def ca_context(_local_channel_access):
+    """
+    A caproto threading client Context shared by the IOC benchmarks.
+    """
+    from caproto.threading.client import Context
+
+    context = Context()
+    yield context
+    context.disconnect()
+
+
+@pytest.fixture(scope='session')
+def diagnostic_ioc(_local_channel_access):
+    """
+    A Diagnostic IOC (a QuadEM and a Prosilica camera) in a subprocess.
+    """
+    prefix = 'BENCH_DIAG'
+    process, _ = start_ioc('diagnostic', prefix, ':Currents:Acquire')
+    yield prefix
+    stop_ioc(process)
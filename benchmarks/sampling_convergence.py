@@ -0,0 +1,76 @@
+"""
+Compare the convergence of the random and quasi-random source sampling.
+
+For each sampling mode and ray count the model is traced with several
+independent seeds, and the RMS error (relative to a high ray count reference)
+of the flux reflected by M1 and of the reflected beam centroid is reported.
+The source divergence is reduced from the model default so that a useful
+fraction of the rays reaches M1. Run from the repository root with:
+
+    python benchmarks/sampling_convergence.py --repeats 8
+"""
+import argparse
+import json
+import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'ari_sxn_simbeamline',
+                                'xrt_sim'))
+
+import ari_sim  # noqa: E402
+from reducers import Moments  # noqa: E402
+
+
+def estimate(model, sampling, nrays, seed):
+    """
+    Return the (reflected flux fraction, x centroid, z centroid) at M1.
+    """
+    model.source.sampling = sampling
+    model.source.seed = seed
+    model.source.nrays = nrays
+    np.random.seed(seed)  # used by the 'random' sampling
+    model.activate(updated=True)
+    moments = Moments('m1', fields=('x', 'z'))(model)
+
+    return np.array([moments[0] / nrays, moments[1] / moments[0],
+                     moments[2] / moments[0]])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeats', type=int, default=8)
+    parser.add_argument('--nrays', type=int, nargs='+',
+                        default=[256, 1024, 4096, 16384, 65536])
+    parser.add_argument('--reference-nrays', type=int, default=2**20)
+    parser.add_argument('--divergence', type=float, default=1E-3)
+    parser.add_argument('--json', help='a file to write the results to')
+    args = parser.parse_args(argv)
+
+    model = ari_sim.AriModel()
+    model.source.dxprime = model.source.dzprime = args.divergence
+    reference = estimate(model, 'sobol', args.reference_nrays, seed=12345)
+
+    results = {'reference': reference.tolist(), 'errors': {}}
+    names = ('flux', 'centroid x', 'centroid z')
+    print(f'{"sampling":>8} {"nrays":>8} ' +
+          ' '.join(f'{name:>14}' for name in names))
+    for sampling in ('random', 'sobol', 'halton'):
+        results['errors'][sampling] = {}
+        for nrays in args.nrays:
+            values = np.array([estimate(model, sampling, nrays, seed)
+                               for seed in range(args.repeats)])
+            error = np.sqrt(((values - reference) ** 2).mean(axis=0))
+            error[0] /= reference[0]  # relative flux error
+            results['errors'][sampling][nrays] = error.tolist()
+            print(f'{sampling:>8} {nrays:>8} ' +
+                  ' '.join(f'{value:>14.3e}' for value in error))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Benchmark the start-up time of the xrt_sim AriModel.
+
+Each repeat runs in a fresh python process, so module imports are not
+cached, and reports the time taken to import ari_sim, to build an AriModel
+(including its first activate call) and the total time to the first
+activate. Run from the repository root with:
+
+    python benchmarks/startup.py --repeats 5 --nrays 10000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# The directory holding the (flat imported) xrt_sim modules.
+xrt_sim_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                           'src', 'ari_sxn_simbeamline', 'xrt_sim')
+
+# The script run in each fresh process, it prints the timings as json.
+_child = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {path!r})
+import ari_sim
+imported = time.perf_counter()
+model = ari_sim.AriModel()
+if model.source.nrays != {nrays}:
+    model.source.nrays = {nrays}
+    model.activate(updated=True)
+activated = time.perf_counter()
+print(json.dumps({{'import': imported - start,
+                  'first_activate': activated - imported,
+                  'total': activated - start,
+                  'qt_imported': any(name.startswith(('PyQt', 'PySide'))
+                                     for name in sys.modules)}}))
+"""
+
+
+def run_once(nrays):
+    """
+    Return the timings from one fresh python process.
+
+    Parameters
+    ----------
+    nrays : int
+        The number of source rays used for the first activate.
+
+    Returns
+    -------
+    timings : dict
+        A dictionary with the 'import', 'first_activate' and 'total' times
+        (in seconds) and whether a Qt binding was imported ('qt_imported').
+    """
+    code = _child.format(path=os.path.abspath(xrt_sim_dir), nrays=nrays)
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            capture_output=True, text=True).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--nrays', type=int, default=10000)
+    parser.add_argument('--json', help='a file to write the results to')
+    args = parser.parse_args(argv)
+
+    runs = [run_once(args.nrays) for _ in range(args.repeats)]
+    results = {'nrays': args.nrays, 'repeats': args.repeats, 'runs': runs}
+    for name in ('import', 'first_activate', 'total'):
+        values = [run[name] for run in runs]
+        results[name] = {'median': statistics.median(values),
+                         'min': min(values), 'max': max(values)}
+        print(f'{name:>15}: median {results[name]["median"]:.3f} s '
+              f'(min {results[name]["min"]:.3f} s, '
+              f'max {results[name]["max"]:.3f} s)')
+    print(f'{"qt imported":>15}: {any(run["qt_imported"] for run in runs)}')
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
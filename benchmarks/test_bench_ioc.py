@@ -0,0 +1,112 @@
+"""
+Benchmarks of the caproto IOCs over local channel access.
+
+The IOCs are run in subprocesses serving on 127.0.0.1 (see
+benchmarks/conftest.py), each round trip is a put to an Acquire PV
+followed by waiting for the acquisition (which runs as an IOC task) to
+finish.
+"""
+import pytest
+import time
+
+from conftest import start_ioc, stop_ioc
+
+pytest.importorskip('caproto')
+
+# The sockets of the sync client reads used to wait for an IOC to start are
+# closed by the garbage collector, which raises ResourceWarnings.
+pytestmark = pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnraisableExceptionWarning')
+
+
+def acquire(acquire_pv, done_pv, timeout=30):
+    """
+    Put 1 to acquire_pv and wait for done_pv to return to 0.
+
+    Parameters
+    ----------
+    acquire_pv, done_pv : caproto.threading.client.PV
+        The Acquire PV and the PV that is set to 0 once the acquisition has
+        finished (i.e. the Acquire_RBV PV).
+    timeout : float
+        The maximum time to wait, in seconds.
+    """
+    acquire_pv.write(1, wait=True, timeout=timeout)
+    deadline = time.monotonic() + timeout
+    while done_pv.read(timeout=timeout).data[0] != 0:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{done_pv.name} did not return to 0')
+        time.sleep(1E-3)
+
+
+@pytest.fixture(scope='module')
+def diagnostic_pvs(diagnostic_ioc, ca_context):
+    """
+    The diagnostic PVs, with the acquisition times set to ~0.
+    """
+    names = {'qem_acquire': ':Currents:Acquire',
+             'qem_averaging_time': ':Currents:AveragingTime',
+             'cam_acquire': ':Camera:cam1:Acquire',
+             'cam_acquire_rbv': ':Camera:cam1:Acquire_RBV',
+             'cam_acquire_period': ':Camera:cam1:AcquirePeriod'}
+    pvs = dict(zip(names, ca_context.get_pvs(
+        *(diagnostic_ioc + name for name in names.values()), timeout=10)))
+    for pv in pvs.values():
+        pv.wait_for_connection(timeout=10)
+    # Only measure the IOC overhead, not the simulated exposure times.
+    pvs['qem_averaging_time'].write(0.0, wait=True, timeout=10)
+    pvs['cam_acquire_period'].write(0.0, wait=True, timeout=10)
+
+    return pvs
+
+
+def test_quad_em_acquire(benchmark, diagnostic_pvs):
+    """
+    A QuadEM 'Single' acquisition, from the put until Acquire returns to 0.
+    """
+    benchmark(acquire, diagnostic_pvs['qem_acquire'],
+              diagnostic_pvs['qem_acquire'])
+
+
+def test_cam_plugin_acquire(benchmark, diagnostic_pvs):
+    """
+    A CamPlugin 'Single' acquisition, from the put until Acquire_RBV returns
+    to 0 (the frame is produced by an IOC task).
+    """
+    benchmark.pedantic(acquire, args=(diagnostic_pvs['cam_acquire'],
+                                      diagnostic_pvs['cam_acquire_rbv']),
+                       kwargs={'timeout': 60}, rounds=10, warmup_rounds=1)
+
+
+def test_quad_em_pvdb_build(benchmark):
+    """
+    The time to build the QuadEM PVGroup and its pvdb.
+    """
+    from area_detector.quad_em import QuadEM
+
+    benchmark(QuadEM, prefix='BENCH_QEM')
+
+
+def test_ari_m1_pvdb_build(benchmark):
+    """
+    The time to build the AriM1 PVGroup and its pvdb.
+    """
+    ari_m1 = pytest.importorskip('ari_m1')
+
+    benchmark.pedantic(ari_m1.AriM1, kwargs={'prefix': 'BENCH_M1'},
+                       rounds=10, warmup_rounds=1)
+
+
+def test_ari_m1_startup(benchmark):
+    """
+    The time from starting an AriM1 IOC process until it serves its PVs.
+    """
+    pytest.importorskip('nslsii')
+
+    def startup():
+        process, elapsed = start_ioc('ari_m1', 'BENCH_M1', ':ccg')
+        stop_ioc(process)
+        return elapsed
+
+    elapsed = benchmark.pedantic(startup, rounds=3)
+    benchmark.extra_info['time_to_first_read'] = elapsed
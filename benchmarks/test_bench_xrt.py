@@ -0,0 +1,73 @@
+"""
+Benchmarks of the xrt_sim ray tracing chain (see benchmarks/conftest.py).
+"""
+import pytest
+
+ari_sim = pytest.importorskip('ari_sim')
+custom_devices = pytest.importorskip('custom_devices')
+
+
+@pytest.fixture(scope='module')
+def model():
+    """
+    An AriModel with enough divergence for rays to reach the diagnostics.
+    """
+    model = ari_sim.AriModel(seed=1)
+    model.source.dxprime = model.source.dzprime = 1E-3
+    model.activate(updated=True)
+
+    return model
+
+
+def test_construction(benchmark):
+    """
+    The time to build an AriModel, including its first (full) activation.
+    """
+    benchmark.pedantic(ari_sim.AriModel, kwargs={'seed': 1}, rounds=5,
+                       warmup_rounds=1)
+
+
+def test_activate_full(benchmark, model):
+    """
+    The time to re-trace every component (regenerating the source rays).
+    """
+    benchmark(model.activate, updated=True)
+
+
+def test_activate_incremental(benchmark, model):
+    """
+    The time to re-trace after a move of the M1 baffles only.
+    """
+    values = iter([1.0, 2.0] * 10000)
+
+    def move_and_activate():
+        model.mirror1.baffles.top = next(values)
+        model.activate()
+
+    benchmark(move_and_activate)
+
+
+def test_activate_noop(benchmark, model):
+    """
+    The time for activate when nothing has changed.
+    """
+    model.activate()
+    benchmark(model.activate)
+
+
+def test_update_parameters_noop(benchmark, model):
+    """
+    The cost of _update_parameters for M1 when nothing has changed.
+    """
+    custom_devices._update_parameters(model.m1)
+    assert not benchmark(custom_devices._update_parameters, model.m1)
+
+
+@pytest.mark.parametrize('bins', [(10, 10, 10), (100, 100, 100),
+                                  (400, 400, 20)])
+def test_beam_to_xarray(benchmark, model, bins):
+    """
+    The time to bin the M1 diagnostic beam into an xarray.DataArray.
+    """
+    pytest.importorskip('xarray')
+    benchmark(ari_sim.beam_to_xarray, model.m1_diag.beamOut, bins=bins)
@@ -44,6 +44,25 @@ def tests(session: nox.Session) -> None:
     session.run("pytest", *session.posargs)
 
 
+@nox.session
+def benchmarks(session: nox.Session) -> None:
+    """
+    Run the benchmark suite, storing the results as JSON in .benchmarks/.
+
+    Each run is saved (numbered, with the commit id) under
+    .benchmarks/<machine>/, pass "--benchmark-compare" to compare with the
+    last saved run or "--benchmark-compare=0003" with a particular one.
+    """
+    session.install(".[benchmark]")
+    session.run(
+        "pytest",
+        "benchmarks",
+        "--benchmark-autosave",
+        f"--benchmark-storage=file://{DIR / '.benchmarks'}",
+        *session.posargs,
+    )
+
+
 @nox.session(reuse_venv=True)
 def docs(session: nox.Session) -> None:
     """
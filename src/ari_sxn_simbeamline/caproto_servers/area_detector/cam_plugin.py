@@ -1,10 +1,25 @@
-from area_detector.plugin_base import PluginBase, pvproperty_rbv
+from area_detector.nd_array_pool import data_types, NDArrayPool
+from area_detector.plugin_base import (data_type_names, PluginBase,
+                                       pvproperty_rbv)
 from caproto import ChannelType
 from caproto.server import pvproperty, ioc_arg_parser, run
+from collections import deque
+import math
 import numpy as np
 from textwrap import dedent
 import time
 
+# The native ChannelType of the ArrayData PV, and the numpy dtype of the array
+# written to it, for each of the DataType choices. Channel Access has no
+# unsigned 16 bit type, so 'UInt16' images are served as SHORT (ChannelType.INT),
+# the bits are unchanged but values above 32767 read back as negative int16
+# values (and are converted as such for other requested types), clients
+# reinterpret them as uint16 using DataType_RBV.
+channel_types = {'UInt8': (ChannelType.CHAR, np.uint8),
+                 'UInt16': (ChannelType.INT, np.int16),
+                 'Float32': (ChannelType.FLOAT, np.float32)}
+
+
 class CamPlugin(PluginBase):
     """
     A PV Group that generates the PVs associated with an Area Detector Stats Plugin.
@@ -13,62 +28,192 @@ class CamPlugin(PluginBase):
     1. Unless otherwise listed in the notes below the PVs generated are 'Dummy' PVs
     that are not modified by any inputs, or modify any other PVs, except there own
     values when they are updated.
-    2. When self.acquire is set to 1 the sequence of events is:
-        i. record the initial time and set self.array_counter to 0.
-        ii. calculate the image to be returned using self._generate_image
-            and write this to the self.image1.array_data attribute
-        iii. if self.acquire_time has elapsed continue otherwise wait until
-             it has.
-        iv. set self.array_counter to self.num_exposures and self.acquire to 0
-    3. When self.acquire_time, self.num_exposures or self.num_images are updated
+    2. Setting self.acquire to 1 only starts the frame producer, a task started
+    by the startup hook of self.acquire, so the other PVs of the IOC are served
+    while it runs. The producer:
+        i. sets self.array_counter to 0 and self.detector_state to 'acquiring'.
+        ii. every frame period (the larger of self.acquire_period divided by
+            self.num_images and self.acquire_time, paced from the start time so
+            the frames do not drift) fills an image using self._generate_image, increments
+            self.array_counter and hands the image to the publisher task (the
+            startup hook of self.array_data), which writes it to
+            self.array_data, and to the downstream plugins (see PluginBase).
+            self.array_rate is updated from the last frames.
+        iii. stops after 1 image ('Single' image_mode), self.num_images images
+             ('Multiple') or when self.acquire is set to 0 ('Continuous'), then
+             sets self.acquire to 0 and self.detector_state to 'idle'.
+    3. Frames are dropped rather than queued when the clients can't keep up, an
+    image handed to the publisher while the previous one is still waiting to be
+    written replaces it, and frame periods missed by the producer are skipped.
+    Both are counted in self.dropped_arrays.
+    4. When self.acquire_time, self.num_exposures or self.num_images are updated
        self.acquire_period should be updated using the following relationship:
         - self.acquire_period = self.acquire_time * self.num_exposures *
                                 self.num_images
-
-    TODO:
-    1. ...
+       so self.acquire_period is the time of a 'Multiple' acquisition, and of
+       every self.num_images frames of a 'Continuous' acquisition.
+    5. The images are NDArrays of the self.data_type ('UInt8', 'UInt16' or
+    'Float32') allocated from the NDArrayPool self.pool (see nd_array_pool.py),
+    which are filled in place by self._generate_image, and the raveled view (not
+    a copy) is written to self.array_data. The publisher holds a reference to the
+    image while it is the value of self.array_data (or waiting to be written), as
+    do the queues of the downstream plugins, so the memory is only re-used once
+    all of them are done with it. If the pool is full the frame is dropped (and
+    counted in self.dropped_arrays). The native type of self.array_data follows
+    the data type of the image it holds (CHAR for 'UInt8', SHORT for 'UInt16'
+    and FLOAT for 'Float32', see channel_types), so a client reading it natively
+    gets the image without conversion. Channel Access only reports the native
+    type when a client connects, so a client that connected before a DataType
+    change keeps requesting the old type (and receives the new images
+    converted to it, i.e. Float32 images truncated to CHAR), it must reconnect
+    (i.e. re-create its PV) to read the new type natively. To keep the type of
+    the images of an acquisition fixed self.data_type_setpoint can only be
+    changed while self.acquire is 0.
     """
 
-    async def _generate_image(self):
+    async def _generate_image(self, image):
         """
-        This method returns an image to be used as the return array.
+        This method fills an image to be used as the return array.
 
-        This method returns a self.array_size0 x array_size1 random image
-        array to be used inside a putter hook for self.acquire which also
-        updates array data with the flattened version of the returned image
-        file via image.flatten().
+        This method fills a preallocated self.array_size0 x self.array_size1
+        image array (of the self.data_type dtype, see self._alloc_frame) in
+        place with random values, the raveled image is then written to
+        self.array_data by the frame producer.
+
+        Parameters
+        ----------
+        image : np.array
+            The self.array_size0 x self.array_size1 numpy array to be filled.
 
         Returns
         -------
         image : np.array,
-            A self.array_size0 x self.array_size1 numpy array consisting of
-            random integers between 0 and 256.
-
+            The filled image, consisting of random values over the range of
+            the integer data types (or between 0 and 256 for 'Float32').
         """
-        image = np.random.randint(0, 257, size=(self.array_size0.value,
-                                                self.array_size1.value))
+        if image.dtype.kind == 'f':
+            self._rng.random(out=image, dtype=image.dtype.type)
+            image *= 256
+        else:  # random bits, without an int64 intermediate
+            image.reshape(-1).view(np.uint8)[:] = np.frombuffer(
+                self._rng.bytes(image.nbytes), dtype=np.uint8)
 
         return image
 
+    def _alloc_frame(self):
+        """
+        Return a new frame allocated from self.pool.
+
+        Returns
+        -------
+        array : NDArray or None
+            A self.array_size0 x self.array_size1 array of the self.data_type
+            dtype, or None if the pool is full.
+        """
+        return self.pool.alloc((self.array_size0.value, self.array_size1.value),
+                               data_types[self.data_type.value])
+
     async def _reset_acquire_period(self):
-        """This is a method that resets num_averaged when required.
+        """This is a method that resets acquire_period when required.
 
-        self.num_averaged requires to be reset whenever self.acquire_time,
-        self.num_exposures or self.num_images are updated. This
-        method will be used as the putter hook for these.
+        self.acquire_period requires to be reset whenever self.acquire_time,
+        self.num_exposures or self.num_images are updated. This method will be
+        used in the putter hook for these.
         """
 
-        await self.acquire_period.write(
+        await self.acquire_period.setpoint.write(
             self.acquire_time.readback.value *
             self.num_exposures.readback.value *
             self.num_images.readback.value)
 
         return
 
+    async def _publish(self, array):
+        """
+        This method hands an image to the publisher task.
+
+        If the previous image has not been written yet it is replaced (and
+        counted in self.dropped_arrays) so that slow clients never queue up
+        frames.
+
+        Parameters
+        ----------
+        array : NDArray
+            The image to be written to self.array_data, the reference of the
+            caller is passed on to the publisher.
+        """
+        if self._frame is not None:
+            self._frame.release()
+            await self._increment(self.dropped_arrays)
+        self._frame = array
+        if self._frame_ready is not None:
+            self._frame_ready.set()
+
+    async def _acquisition(self, async_lib):
+        """
+        This method runs the frame producer of one acquisition (see the class NOTES).
+        """
+        mode = self.image_mode.readback.value
+        total = {'Single': 1,
+                 'Multiple': self.num_images.readback.value}.get(mode, math.inf)
+        await self.array_counter.setpoint.write(0)
+        await self.detector_state.write('acquiring')
+        times = deque(maxlen=10)  # the times of the last frames, for array_rate
+
+        frames = 0
+        deadline = time.monotonic()
+        while frames < total and self.acquire.setpoint.value == 1:
+            period = max(self.acquire_period.readback.value /
+                         max(self.num_images.readback.value, 1),
+                         self.acquire_time.readback.value, 1E-3)
+            deadline += period
+            now = time.monotonic()
+            if now > deadline + period:  # skip the frames we are too late for
+                missed = int((now - deadline) // period)
+                await self._increment(self.dropped_arrays, missed)
+                deadline += missed * period
+            # sleep in short steps so that setting acquire to 0 stops promptly
+            while now < deadline and self.acquire.setpoint.value == 1:
+                await async_lib.library.sleep(min(deadline - now, 0.1))
+                now = time.monotonic()
+            if self.acquire.setpoint.value != 1:  # stopped while waiting
+                break
+
+            array = self._alloc_frame()
+            if array is None:  # the pool is full, so skip this frame
+                await self._increment(self.dropped_arrays)
+                continue
+            await self._generate_image(array.data)
+            array.timestamp = time.time()
+            await self._publish_array(array)  # to the downstream plugins
+            await self._publish(array)
+            await self._update_pool_pvs()
+            frames += 1
+            await self._increment(self.array_counter)
+            times.append(time.monotonic())
+            if len(times) > 1 and times[-1] > times[0]:
+                await self.array_rate.write((len(times) - 1) /
+                                            (times[-1] - times[0]))
+
+        await self.detector_state.write('idle')
+        await self.acquire.setpoint.write(0)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)  # call the PluginBase __init__ function
+        self._start = None  # the Event that starts the frame producer
+        self._frame = None  # the image waiting to be written to array_data
+        self._frame_ready = None  # the Event that wakes up the publisher
+        self._published = None  # the NDArray that is the array_data value
+        self.pool = NDArrayPool()
+        self._rng = np.random.default_rng()
+
+    def _connect(self):
+        """A driver has no upstream port."""
+        return
 
     # Write some new values for the image plugin
+    port_name = pvproperty(name=':PortName_RBV', value='CAM1',
+                           report_as_string=True, read_only=True)
     plugin_type = pvproperty(name=':PluginType_RBV', value='NDPluginStdArrays',
                              report_as_string=True, read_only=True)
     # image array properties
@@ -78,7 +223,15 @@ class CamPlugin(PluginBase):
                              read_only=True)
     array_size2 = pvproperty(name=':ArraySize2_RBV', value=1, dtype=int,
                              read_only=True)
-    array_data = pvproperty(name=':ArrayData', dtype=int, max_length=3200000)
+    # (the native type is set from the DataType by the startup hook below)
+    array_data = pvproperty(name=':ArrayData', dtype=ChannelType.FLOAT,
+                            max_length=3200000)
+    # (a setpoint/readback pair can't replace the PluginBase DataType_RBV PV)
+    data_type_setpoint = pvproperty(name=':DataType', dtype=ChannelType.ENUM,
+                                    value='UInt8', enum_strings=list(data_types))
+    data_type = pvproperty(name=':DataType_RBV', dtype=ChannelType.ENUM,
+                           value='UInt8', enum_strings=list(data_types),
+                           read_only=True)
     max_size_x = pvproperty(name=':MaxSizeX_RBV', dtype=int, read_only=True)
     max_size_y = pvproperty(name=':MaxSizeY_RBV', dtype=int, read_only=True)
     size_x = pvproperty_rbv(name=':SizeX', dtype=int)
@@ -111,31 +264,76 @@ class CamPlugin(PluginBase):
     @acquire.setpoint.putter
     async def acquire(obj, instance, value):
         """
-        This is a putter function that steps through the proces required when the 'acquire'
-        PV is set to 1. If it is set to 0 it just sets itself to 0.
+        This is a putter function that starts the frame producer when the 'acquire'
+        PV is set to 1, setting it to 0 stops a running acquisition.
+        """
+        parent = obj.parent
+        if value == 1 and instance.value != 1 and parent._start is not None:
+            parent._start.set()
+        await obj.readback.write(value)
+
+        return value
+
+    @acquire.readback.startup
+    async def acquire(obj, instance, async_lib):
+        """
+        This is a startup hook that runs the frame producer each time the
+        'acquire' PV is set to 1.
         """
-        if value == 1:
-            await instance.write(1, verify_value=False)
-            await obj.readback.write(1)
-            start_timestamp = time.time()  # record initial time
-            await obj.parent.array_counter.setpoint.write(0)  # set the number of averaged points to 0
-            image = await obj.parent._generate_image()  # calculate the new image.
-            await obj.parent.array_data.write(image.flatten())
-            # Make sure that it has taken at least averaging_time to finish
-            while time.time() - start_timestamp < obj.parent.acquire_period.readback.value:
-                time.sleep(1E-3)
+        parent = obj.parent
+        # The Event is created once, before the first wait, and cleared when
+        # an acquisition starts, so a start requested while the previous
+        # acquisition is finishing is not lost.
+        parent._start = async_lib.Event()
+        while True:
+            await parent._start.wait()
+            parent._start.clear()
+            await parent._acquisition(async_lib)
 
-            await obj.parent.array_counter.setpoint.write(obj.parent.num_exposures.readback.value)
+    @array_data.startup
+    async def array_data(self, instance, async_lib):
+        """
+        This is a startup hook that writes the images handed over by the frame
+        producer to the 'array_data' PV.
+        """
+        instance.data_type = channel_types[self.data_type.value][0]
+        while True:
+            self._frame_ready = async_lib.Event()
+            if self._frame is None:
+                await self._frame_ready.wait()
+            array, self._frame = self._frame, None
+            native_type, dtype = channel_types[data_type_names[array.data.dtype]]
+            value = array.data.ravel().view(dtype)
+            instance.data_type = native_type  # see the class NOTES
+            await instance.write(value)
+            await self.unique_id.write(array.unique_id)
+            await self.time_stamp.write(array.timestamp)
+            if self._published is not None:  # it is no longer the value
+                self._published.release()
+            self._published = array
+            await self._update_pool_pvs()
 
-        await obj.readback.write(0)
-        return 0
+    @data_type_setpoint.putter
+    async def data_type_setpoint(self, instance, value):
+        """
+        This is a putter function that updates the data_type readback, the
+        data type can't be changed during an acquisition (see the class NOTES).
+        """
+        if value != self.data_type.value and (
+                self.acquire.readback.value == 1 or
+                self.detector_state.value == 'acquiring'):
+            raise ValueError('DataType can not be changed while acquiring, '
+                             'set Acquire to 0 first')
+        await self.data_type.write(value)
+
+        return value
 
     @acquire_time.setpoint.putter
     async def acquire_time(obj, instance, value):
         """
-        This is a putter function that updates num_average when averaging_time is set
+        This is a putter function that updates acquire_period when acquire_time is set
         """
-        await obj.write(value)
+        await obj.readback.write(value)
         await obj.parent._reset_acquire_period()
 
         return value
@@ -143,9 +341,9 @@ class CamPlugin(PluginBase):
     @num_exposures.setpoint.putter
     async def num_exposures(obj, instance, value):
         """
-        This is a putter function that updates num_average when averaging_time is set
+        This is a putter function that updates acquire_period when num_exposures is set
         """
-        await obj.write(value)
+        await obj.readback.write(value)
         await obj.parent._reset_acquire_period()
 
         return value
@@ -153,17 +351,18 @@ class CamPlugin(PluginBase):
     @num_images.setpoint.putter
     async def num_images(obj, instance, value):
         """
-        This is a putter function that updates num_average when averaging_time is set
+        This is a putter function that updates acquire_period when num_images is set
         """
-        await obj.write(value)
+        await obj.readback.write(value)
         await obj.parent._reset_acquire_period()
 
         return value
 
-    # Add some code to start a version of the server if this file is 'run'.
-    if __name__ == "__main__":
-        ioc_options, run_options = ioc_arg_parser(
-            default_prefix="CamPlugin",
-            desc=dedent(CamPlugin.__doc__))
-        ioc = CamPlugin(**ioc_options)
-        run(ioc.pvdb, **run_options)
+
+# Add some code to start a version of the server if this file is 'run'.
+if __name__ == "__main__":
+    ioc_options, run_options = ioc_arg_parser(
+        default_prefix="CamPlugin",
+        desc=dedent(CamPlugin.__doc__))
+    ioc = CamPlugin(**ioc_options)
+    run(ioc.pvdb, **run_options)
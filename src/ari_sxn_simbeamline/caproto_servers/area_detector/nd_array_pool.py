@@ -0,0 +1,175 @@
+"""
+This file contains the NDArray buffer pool shared by the area detector
+PVGroups, it is based on the areaDetector NDArrayPool.
+
+A driver (i.e. CamPlugin) allocates each frame from its NDArrayPool, the
+frame is then passed to the downstream plugins (see PluginBase) which hold a
+reference to it while it waits in their queue. The memory is only returned
+to the pool, for re-use by a later frame, once every holder has released it.
+"""
+import numpy as np
+import time
+
+# The numpy dtype of the arrays for each of the DataType choices.
+data_types = {'UInt8': np.uint8, 'UInt16': np.uint16, 'Float32': np.float32}
+
+
+class NDArray:
+    """
+    An array allocated from an NDArrayPool.
+
+    The array is reference counted, the pool gives it out with a count of 1
+    (held by the allocator) and each additional holder (i.e. a plugin queue)
+    calls self.reserve, and later self.release once it is done with it. The
+    memory is returned to the pool when the count drops to 0, after which
+    self.data must not be used.
+
+    Parameters
+    ----------
+    pool : NDArrayPool
+        The pool that the memory belongs to.
+    buffer : np.array
+        The 1D uint8 memory of the array (which may be larger than needed).
+    shape : tuple
+        The shape of the array.
+    dtype : np.dtype
+        The dtype of the array.
+    unique_id : int
+        The (increasing) unique ID of the array.
+
+    Attributes
+    ----------
+    data : np.array
+        The shape x dtype view of the memory, filled in place by the
+        allocator.
+    unique_id : int
+        The unique ID of the array.
+    timestamp : float
+        The time that the array was allocated, the allocator may update it.
+    reference_count : int
+        The number of holders of the array.
+
+    Methods
+    -------
+    reserve()
+        Add a holder to the array.
+    release()
+        Remove a holder from the array.
+    """
+    def __init__(self, pool, buffer, shape, dtype, unique_id):
+        self._pool = pool
+        self._buffer = buffer
+        dtype = np.dtype(dtype)
+        self.data = buffer[:int(np.prod(shape)) * dtype.itemsize].view(
+            dtype).reshape(shape)
+        self.unique_id = unique_id
+        self.timestamp = time.time()
+        self.reference_count = 1
+
+    def reserve(self):
+        """Add a holder to the array."""
+        self.reference_count += 1
+
+    def release(self):
+        """Remove a holder from the array, returning it to the pool if it was
+        the last one."""
+        self.reference_count -= 1
+        if self.reference_count == 0:
+            self._pool._return(self._buffer)
+            self._buffer = self.data = None
+
+
+class NDArrayPool:
+    """
+    A pool of re-usable array memory with limits on its size.
+
+    Memory released by all of the holders of an NDArray is kept in the pool
+    and handed out again by self.alloc, new memory is only allocated when no
+    free buffer is large enough. Once self.max_buffers or self.max_memory are
+    reached free buffers that are too small are discarded to make room, and if
+    that isn't enough self.alloc returns None so that the caller drops the
+    array (back-pressure) instead of the memory growing without bound.
+
+    Parameters
+    ----------
+    max_buffers : int
+        The maximum number of buffers, free or in use, the default is 20.
+    max_memory : float
+        The maximum memory of the buffers, in bytes, the default is 200 MB.
+
+    Attributes
+    ----------
+    max_buffers : int
+        The maximum number of buffers.
+    max_memory : float
+        The maximum memory of the buffers, in bytes.
+    num_buffers : int
+        The number of buffers allocated (free or in use).
+    num_free : int
+        The number of free buffers.
+    memory : int
+        The memory of the allocated buffers, in bytes.
+
+    Methods
+    -------
+    alloc(shape, dtype)
+        Return an NDArray from the pool, or None if the pool is full.
+    """
+    def __init__(self, max_buffers=20, max_memory=200E6):
+        self.max_buffers = max_buffers
+        self.max_memory = max_memory
+        self.num_buffers = 0
+        self.memory = 0
+        self._free = []  # the free buffers
+        self._unique_id = 0
+
+    @property
+    def num_free(self):
+        """The number of free buffers."""
+        return len(self._free)
+
+    def alloc(self, shape, dtype):
+        """
+        Return an NDArray from the pool, or None if the pool is full.
+
+        Parameters
+        ----------
+        shape : tuple
+            The shape of the array.
+        dtype : np.dtype
+            The dtype of the array.
+
+        Returns
+        -------
+        array : NDArray or None
+            The array (with a reference count of 1), the content of
+            array.data is undefined.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        fits = [buffer for buffer in self._free if buffer.nbytes >= nbytes]
+        if fits:  # re-use the smallest free buffer that is large enough
+            buffer = min(fits, key=len)
+            self._free.remove(buffer)
+        else:
+            while self._free and (self.num_buffers >= self.max_buffers or
+                                  self.memory + nbytes > self.max_memory):
+                self._discard(self._free.pop(0))
+            if (self.num_buffers >= self.max_buffers or
+                    self.memory + nbytes > self.max_memory):
+                return None
+            buffer = np.empty(nbytes, dtype=np.uint8)
+            self.num_buffers += 1
+            self.memory += nbytes
+
+        self._unique_id += 1
+
+        return NDArray(self, buffer, shape, dtype, self._unique_id)
+
+    def _discard(self, buffer):
+        """Remove a free buffer from the pool."""
+        self.num_buffers -= 1
+        self.memory -= buffer.nbytes
+
+    def _return(self, buffer):
+        """Return the buffer of a released NDArray to the pool."""
+        self._free.append(buffer)
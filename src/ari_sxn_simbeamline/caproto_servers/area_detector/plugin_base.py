@@ -1,10 +1,26 @@
+from area_detector.nd_array_pool import data_types
+from caproto import ChannelType
 from caproto.server import (PVGroup, pvproperty, get_pv_pair_wrapper,
                             ioc_arg_parser, run)
+from collections import deque
+import numpy as np
 from textwrap import dedent
+import time
 
 # A shortcut to use for PVs with a readback partner given by the suffix '_RBV'
 pvproperty_rbv = get_pv_pair_wrapper(setpoint_suffix='', readback_suffix='_RBV')
 
+# The DataType name of each of the numpy dtypes in data_types.
+data_type_names = {np.dtype(dtype): name for name, dtype in data_types.items()}
+
+
+def _plugins(group):
+    """Yield the PluginBase groups in group (including itself) and its SubGroups."""
+    if isinstance(group, PluginBase):
+        yield group
+    for subgroup in group.groups.values():
+        yield from _plugins(subgroup)
+
 
 class PluginBase(PVGroup):
     """
@@ -17,13 +33,212 @@ class PluginBase(PVGroup):
     1. Unless otherwise listed in the notes below the PVs generated are 'Dummy' PVs
     that are not modified by any inputs, or modify any other PVs, except there own
     values when they are updated.
+    2. The plugin receives the NDArrays (see nd_array_pool.py) published by the
+    plugin, or driver, whose self.port_name is the self.nd_array_port of this
+    plugin. The upstream port is looked for in the whole IOC (the top parent
+    PVGroup and its SubGroups) at startup and when self.nd_array_port changes.
+    3. The upstream port can also be set with the nd_array_port argument, which
+    is written to self.nd_array_port at startup.
+    4. Arrays are only received while self.enable is 'On', and arrays that arrive
+    within self.min_callback_time seconds of the last received one are ignored. If
+    self.blocking_callbacks is 'Yes' each array is processed as it is published,
+    otherwise it is added to a queue of at most self.queue_size arrays (holding a
+    reference to it) which is processed by the task started by the startup hook
+    of self.queue_size. Arrays that arrive when the queue is full are dropped and
+    counted in self.dropped_arrays, so that a slow plugin holds up neither the
+    upstream nor more than self.queue_size arrays of the pool.
+    5. Processing an array calls self._process_array (used by sub-classes to do
+    the work of the plugin), updates self.array_counter, self.unique_id,
+    self.time_stamp, the array size PVs and the pool PVs, and then publishes the
+    array to the plugins downstream of this one.
+    6. The pool PVs report the NDArrayPool of the driver (self.pool, or the pool
+    of the upstream port for a plugin), the queue PVs report the live queue use.
 
-    TODO:
-    1. ...
+    Parameters
+    ----------
+    *args : list
+        The arguments passed to the PVGroup parent class.
+    nd_array_port : str, optional
+        The initial port name of the upstream plugin (or driver), the default
+        is the self.nd_array_port value.
+    **kwargs : list, optional
+        The Keyword arguments passed to the PVGroup parent class.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, nd_array_port=None, **kwargs):
         super().__init__(*args, **kwargs)  # call the PVGroup __init__ function
+        self._initial_port = nd_array_port
+        self.pool = None  # the NDArrayPool of a driver
+        self._upstream = None  # the PluginBase whose arrays are received
+        self._subscribers = []  # the PluginBase groups that receive the arrays
+        self._queue = deque()  # the NDArrays waiting to be processed
+        self._queue_ready = None  # the Event that wakes up the queue task
+        self._last_callback = -float('inf')  # the time the last array was received
+
+    def _find_port(self, name):
+        """
+        Return the plugin (or driver) of the IOC with the port_name name.
+
+        Plugins downstream of this one are not returned, so that the arrays
+        can't loop back.
+
+        Parameters
+        ----------
+        name : str
+            The port name.
+
+        Returns
+        -------
+        plugin : PluginBase or None
+            The plugin, or None if there is no (allowed) plugin with that name.
+        """
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        for plugin in _plugins(root):
+            if plugin.port_name.value != name:
+                continue
+            upstream = plugin
+            while upstream is not None and upstream is not self:
+                upstream = upstream._upstream
+            if upstream is None:  # self is not upstream of plugin
+                return plugin
+
+        return None
+
+    def _connect(self):
+        """Subscribe to the arrays of the self.nd_array_port port."""
+        upstream = self._find_port(self.nd_array_port.readback.value)
+        if upstream is not self._upstream:
+            if self._upstream is not None:
+                self._upstream._subscribers.remove(self)
+            if upstream is not None:
+                upstream._subscribers.append(self)
+            self._upstream = upstream
+
+    def _array_pool(self):
+        """Return the NDArrayPool of the driver of the arrays (or None)."""
+        if self.pool is not None:
+            return self.pool
+        if self._upstream is not None:
+            return self._upstream._array_pool()
+
+        return None
+
+    @staticmethod
+    def _is_on(pair):
+        """Return True if the (bool) setpoint/readback pair is 'On'."""
+        # the initial value is the bool, written values are the enum strings
+        return pair.readback.value in ('On', True)
+
+    async def _update(self, pv, value):
+        """Write value to pv, only if it has changed (to not post to subscribers)."""
+        if pv.value != value:
+            await pv.write(value)
+
+    async def _increment(self, pair, count=1):
+        """Add count to a setpoint/readback pair counter (i.e. array_counter)."""
+        await pair.setpoint.write(pair.setpoint.value + count)
+
+    async def _update_pool_pvs(self):
+        """Write the live numbers of the NDArrayPool to the pool PVs."""
+        pool = self._array_pool()
+        if pool is None:
+            return
+        for pv, value in ((self.pool_max_buffers, pool.max_buffers),
+                          (self.pool_alloc_buffers, pool.num_buffers),
+                          (self.pool_free_buffers, pool.num_free),
+                          (self.pool_used_buffers, pool.num_buffers - pool.num_free),
+                          (self.pool_max_mem, pool.max_memory / 1E6),
+                          (self.pool_used_mem, pool.memory / 1E6)):
+            await self._update(pv, value)
+
+    async def _update_queue_pvs(self):
+        """Write the live queue use to the queue PVs."""
+        await self._update(self.queue_use, len(self._queue))
+        await self._update(self.queue_free, max(self.queue_size.value - len(self._queue), 0))
+
+    async def _process_array(self, array):
+        """
+        This method does the work of the plugin on a received array.
+
+        The PluginBase version does nothing, sub-classes re-define it.
+
+        Parameters
+        ----------
+        array : NDArray
+            The received array, which must not be kept after returning.
+        """
+        return
+
+    async def _publish_array(self, array):
+        """
+        This method passes an array to the plugins downstream of this one.
+
+        Parameters
+        ----------
+        array : NDArray
+            The array to publish.
+        """
+        for plugin in list(self._subscribers):
+            await plugin._on_array(array)
+
+    async def _on_array(self, array):
+        """
+        This method receives an array published by the upstream port.
+
+        Parameters
+        ----------
+        array : NDArray
+            The published array.
+        """
+        if not self._is_on(self.enable):
+            return
+        now = time.monotonic()
+        if now - self._last_callback < self.min_callback_time.readback.value:
+            return  # throttled
+        self._last_callback = now
+
+        if self.blocking_callbacks.readback.value == 'Yes':
+            await self._do_callbacks(array)
+        elif len(self._queue) >= max(self.queue_size.value, 1):
+            await self._increment(self.dropped_arrays)
+        else:
+            array.reserve()  # released once the array is processed
+            self._queue.append(array)
+            if self._queue_ready is not None:
+                self._queue_ready.set()
+        await self._update_queue_pvs()
+
+    async def _do_callbacks(self, array):
+        """
+        This method processes a received array (see the class NOTES).
+
+        Parameters
+        ----------
+        array : NDArray
+            The received array.
+        """
+        await self._process_array(array)
+
+        await self._increment(self.array_counter)
+        await self.unique_id.write(array.unique_id)
+        await self.time_stamp.write(array.timestamp)
+        shape = array.data.shape
+        await self._update(self.ndimensions, len(shape))
+        await self._update(self.dimensions, list(shape))
+        for pv, size in zip((self.array_size0, self.array_size1, self.array_size2),
+                            shape + (1, 1)):
+            await self._update(pv, size)
+        await self._update(self.data_type, data_type_names.get(array.data.dtype, ''))
+        await self._update_pool_pvs()
+
+        await self._publish_array(array)
+
+    def _flush_queue(self):
+        """Release the arrays waiting in the queue."""
+        while self._queue:
+            self._queue.popleft().release()
 
     _default_port_name = 'EM180'
     array_counter = pvproperty_rbv(name=':ArrayCounter', dtype=int)
@@ -46,8 +261,9 @@ class PluginBase(PVGroup):
                            report_as_string=True, read_only=True)
 
     bayer_pattern = pvproperty(name=':BayerPattern_RBV', dtype=int, read_only=True)
-    blocking_callbacks = pvproperty_rbv(name=':BlockingCallbacks',
-                                        report_as_string=True, dtype=str)
+    blocking_callbacks = pvproperty_rbv(name=':BlockingCallbacks', value='No',
+                                        dtype=ChannelType.ENUM,
+                                        enum_strings=['No', 'Yes'])
     color_mode = pvproperty(name=':ColorMode_RBV', dtype=int, read_only=True)
     data_type = pvproperty(name=':DataType_RBV', dtype=str,
                            report_as_string=True, read_only=True)
@@ -69,7 +285,7 @@ class PluginBase(PVGroup):
                              report_as_string=True, read_only=True)
     queue_free = pvproperty(name=':QueueFree', dtype=int)
     queue_free_low = pvproperty(name=':QueueFreeLow', dtype=float)
-    queue_size = pvproperty(name=':QueueSize', dtype=int)
+    queue_size = pvproperty(name=':QueueSize', dtype=int, value=5)
     queue_use = pvproperty(name=':QueueUse', dtype=float)
     queue_use_high = pvproperty(name=':QueueUseHIGH', dtype=float)
     queue_use_hihi = pvproperty(name=':QueueUseHIHI', dtype=float)
@@ -77,6 +293,59 @@ class PluginBase(PVGroup):
     unique_id = pvproperty(name=':UniqueId_RBV', dtype=int, read_only=True)
     array_data = pvproperty(name=':ArrayData', dtype=int, max_length=300000)
 
+    @queue_size.startup
+    async def queue_size(self, instance, async_lib):
+        """
+        This is a startup hook that connects to the upstream port and then
+        processes the queued arrays.
+        """
+        if self._initial_port is not None:
+            await self.nd_array_port.setpoint.write(self._initial_port)
+        self._connect()
+        await self._update_queue_pvs()
+        while True:
+            self._queue_ready = async_lib.Event()
+            if not self._queue:
+                await self._queue_ready.wait()
+            array = self._queue.popleft()
+            try:
+                await self._do_callbacks(array)
+            finally:
+                array.release()
+            await self._update_queue_pvs()
+
+    @queue_size.putter
+    async def queue_size(self, instance, value):
+        """
+        This is a putter function that updates queue_free when queue_size is set.
+        """
+        await self._update(self.queue_free, max(value - len(self._queue), 0))
+
+        return value
+
+    @nd_array_port.setpoint.putter
+    async def nd_array_port(obj, instance, value):
+        """
+        This is a putter function that re-connects to the new upstream port.
+        """
+        await obj.readback.write(value)
+        obj.parent._connect()
+
+        return value
+
+    @enable.setpoint.putter
+    async def enable(obj, instance, value):
+        """
+        This is a putter function that drops the queued arrays when the
+        callbacks are disabled.
+        """
+        await obj.readback.write(value)
+        if value not in ('On', True):
+            obj.parent._flush_queue()
+            await obj.parent._update_queue_pvs()
+
+        return value
+
 
 # Add some code to start a version of the server if this file is 'run'.
 if __name__ == "__main__":
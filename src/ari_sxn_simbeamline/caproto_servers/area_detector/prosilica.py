@@ -1,4 +1,5 @@
 from area_detector.prosilica_cam_plugin import ProsilicaCamPlugin
+from area_detector.stats_plugin import StatsPlugin
 from caproto.server import (PVGroup, SubGroup, ioc_arg_parser, run)
 from textwrap import dedent
 
@@ -15,7 +16,9 @@ class Prosilica(PVGroup):
     self.cam._generate_image method, to add functionality other than a
     'random' image use a sub-class which defines a new
     self.cam._generate_image method. If you want the camera to save images
-    then use the (TO BE DONE) ProsilicaTiff sub-class instead.
+    then use the (TO BE DONE) ProsilicaTiff sub-class instead. The
+    self.stats1 StatsPlugin calculates the statistics (i.e. the centroid) of
+    the camera images once its EnableCallbacks PV is set to 1.
 
     NOTES:
     1. Unless otherwise listed in the notes below the PVs generated are
@@ -24,6 +27,7 @@ class Prosilica(PVGroup):
     """
 
     cam = SubGroup(ProsilicaCamPlugin, prefix=":cam1")
+    stats1 = SubGroup(StatsPlugin, prefix=":Stats1", nd_array_port='CAM1')
 
 
 # Add some code to start a version of the server if this file is 'run'.
@@ -3,6 +3,7 @@ from caproto.server import (pvproperty, PVGroup, SubGroup,
                             ioc_arg_parser, run)
 import math
 from area_detector.cam_plugin import CamPlugin
+import numpy as np
 from area_detector.plugin_base import PluginBase, pvproperty_rbv
 from area_detector.stats_plugin import StatsPlugin
 import random
@@ -19,28 +20,41 @@ class QuadEM(PVGroup):
     when the device is triggered via setting the 'acquire' PV to 1 (see Notes below
     for details). This is done via the self._generate_current method, to add
     functionality other than a 'random' current use a sub-class which defines a
-    new self._generate_current method.
+    new self._generate_current method (or self._generate_samples for currents
+    that vary from sample to sample).
 
     NOTES:
     1. Unless otherwise listed in the notes below the PVs generated are 'Dummy' PVs
     that are not modified by any inputs, or modify any other PVs, except there own
     values when they are updated.
-    2. When self.acquire is set to 1 the sequence of events is:
-        i. record the initial time and set self.num_averaged to 0.
-        ii.  calculate the current to be set on each channel using self._generate_current
-        and write these to the self.current(x).mean_value attributes (x in [1,2,3,4])
-        iii. if self.averaging_time has elapsed continue otherwise wait until it has.
-        iv. set self.num_averaged to self.num_average and self.acquire to 0
+    2. Setting self.acquire to 1 only starts the acquisition, which runs as a task
+    started by the startup hook of self.acquire, so the other PVs of the IOC are
+    served while it runs. Each reading (one for the 'Single' acquire_mode, repeated
+    until self.acquire is set to 0 for 'Continuous') is:
+        i. set self.num_averaged to 0 and wait (asynchronously) for
+        self.averaging_time, the readings are paced from the start time so
+        continuous readings do not drift.
+        ii. the samples for the elapsed time (num_average/values_per_read per
+        averaging_time) are calculated using self._generate_samples and written
+        to a ring buffer of 2 * num_average/values_per_read samples, samples
+        that overwrite unread samples (i.e. if the event loop was held up for
+        more than a reading) are counted in self.ring_overflows.
+        iii. the reading takes the oldest (up to) num_average/values_per_read
+        unread samples from the ring buffer, first in first out as for the
+        electrometer hardware, so the samples of a held up reading are used
+        by the next readings. Their mean is written to the
+        self.current(x).mean_value attributes (x in [1,2,3,4]) and
+        self.num_averaged (the number of samples used) and self.num_acquired
+        are updated.
+    Once the acquisition finishes self.acquire is set to 0.
     3. When self.averaging_time or self.integrating_time are updated self.num_average is
     updated using the following relationship:
         - self.num_average = floor(self.averaging_time/self.integration_time)
-
-    TODO:
-    1. Think about adding a 'Continuous' acquire_mode as well as the current
-    'Single' acquire_mode.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)  # call the PluginBase __init__ function
+        self._start = None  # the Event that starts the acquisition task
+        self._ring = None  # [samples, next write index, unread count]
 
     async def _generate_currents(self):
         """
@@ -65,6 +79,100 @@ class QuadEM(PVGroup):
 
         return currents
 
+    async def _generate_samples(self, count):
+        """
+        This method is used to generate the per-sample currents for a reading.
+
+        The default uses the same self._generate_currents values for each of
+        the samples, a sub-class can re-define this to add per-sample
+        variation (i.e. noise) to the currents.
+
+        Parameters
+        ----------
+        count : int
+            The number of samples required.
+
+        Returns
+        -------
+        samples : np.array
+            A (count, 4) array with the current of each channel for each sample.
+        """
+        currents = await self._generate_currents()
+
+        return np.broadcast_to(np.asarray(currents, dtype=float), (count, 4))
+
+    def _reading_size(self):
+        """Return the number of samples in one reading (num_average/values_per_read)."""
+        return max(1, int(self.num_average.value) //
+                   max(1, int(self.values_per_read.readback.value)))
+
+    async def _read(self, elapsed):
+        """
+        This method adds the samples for elapsed seconds to the ring buffer
+        and writes the mean currents of the oldest unread samples.
+
+        The ring buffer holds two readings worth of samples, so only samples
+        of readings held up by more than a full averaging_time overwrite
+        unread samples (counted in self.ring_overflows).
+
+        Parameters
+        ----------
+        elapsed : float
+            The time since the previous reading, in seconds.
+        """
+        size = self._reading_size()
+        if self._ring is None or len(self._ring[0]) != 2 * size:
+            self._ring = [np.zeros((2 * size, 4)), 0, 0]
+        ring, index, unread = self._ring
+
+        period = max(self.averaging_time.readback.value, 1E-9) / size
+        count = max(1, int(round(elapsed / period)))
+        samples = await self._generate_samples(count)
+        overwritten = max(0, unread + count - len(ring))
+        if overwritten:
+            await self.ring_overflows.write(self.ring_overflows.value +
+                                            overwritten)
+        samples = samples[-len(ring):]  # the others are overwritten anyway
+        ring[(index + np.arange(len(samples))) % len(ring)] = samples
+        index = (index + len(samples)) % len(ring)
+        unread = min(unread + count, len(ring))
+
+        used = min(unread, size)  # the oldest unread samples
+        positions = (index - unread + np.arange(used)) % len(ring)
+        self._ring[1:] = [index, unread - used]
+
+        means = ring[positions].mean(axis=0)
+        for current, mean in zip((self.current1, self.current2, self.current3,
+                                  self.current4), means.tolist()):
+            await current.mean_value.write(mean)
+        await self.num_averaged.write(used)
+        await self.num_acquired.write(self.num_acquired.value + 1)
+
+    async def _acquisition(self, instance, async_lib):
+        """
+        This method runs the readings of one acquisition (see the class NOTES).
+        """
+        await self.num_acquired.write(0)
+        await self.ring_overflows.write(0)
+        self._ring = None  # start with an empty ring buffer
+        deadline = last = time.monotonic()
+        while instance.value == 1:
+            await self.num_averaged.write(0)
+            # the readings are paced from the nominal start time, so they don't drift
+            deadline = max(deadline + self.averaging_time.readback.value,
+                           time.monotonic() - 1)
+            # always yield to the event loop, even for a 0 averaging_time
+            await async_lib.library.sleep(max(deadline - time.monotonic(), 1E-3))
+            if instance.value != 1:  # stopped while waiting
+                break
+            now = time.monotonic()
+            await self._read(now - last)
+            last = now
+            if self.acquire_mode.readback.value != 'Continuous':
+                break
+
+        await instance.write(0)
+
     async def _reset_num_average(self):
         """This is a function that resets num_averaged when required.
 
@@ -146,29 +254,33 @@ class QuadEM(PVGroup):
     image1 = SubGroup(CamPlugin, prefix=":image1")
     sum_all = SubGroup(StatsPlugin, prefix=":SumAll")
 
-    # Add the code that sets new current values when 'acquire' is changed.
+    # Add the code that starts (or stops) the acquisition when 'acquire' is changed.
     @acquire.putter
     async def acquire(obj, instance, value):
         """
-        This is a putter function that steps through the proces required when the 'acquire'
-        PV is set to 1. If it is set to 0 it just sets itself to 0.
-        """
-        if value == 1:
-            await instance.write(1, verify_value=False)
-            start_timestamp = time.time()  # record initial time
-            await obj.num_averaged.write(0)  # set the number of averaged points to 0
-            currents = await obj._generate_currents()  # calculate the new current values and write out.
-            await obj.current1.mean_value.write(currents[0])
-            await obj.current2.mean_value.write(currents[1])
-            await obj.current3.mean_value.write(currents[2])
-            await obj.current4.mean_value.write(currents[3])
-            # Make sure that it has taken at least averaging_time to finish
-            while time.time()-start_timestamp < obj.averaging_time.readback.value:
-                time.sleep(1E-3)
-
-            await obj.num_averaged.write(obj.num_average.value)
-
-        return 0
+        This is a putter function that starts the acquisition task when the
+        'acquire' PV is set to 1. Setting it to 0 stops a running acquisition
+        after the current reading.
+        """
+        if value == 1 and instance.value != 1 and obj._start is not None:
+            obj._start.set()
+
+        return value
+
+    @acquire.startup
+    async def acquire(obj, instance, async_lib):
+        """
+        This is a startup hook that runs the acquisition task each time the
+        'acquire' PV is set to 1.
+        """
+        # The Event is created once, before the first wait, and cleared when
+        # an acquisition starts, so a start requested while the previous
+        # acquisition is finishing is not lost.
+        obj._start = async_lib.Event()
+        while True:
+            await obj._start.wait()
+            obj._start.clear()
+            await obj._acquisition(instance, async_lib)
 
     @averaging_time.setpoint.putter
     async def averaging_time(obj, instance, value):
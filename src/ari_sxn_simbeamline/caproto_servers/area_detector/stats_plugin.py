@@ -1,7 +1,11 @@
 from caproto.server import pvproperty, ioc_arg_parser, run
 from area_detector.plugin_base import PluginBase, pvproperty_rbv
+import numpy as np
 from textwrap import dedent
 
+# The maximum length of the profile and histogram PVs.
+max_profile_length = 4096
+
 
 class StatsPlugin(PluginBase):
     """
@@ -11,31 +15,269 @@ class StatsPlugin(PluginBase):
     1. Unless otherwise listed in the notes below the PVs generated are 'Dummy' PVs
     that are not modified by any inputs, or modify any other PVs, except there own
     values when they are updated.
-
-    TODO:
-    1. ...
+    2. The statistics are calculated from the arrays received from the
+    self.nd_array_port port (i.e. a CamPlugin with the 'CAM1' port name, see
+    PluginBase for how the arrays are received, queued and throttled by
+    self.min_callback_time). Only the groups of PVs that are switched 'On' are
+    calculated:
+        - self.compute_statistics: min_value, max_value (and their min_x/y,
+          max_x/y positions), mean_value, sigma, total and net (total minus the
+          mean of the self.bgd_width wide border times the number of pixels).
+        - self.compute_centroid: centroid_x/y, sigma_x/y and sigma_xy (the
+          normalized cross term) of the pixels >= self.centroid_threshold.
+        - self.compute_profiles: the average (profile_average_x/y), thresholded
+          average (profile_threshold_x/y) and the row/column through the
+          centroid (profile_centroid_x/y) and the cursor (profile_cursor_x/y).
+        - self.compute_histogram: the self.hist_size bin histogram of the values
+          in [self.hist_min, self.hist_max) and its entropy (hist_entropy).
+    x is the column (last axis) and y the row (first axis) of the array, 1D
+    arrays are treated as a single row.
+    3. Each array is converted once into a (re-used) float32 scratch buffer, all
+    the sums are then matrix-vector products of it (i.e. the column sums are
+    ones @ image) so no other full size temporaries are allocated. The second
+    moments (sigma, sigma_x/y and sigma_xy) are taken about the mean and the
+    centroid, so a narrow beam far from the origin keeps its precision.
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)  # call the PluginBase __init__ function
+        self._buffers = {}  # the scratch buffers, see self._scratch
+
+    def _scratch(self, name, shape, dtype=np.float32):
+        """
+        Return the scratch buffer name, re-allocated only if shape or dtype change.
+
+        Parameters
+        ----------
+        name : str
+            The name of the buffer.
+        shape : tuple
+            The shape of the buffer.
+        dtype : np.dtype
+            The dtype of the buffer, the default is np.float32.
+
+        Returns
+        -------
+        buffer : np.array
+            The buffer, its content is undefined.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+
+        return buffer
+
+    async def _process_array(self, array):
+        """
+        This method calculates the statistics of a received array.
+
+        Parameters
+        ----------
+        array : NDArray
+            The received array.
+        """
+        data = array.data.reshape(-1, array.data.shape[-1])
+        image = self._scratch('image', data.shape)
+        np.copyto(image, data)  # the only full size conversion
+        rows, columns = image.shape
+        ones_x = np.ones(columns, dtype=np.float32)
+        ones_y = np.ones(rows, dtype=np.float32)
+        profile_y = (image @ ones_x).astype(float)  # the row sums
+        total = profile_y.sum()
+
+        if self._is_on(self.compute_statistics):
+            await self._statistics(data, image, profile_y, total)
+        if self._is_on(self.compute_centroid) or self._is_on(self.compute_profiles):
+            weights = image
+            threshold = self.centroid_threshold.readback.value
+            if threshold > data.min():  # zero the pixels below the threshold
+                weights = self._scratch('weights', image.shape)
+                mask = self._scratch('mask', image.shape, dtype=bool)
+                np.greater_equal(image, threshold, out=mask)
+                np.multiply(image, mask, out=weights)
+            threshold_x = (ones_y @ weights).astype(float)
+            threshold_y = (weights @ ones_x).astype(float)
+            centroid = await self._centroid(weights, threshold_x, threshold_y)
+            if self._is_on(self.compute_profiles):
+                await self._profiles(image, ones_y, profile_y, threshold_x,
+                                     threshold_y, centroid)
+        if self._is_on(self.compute_histogram):
+            await self._histogram(image)
+
+    async def _statistics(self, data, image, profile_y, total):
+        """
+        This method writes the basic statistics of an array (see the class NOTES).
+
+        Parameters
+        ----------
+        data : np.array
+            The 2D received data.
+        image : np.array
+            The float32 copy of data.
+        profile_y : np.array
+            The row sums of image.
+        total : float
+            The sum of image.
+        """
+        rows, columns = image.shape
+        count = image.size
+        minimum, maximum = data.argmin(), data.argmax()
+        mean = total / count
+        # the row sums of squared deviations, accumulated in float64 over the
+        # rows (about the mean, as the raw moments cancel catastrophically)
+        deviations = self._scratch('deviations', image.shape)
+        np.subtract(image, mean, out=deviations)
+        squares = np.einsum('ij,ij->i', deviations, deviations).sum(dtype=float)
+        net = total
+        width = int(self.bgd_width.readback.value)
+        if 0 < width and 2 * width < min(rows, columns):
+            border = (profile_y[:width].sum() + profile_y[-width:].sum() +
+                      image[width:-width, :width].sum(dtype=float) +
+                      image[width:-width, -width:].sum(dtype=float))
+            border_count = count - (rows - 2 * width) * (columns - 2 * width)
+            net = total - border / border_count * count
+
+        for pv, value in ((self.min_value, data.flat[minimum]),
+                          (self.min_x, minimum % columns),
+                          (self.min_y, minimum // columns),
+                          (self.max_value, data.flat[maximum]),
+                          (self.max_x, maximum % columns),
+                          (self.max_y, maximum // columns),
+                          (self.mean_value, mean),
+                          (self.sigma, np.sqrt(squares / count)),
+                          (self.total, total),
+                          (self.net, net)):
+            await pv.write(float(value))
+
+    async def _centroid(self, weights, threshold_x, threshold_y):
+        """
+        This method calculates (and writes) the centroid of an array.
+
+        Parameters
+        ----------
+        weights : np.array
+            The float32 image with the pixels below the threshold set to 0.
+        threshold_x, threshold_y : np.array
+            The column and row sums of weights.
+
+        Returns
+        -------
+        centroid : (float, float)
+            The (x, y) centroid, (0, 0) if all the weights are 0.
+        """
+        rows, columns = weights.shape
+        x = np.arange(columns, dtype=float)
+        y = np.arange(rows, dtype=float)
+        moment = threshold_x.sum()
+        if moment <= 0:
+            return 0.0, 0.0
+
+        centroid_x = threshold_x @ x / moment
+        centroid_y = threshold_y @ y / moment
+        # the second moments are taken about the centroid, the raw moments
+        # (i.e. <x**2> - <x>**2) cancel catastrophically for a narrow beam far
+        # from the origin, as the float32 sums have a relative error of ~1E-7.
+        dx, dy = x - centroid_x, y - centroid_y
+        sigma_x = np.sqrt(threshold_x @ dx ** 2 / moment)
+        sigma_y = np.sqrt(threshold_y @ dy ** 2 / moment)
+        cross = dy @ (weights @ dx.astype(np.float32)) / moment
+        sigma_xy = 0.0
+        if sigma_x > 0 and sigma_y > 0:
+            sigma_xy = cross / (sigma_x * sigma_y)
+
+        if self._is_on(self.compute_centroid):
+            for pv, value in ((self.centroid_x, centroid_x),
+                              (self.centroid_y, centroid_y),
+                              (self.sigma_x, sigma_x), (self.sigma_y, sigma_y),
+                              (self.sigma_xy, sigma_xy)):
+                await pv.write(float(value))
+
+        return centroid_x, centroid_y
+
+    async def _profiles(self, image, ones_y, profile_y, threshold_x, threshold_y,
+                        centroid):
+        """
+        This method writes the profiles of an array (see the class NOTES).
+
+        Parameters
+        ----------
+        image : np.array
+            The float32 copy of the received data.
+        ones_y : np.array
+            A vector of ones with the length of the columns of image.
+        profile_y, threshold_x, threshold_y : np.array
+            The row sums of image and the column and row sums of the
+            thresholded image.
+        centroid : (float, float)
+            The (x, y) centroid.
+        """
+        rows, columns = image.shape
+
+        def row(y):  # (a copy of) the row closest to y
+            return image[int(np.clip(round(y), 0, rows - 1)), :].astype(float)
+
+        def column(x):  # (a copy of) the column closest to x
+            return image[:, int(np.clip(round(x), 0, columns - 1))].astype(float)
+
+        profile_x = (ones_y @ image).astype(float)  # the column sums
+        for pv, value in ((self.profile_average_x, profile_x / rows),
+                          (self.profile_average_y, profile_y / columns),
+                          (self.profile_threshold_x, threshold_x / rows),
+                          (self.profile_threshold_y, threshold_y / columns),
+                          (self.profile_centroid_x, row(centroid[1])),
+                          (self.profile_centroid_y, column(centroid[0])),
+                          (self.profile_cursor_x, row(self.cursor_y.readback.value)),
+                          (self.profile_cursor_y, column(self.cursor_x.readback.value))):
+            await pv.write(value[:max_profile_length])
+        await self.profile_size_x.write(float(columns))
+        await self.profile_size_y.write(float(rows))
+
+    async def _histogram(self, image):
+        """
+        This method writes the histogram of an array (see the class NOTES).
+
+        Parameters
+        ----------
+        image : np.array
+            The float32 copy of the received data (used as scratch space).
+        """
+        size = int(np.clip(self.hist_size.readback.value, 1, max_profile_length))
+        low, high = self.hist_min.readback.value, self.hist_max.readback.value
+        if high <= low:
+            return
+
+        # bin + 1, so that the values out of range are in the first or last bins
+        np.subtract(image, low, out=image)
+        np.multiply(image, size / (high - low), out=image)
+        np.clip(image, -1, size, out=image)
+        np.floor(image, out=image)
+        np.add(image, 1, out=image)
+        bins = self._scratch('bins', image.shape, dtype=np.int32)
+        np.copyto(bins, image, casting='unsafe')
+        counts = np.bincount(bins.ravel(), minlength=size + 2)[1:size + 1]
+
+        probability = counts[counts > 0] / max(counts.sum(), 1)
+        await self.histogram.write(counts.astype(float))
+        await self.hist_entropy.write(float(-(probability * np.log(probability)).sum()))
 
     bgd_width = pvproperty_rbv(name=':BgdWidth', dtype=float)
 
     centroid_threshold = pvproperty_rbv(name=':CentroidThreshold', dtype=float)
     centroid_x = pvproperty(name=':CentroidX_RBV', dtype=float, read_only=True)
     centroid_y = pvproperty(name=':CentroidY_RBV', dtype=float, read_only=True)
-    compute_centroid = pvproperty_rbv(name=':ComputeCentroid', dtype=bool)
+    compute_centroid = pvproperty_rbv(name=':ComputeCentroid', dtype=bool, value=True)
     compute_histogram = pvproperty_rbv(name=':ComputeHistogram', dtype=bool)
     compute_profiles = pvproperty_rbv(name=':ComputeProfiles', dtype=bool)
-    compute_statistics = pvproperty_rbv(name=':ComputeStatistics', dtype=bool)
+    compute_statistics = pvproperty_rbv(name=':ComputeStatistics', dtype=bool, value=True)
 
     cursor_x = pvproperty_rbv(name=':CursorX', dtype=float)
     cursor_y = pvproperty_rbv(name=':CursorY', dtype=float)
 
     hist_entropy = pvproperty(name=':HistEntropy_RBV', dtype=float, read_only=True)
-    hist_max = pvproperty_rbv(name=':HistMax', dtype=float)
-    hist_min = pvproperty_rbv(name=':HistMin', dtype=float)
-    hist_size = pvproperty_rbv(name=':HistSize', dtype=int)
-    histogram = pvproperty(name=':Histogram_RBV', dtype=float)
+    hist_max = pvproperty_rbv(name=':HistMax', dtype=float, value=256.0)
+    hist_min = pvproperty_rbv(name=':HistMin', dtype=float, value=0.0)
+    hist_size = pvproperty_rbv(name=':HistSize', dtype=int, value=256)
+    histogram = pvproperty(name=':Histogram_RBV', dtype=float, read_only=True,
+                           max_length=max_profile_length)
 
     max_size_x = pvproperty(name=':MaxSizeX', dtype=int)
     max_size_y = pvproperty(name=':MaxSizeY', dtype=int)
@@ -48,16 +290,24 @@ class StatsPlugin(PluginBase):
     min_y = pvproperty(name=':MinY_RBV', dtype=float, read_only=True)
     net = pvproperty(name=':Net_RBV', dtype=float, read_only=True)
 
-    profile_average_x = pvproperty(name=':ProfileAverageX_RBV', dtype=float, read_only=True)
-    profile_average_y = pvproperty(name=':ProfileAverageY_RBV', dtype=float, read_only=True)
-    profile_centroid_x = pvproperty(name=':ProfileCentroidX_RBV', dtype=float, read_only=True)
-    profile_centroid_y = pvproperty(name=':ProfileCentroidY_RBV', dtype=float, read_only=True)
-    profile_cursor_x = pvproperty(name=':ProfileCursorX_RBV', dtype=float, read_only=True)
-    profile_cursor_y = pvproperty(name=':ProfileCursorY_RBV', dtype=float, read_only=True)
+    profile_average_x = pvproperty(name=':ProfileAverageX_RBV', dtype=float,
+                                   read_only=True, max_length=max_profile_length)
+    profile_average_y = pvproperty(name=':ProfileAverageY_RBV', dtype=float,
+                                   read_only=True, max_length=max_profile_length)
+    profile_centroid_x = pvproperty(name=':ProfileCentroidX_RBV', dtype=float,
+                                    read_only=True, max_length=max_profile_length)
+    profile_centroid_y = pvproperty(name=':ProfileCentroidY_RBV', dtype=float,
+                                    read_only=True, max_length=max_profile_length)
+    profile_cursor_x = pvproperty(name=':ProfileCursorX_RBV', dtype=float,
+                                  read_only=True, max_length=max_profile_length)
+    profile_cursor_y = pvproperty(name=':ProfileCursorY_RBV', dtype=float,
+                                  read_only=True, max_length=max_profile_length)
     profile_size_x = pvproperty(name=':ProfileSizeX_RBV', dtype=float, read_only=True)
     profile_size_y = pvproperty(name=':ProfileSizeY_RBV', dtype=float, read_only=True)
-    profile_threshold_x = pvproperty(name=':ProfileThresholdX_RBV', dtype=float, read_only=True)
-    profile_threshold_y = pvproperty(name=':ProfileThresholdY_RBV', dtype=float, read_only=True)
+    profile_threshold_x = pvproperty(name=':ProfileThresholdX_RBV', dtype=float,
+                                     read_only=True, max_length=max_profile_length)
+    profile_threshold_y = pvproperty(name=':ProfileThresholdY_RBV', dtype=float,
+                                     read_only=True, max_length=max_profile_length)
 
     set_x_hopr = pvproperty(name=':SetXHOPR', dtype=float)
     set_y_hopr = pvproperty(name=':SetYHOPR', dtype=float)
@@ -7,6 +7,7 @@ from caproto.ioc_examples.fake_motor_record import FakeMotor
 from caproto.server import PVGroup, SubGroup, pvproperty, ioc_arg_parser, run
 from diagnostic import Diagnostic
 from nslsii.iocs.eps_two_state_ioc_sim import EPSTwoStateIOC
+from sim_stats import SimStats
 from textwrap import dedent
 
 
@@ -32,12 +33,18 @@ class AriM1(PVGroup):
     ----------
     *args : list
         The arguments passed to the PVGroup parent class.
+    model : AriModel, optional
+        The xrt simulation model whose component performance statistics are
+        published on the ':sim' PVs (see sim_stats.py) and whose m1_baffles
+        aperture gives the baffle blade photo-currents.
     **kwargs : list, optional
         The Keyword arguments passed to the PVGroup parent class.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, model=None, **kwargs):
         super().__init__(*args, **kwargs)  # call the PVGroup __init__ function
+        self.sim.model = model
+        self.baffle.currents.model = model
 
     # Add the mirror motor PVs.
 
@@ -64,6 +71,9 @@ class AriM1(PVGroup):
     # Add the diagnostic PVs.
     diag = SubGroup(Diagnostic, prefix=':diag')
 
+    # Add the simulation performance statistics PVs.
+    sim = SubGroup(SimStats, prefix=':sim')
+
 
 # Add some code to start a version of the server if this file is 'run'.
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-from area_detector.quad_em import QuadEM
+from blade_quad_em import BladeQuadEM
 from caproto.ioc_examples.fake_motor_record import FakeMotor
 from caproto.server import PVGroup, SubGroup, ioc_arg_parser, run
 from textwrap import dedent
@@ -11,17 +11,30 @@ class BaffleSlit(PVGroup):
     This class should be used to define the Baffle Slit system PVs for the baffle slits
     used in the ARI and SXN beamlines. It will consist of PVs for each of the associated
     motors for each baffle as well as the photo-current PVs from each of the blades.
+    The photo-currents are calculated from the rays absorbed by each blade of the
+    simulated aperture when a model is given (see blade_quad_em.py).
 
     TODO:
-    1. Work out how we want to define the area detector PVs, including how we 'update'
-       the photo-current PVs based from each of the blades when the mirror and/or baffles
-       are moved.
-    2. Decide how we want to implement the motor-record PVs.
+    1. Decide how we want to implement the motor-record PVs.
         - See the section in the AriM1Mirror PVGroup below on this topic.
+
+    Parameters
+    ----------
+    *args : list
+        The arguments passed to the PVGroup parent class.
+    model : AriModel, optional
+        The xrt simulation model used for the blade photo-currents.
+    aperture : str
+        The name of the aperture component of model, the default is
+        'm1_baffles'.
+    **kwargs : list, optional
+        The Keyword arguments passed to the PVGroup parent class.
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, model=None, aperture='m1_baffles', **kwargs):
         super().__init__(*args, **kwargs)  # call the PVGroup __init__ function
+        self.currents.model = model
+        self.currents.aperture = aperture
 
     # Add the baffle motor PVs.
     top = SubGroup(FakeMotor, velocity=1, precision=3,
@@ -33,7 +46,7 @@ class BaffleSlit(PVGroup):
     outboard = SubGroup(FakeMotor, velocity=1, precision=3,
                         user_limits=(-13, 40), prefix=':Outboard')
 
-    currents = SubGroup(QuadEM, prefix=':Currents')
+    currents = SubGroup(BladeQuadEM, prefix=':Currents')
 
 
 # Add some code to start a version of the server if this file is 'run'.
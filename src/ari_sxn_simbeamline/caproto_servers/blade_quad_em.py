@@ -0,0 +1,198 @@
+from area_detector.quad_em import QuadEM
+import asyncio
+from caproto.server import pvproperty, ioc_arg_parser, run
+import numpy as np
+from textwrap import dedent
+
+# The elementary charge, in Coulomb.
+elementary_charge = 1.602176634E-19
+
+# The xrt aperture edge ('kind') that each NSLS-II blade name corresponds to,
+# matching the parameter_map of the apertures in xrt_sim/ari_sim.py.
+blade_kinds = {'top': 'top', 'bottom': 'bottom', 'inboard': 'right',
+               'outboard': 'left'}
+
+
+def _source_nrays(model):
+    """
+    A reducer (see xrt_sim/reducers.py) returning the number of source rays.
+    """
+    return np.array(model.source.nrays)
+
+
+def _generation(model):
+    """
+    A reducer (see xrt_sim/reducers.py) returning the model generation.
+    """
+    return np.array(model.generation)
+
+
+def _same_parameters(parameters, other):
+    """
+    Return True if two AriModel.parameters outputs hold the same values.
+    """
+    return (other is not None and parameters.keys() == other.keys() and
+            all(np.array_equal(parameters[item], other[item])
+                for item in parameters))
+
+
+class BladeQuadEM(QuadEM):
+    """
+    A QuadEM PVGroup whose currents are the blade photocurrents of a slit.
+
+    The four currents are calculated from the rays absorbed by each blade of
+    an aperture of the xrt simulation (self.model, see xrt_sim/ari_sim.py),
+    using the reducers.BladeFlux reducer. The absorbed intensity of each
+    blade is converted to a current using:
+
+        current = e * photo_yield * photon_flux * blade_intensity / nrays
+
+    where nrays is the number of source rays (each with an intensity of ~1)
+    and photon_flux the flux of the full source, so the currents are
+    meaningful for any number of rays. The ray tracing never runs in the
+    event loop: when the model inputs (model.parameters, i.e. the motor
+    positions) differ from those of the last request, a reading requests a
+    recompute from a model_runner.ModelRunner, which runs model.activate and
+    the reducers in its worker thread and publishes the results back to the
+    event loop. The readings use the latest published result (waiting only
+    for the first one), so they may lag a blade move by one recompute. The
+    currents are kept until the published model generation (or the
+    conversion PVs) change, readings that re-use them are counted in
+    self.cache_hits. If self.model is None the random currents of the QuadEM
+    parent class are used.
+
+    Parameters
+    ----------
+    *args : list
+        The arguments passed to the QuadEM parent class.
+    model : AriModel, optional
+        The simulation model holding the aperture.
+    aperture : str
+        The name of the aperture component of model, the default is
+        'm1_baffles'.
+    channels : tuple
+        The blade ('top', 'bottom', 'inboard' or 'outboard') read by each of
+        the four current channels, the default is ('top', 'bottom',
+        'inboard', 'outboard').
+    **kwargs : list, optional
+        The Keyword arguments passed to the QuadEM parent class.
+
+    Attributes
+    ----------
+    cache_hits : int
+        The number of readings that re-used the previous currents.
+    """
+    def __init__(self, *args, model=None, aperture='m1_baffles',
+                 channels=('top', 'bottom', 'inboard', 'outboard'), **kwargs):
+        super().__init__(*args, **kwargs)  # call the QuadEM __init__ function
+        self.model = model
+        self.aperture = aperture
+        self.channels = tuple(channels)
+        self._runner = None  # the ModelRunner of self.model
+        self._runner_key = None  # the (model, aperture) of self._runner
+        self._published = None  # (version, outputs) from self._runner
+        self._ready = None  # the asyncio Event set by self._publish
+        self._requested = None  # the model.parameters of the last request
+        self._currents = None  # (generation, conversion, currents) last used
+        self.cache_hits = 0
+
+    photo_yield = pvproperty(name=':PhotoYield', dtype=float, value=0.01,
+                             precision=4,
+                             doc='electrons emitted per absorbed photon')
+    photon_flux = pvproperty(name=':PhotonFlux', dtype=float, value=1E12,
+                             precision=3,
+                             doc='photons per second of the full source')
+
+    async def _generate_currents(self):
+        """
+        This method returns the blade photocurrents from the simulation.
+
+        Returns
+        -------
+        currents : [float, float, float, float].
+            A list containing the current of each channel, in Amperes.
+        """
+        if self.model is None:
+            return await super()._generate_currents()
+
+        runner = self._get_runner()
+        parameters = self.model.parameters()
+        if not _same_parameters(parameters, self._requested):
+            runner.request()  # pick up the changed inputs
+            self._requested = parameters
+        while self._published is None:  # wait for the first result
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout=1)
+            except asyncio.TimeoutError:  # re-request in case it failed
+                runner.request()
+        _, outputs = self._published
+
+        generation = int(outputs['generation'])
+        conversion = (elementary_charge * self.photo_yield.value *
+                      self.photon_flux.value / int(outputs['nrays']))
+        if (self._currents is not None and
+                self._currents[:2] == (generation, conversion)):
+            self.cache_hits += 1
+            return list(self._currents[2])
+
+        kinds = list(getattr(self.model, self.aperture).kind)
+        flux = outputs['flux']
+        currents = [float(conversion * flux[kinds.index(blade_kinds[channel])])
+                    if blade_kinds[channel] in kinds else 0.0
+                    for channel in self.channels]
+        self._currents = (generation, conversion, currents)
+
+        return list(currents)
+
+    def _get_runner(self):
+        """
+        Return the ModelRunner of self.model, (re-)starting it if required.
+
+        This must be called from the event loop, which the results are
+        published on.
+        """
+        if (self._runner is not None and
+                self._runner_key != (self.model, self.aperture)):
+            self._runner.close()
+            self._runner = None
+        if self._runner is None:
+            # xrt_sim is only required when a model is used.
+            from model_runner import ModelRunner
+            from reducers import BladeFlux
+
+            self._published = self._requested = self._currents = None
+            self._ready = asyncio.Event()
+            self._runner = ModelRunner(
+                self.model, publish=self._publish,
+                loop=asyncio.get_running_loop(),
+                reducers={'flux': BladeFlux(self.aperture),
+                          'nrays': _source_nrays,
+                          'generation': _generation})
+            self._runner_key = (self.model, self.aperture)
+
+        return self._runner
+
+    async def _publish(self, version, outputs):
+        """
+        Store a result published by self._runner, in the event loop.
+
+        Parameters
+        ----------
+        version : int
+            The version stamp of the result.
+        outputs : dict
+            The 'flux' (per blade, in the order of the aperture kind), 'nrays'
+            and 'generation' reducer outputs.
+        """
+        if self._published is None or version > self._published[0]:
+            self._published = (version, outputs)
+        self._ready.set()
+
+
+# Add some code to start a version of the server if this file is 'run'.
+if __name__ == "__main__":
+    ioc_options, run_options = ioc_arg_parser(
+        default_prefix="BladeQuadEM",
+        desc=dedent(BladeQuadEM.__doc__))
+    ioc = BladeQuadEM(**ioc_options)
+    run(ioc.pvdb, **run_options)
@@ -0,0 +1,135 @@
+"""
+This file contains the PVGroups used to publish the performance statistics
+of the xrt simulation components as read-only PVs.
+"""
+from caproto.server import PVGroup, SubGroup, pvproperty, ioc_arg_parser, run
+from textwrap import dedent
+
+
+class ComponentStats(PVGroup):
+    """
+    A PVGroup that generates the read-only statistics PVs of a sim component.
+
+    The values are written by self.publish from the dictionary returned by the
+    ActivationStats.summary method (see xrt_sim/instrumentation.py) of one of
+    the components of the xrt simulation (i.e. AriModel.m1).
+
+    Parameters
+    ----------
+    *args : list
+        The arguments passed to the PVGroup parent class.
+    **kwargs : list, optional
+        The Keyword arguments passed to the PVGroup parent class.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)  # call the PVGroup __init__ function
+
+    last_trace_time = pvproperty(value=0.0, name=':LastTraceTime',
+                                 read_only=True, units='s', precision=6)
+    mean_trace_time = pvproperty(value=0.0, name=':MeanTraceTime',
+                                 read_only=True, units='s', precision=6)
+    max_trace_time = pvproperty(value=0.0, name=':MaxTraceTime',
+                                read_only=True, units='s', precision=6)
+    rays_in = pvproperty(value=0, name=':RaysIn', read_only=True)
+    rays_out = pvproperty(value=0, name=':RaysOut', read_only=True)
+    mean_rays_out = pvproperty(value=0.0, name=':MeanRaysOut', read_only=True,
+                               precision=1)
+    nbytes = pvproperty(value=0, name=':Bytes', read_only=True, units='B')
+    mean_nbytes = pvproperty(value=0.0, name=':MeanBytes', read_only=True,
+                             units='B', precision=0)
+    activations = pvproperty(value=0, name=':Activations', read_only=True)
+    skipped = pvproperty(value=0, name=':Skipped', read_only=True)
+    skip_fraction = pvproperty(value=0.0, name=':SkipFraction',
+                               read_only=True, precision=3)
+
+    async def publish(self, summary):
+        """
+        Write the values of an ActivationStats summary to the PVs.
+
+        Parameters
+        ----------
+        summary : dict
+            The dictionary returned by ActivationStats.summary.
+        """
+        for pv, key in ((self.last_trace_time, 'last_time'),
+                        (self.mean_trace_time, 'mean_time'),
+                        (self.max_trace_time, 'max_time'),
+                        (self.rays_in, 'last_rays_in'),
+                        (self.rays_out, 'last_rays_out'),
+                        (self.mean_rays_out, 'mean_rays_out'),
+                        (self.nbytes, 'last_nbytes'),
+                        (self.mean_nbytes, 'mean_nbytes'),
+                        (self.activations, 'activations'),
+                        (self.skipped, 'skipped'),
+                        (self.skip_fraction, 'skip_fraction')):
+            value = type(pv.value)(summary[key])
+            if value != pv.value:  # only post changes to the subscribers
+                await pv.write(value)
+
+
+class SimStats(PVGroup):
+    """
+    A PVGroup that publishes the performance statistics of the xrt simulation.
+
+    Every self.update_period seconds the AriModel.stats dictionary of
+    self.model (see xrt_sim/ari_sim.py) is read and written to the
+    ComponentStats SubGroup of each component, i.e. the last trace time of M1
+    is published as '<prefix>:m1:LastTraceTime'. Nothing is published while
+    self.model is None (the default) or self.update_period is <= 0.
+
+    Parameters
+    ----------
+    *args : list
+        The arguments passed to the PVGroup parent class.
+    model : AriModel, optional
+        The simulation model whose statistics are published.
+    **kwargs : list, optional
+        The Keyword arguments passed to the PVGroup parent class.
+    """
+
+    def __init__(self, *args, model=None, **kwargs):
+        super().__init__(*args, **kwargs)  # call the PVGroup __init__ function
+        self.model = model
+
+    # Add the statistics PVs for each component of the model.
+    source = SubGroup(ComponentStats, prefix=':source')
+    m1 = SubGroup(ComponentStats, prefix=':m1')
+    m1_baffles = SubGroup(ComponentStats, prefix=':m1_baffles')
+    m1_diag = SubGroup(ComponentStats, prefix=':m1_diag')
+    m1_diag_slit = SubGroup(ComponentStats, prefix=':m1_diag_slit')
+
+    update_period = pvproperty(value=1.0, name=':UpdatePeriod', units='s',
+                               precision=2)
+
+    async def publish(self):
+        """
+        Write the current statistics of self.model to the PVs.
+        """
+        if self.model is None:
+            return
+
+        for name, summary in self.model.stats().items():
+            group = getattr(self, name, None)
+            if isinstance(group, ComponentStats):
+                await group.publish(summary)
+
+    @update_period.startup
+    async def update_period(self, instance, async_lib):
+        """
+        This is a startup hook that periodically publishes the statistics.
+        """
+        while True:
+            period = instance.value
+            if period > 0:
+                await self.publish()
+            await async_lib.library.sleep(period if period > 0 else 1.0)
+
+
+# Add some code to start a version of the server if this file is 'run'.
+if __name__ == "__main__":
+    ioc_options, run_options = ioc_arg_parser(
+        default_prefix="SimStats",
+        desc=dedent(SimStats.__doc__))
+    ioc = SimStats(**ioc_options)
+    run(ioc.pvdb, **run_options)
@@ -1,28 +1,192 @@
+from binning import BeamBinner
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from custom_devices import (ID29Source, ID29OE, ID29Aperture, ID29Screen,
-                            TestM1, transform_NSLS2XRT)
-import matplotlib
-from matplotlib import pyplot as plt
+                            TestM1, seeded_random_state, transform_NSLS2XRT)
+import copy
+from functools import lru_cache
+from parameter_map import ParameterBank
+import pickle
+from ray_store import source_attributes
+from reflectivity import TabulatedMaterial
 import numpy as np
-import xarray as xr
+import os
+import threading
 import xrt.backends.raycing as xrt_raycing
 import xrt.backends.raycing.materials as xrt_material
 
-matplotlib.use('qtagg')
 
-# Define a test object to use in place of the caproto IOC for testing
-mirror1 = TestM1({'Ry_coarse': np.radians(2), 'Ry_fine': 0, 'Rz': 0,
-                  'x': 0, 'y': 0})
+# The source attributes included in AriModel.spec, nrays is set per call and
+# the acceptance_window is re-calculated from the other attributes.
+_source_settings = tuple(attribute for attribute in source_attributes
+                         if attribute not in ('nrays', 'acceptance_window')
+                         ) + ('seed',)
+
+# The (pickled spec, AriModel) used by each process pool worker, see
+# _get_worker_model.
+_worker_model = None
+
+
+def _get_worker_model(spec):
+    """
+    Return the AriModel of this process pool worker for a model spec.
+
+    Each worker process builds its own AriModel (see AriModel.from_spec) the
+    first time it is called, and then re-uses it for later calls with the
+    same spec. A different spec (i.e. from another model) re-builds it.
+
+    Parameters
+    ----------
+    spec : dict
+        The output of AriModel.spec.
+
+    Returns
+    -------
+    model : AriModel
+        The model of this worker.
+    """
+    global _worker_model
+    key = pickle.dumps(spec)
+    if _worker_model is None or _worker_model[0] != key:
+        _worker_model = (key, AriModel.from_spec(spec))
+
+    return _worker_model[1]
+
+
+def _trace_chunk(spec, parameters, nrays, seed, reducers=None):
+    """
+    Trace one independently seeded chunk of rays through an AriModel.
+
+    This is run inside the process pool workers used by
+    AriModel.trace_parallel, using the worker model for spec (see
+    _get_worker_model).
+
+    Parameters
+    ----------
+    spec : dict
+        The configuration of the model, from AriModel.spec().
+    parameters : dict
+        The parameter values for each component, from AriModel.parameters().
+    nrays : int
+        The number of rays to generate at the source.
+    seed : int
+        The seed for the random number generator used by the source.
+    reducers : dict, optional
+        A dictionary mapping output names to reducers (see reducers.py). If
+        None the beamOut of every component is returned.
+
+    Returns
+    -------
+    output : dict
+        A dictionary mapping the reducer names to their outputs, or the
+        component names to their beamOut if reducers is None.
+    """
+    model = _get_worker_model(spec)
+    model.apply_parameters(parameters)
+    model.source.nrays = nrays
+    with seeded_random_state(seed):  # XRT uses the global random state
+        model.activate(updated=True)
+
+    if reducers is None:
+        return {item: getattr(model, item).beamOut
+                for item in model.components}
+
+    return {name: reducer(model) for name, reducer in reducers.items()}
+
+
+def _scan_points(model, points, reducers, seed=None, spec=None,
+                 nrays=None):
+    """
+    Evaluate the reducers at each of a sequence of parameter sets.
+
+    This is used by AriModel.scan, either in this process or inside the
+    process pool workers. All of the components are re-traced for the first
+    point, and the later points are evaluated in order so only the components
+    whose parameters differ from the previous point (and those downstream)
+    are re-traced. The random state is seeded in the same way for every
+    point, so the rays do not depend on where a block of points starts.
+
+    Parameters
+    ----------
+    model : AriModel or None
+        The model to use, if None the process pool worker model for spec is
+        used (see _get_worker_model).
+    points : list
+        A list of dictionaries mapping component names to their values
+        vectors, see AriModel.parameters().
+    reducers : dict
+        A dictionary mapping output names to reducers (see reducers.py).
+    seed : int, optional
+        If not None, the random state is seeded with this value (and
+        restored afterwards) for the activation at each point.
+    spec : dict, optional
+        The configuration of the model, from AriModel.spec(), used if model
+        is None.
+    nrays : int, optional
+        If not None, the number of rays generated at the source.
+
+    Returns
+    -------
+    output : list
+        A list, with one dictionary for each point, mapping the reducer names
+        to their outputs.
+    """
+    if model is None:
+        model = _get_worker_model(spec)
+    if nrays is not None:
+        model.source.nrays = nrays
+
+    output = []
+    for i, parameters in enumerate(points):
+        model.apply_parameters(parameters)
+        with seeded_random_state(seed):  # XRT uses the global random state
+            model.activate(updated=(i == 0))
+        # (copied, as some reducers re-use their output array)
+        output.append({name: np.array(reducer(model))
+                       for name, reducer in reducers.items()})
+
+    return output
 
 
 # Define a function for creating xarrays from beamin/ beamout objects
+# The BeamBinner instances used by beam_to_xarray. As their scratch arrays
+# are re-used between calls each thread (i.e. a ModelRunner worker and the IOC
+# event loop) has its own, in an OrderedDict keyed on (bins, range) holding at
+# most _max_binners of the most recently used.
+_binners = threading.local()
+_max_binners = 8
+
+
+def _get_binner(key):
+    """
+    Return the BeamBinner of this thread for a (bins, output_range) key.
+    """
+    binners = getattr(_binners, 'binners', None)
+    if binners is None:
+        binners = _binners.binners = OrderedDict()
+    if key in binners:
+        binners.move_to_end(key)
+    else:
+        binners[key] = BeamBinner(*key, fields=('x', 'z', 'E'))
+        while len(binners) > _max_binners:
+            binners.popitem(last=False)
+
+    return binners[key]
+
+
 def beam_to_xarray(beam_object, bins=(100, 100, 100),
-                   output_range=((-10, 10), (-10, 10), None)):
+                   output_range=((-10, 10), (-10, 10), None), weights=None,
+                   out=None):
     """
     Convert a beam object to an xarray object.
 
     This function takes a beam object and converts it to an xarray object
     with the beam properties as data variables. The xarray object is then
-    returned.
+    returned. The binning is done by a BeamBinner (see binning.py), one of
+    which is kept (per thread) for each of the recently used bins and
+    output_range combinations so that the bin coordinates and scratch arrays
+    are re-used between calls.
 
     Parameters
     ----------
@@ -36,45 +200,59 @@ def beam_to_xarray(beam_object, bins=(100, 100, 100),
         The range of the histogram along each direction. If None, the range
         is automatically determined.
 
+    weights : str, np.array or None, optional
+        The weight of each ray, 'intensity' uses Jss + Jpp for each ray. If
+        None (the default) the rays are counted.
+
+    out : an xarray object, optional
+        A beam_array from a previous call (with the same bins and a fixed
+        output_range) that the histogram is added to and returned.
+
     Returns
     -------
     beam_array : an xarray object
         The xarray object with the beam properties as data variables.
     """
+    key = (tuple(bins), tuple(None if value is None else tuple(value)
+                              for value in output_range))
+    binner = _get_binner(key)
 
-    # extract the required values
-    points = np.vstack([beam_object.__dict__['x'],
-                        beam_object.__dict__['z'],
-                        beam_object.__dict__['E']]).T
+    if type(weights) is str and weights == 'intensity':
+        weights = beam_object.Jss + beam_object.Jpp
 
-    data, edges = np.histogramdd(points, bins=bins, range=output_range)
+    if out is not None:
+        if None in key[1]:
+            raise ValueError('out can only be used with a fixed output_range')
+        binner.bin(beam_object, weights=weights, out=out.data)
+        return out
 
-    # convert the edges to the correct lists
-    x_coords = list(edges[0][:-1])
-    z_coords = list(edges[1][:-1])
-    E_coords = list(edges[2][:-1])
+    return binner.to_xarray(beam_object, weights=weights)
 
-    # create the xarray object
-    beam_array = xr.DataArray(data,
-                              coords={'x': x_coords, 'z': z_coords,
-                                      'E': E_coords},
-                              dims=['x', 'z', 'E'])
 
-    return beam_array
+@lru_cache(maxsize=None)
+def materials():
+    """
+    Return the optics coating material instances, built on the first call.
 
+    Returns
+    -------
+    materials : dict
+        A dictionary mapping the material names ('nickel', 'gold' and
+        'genericGR') to xrt.backends.raycing.materials.Material instances.
+    """
+    nickel = xrt_material.Material('Ni', rho=8.908,
+                                   table='Chantler Total',
+                                   kind='mirror', name='Ni')
 
-# Define optics coating material instances.
-nickel = xrt_material.Material('Ni', rho=8.908,
-                               table='Chantler Total',
-                               kind='mirror', name='Ni')
+    gold = xrt_material.Material('Au', rho=19.3, table='Chantler Total',
+                                 kind='mirror', name='Au')
 
-gold = xrt_material.Material('Au', rho=19.3, table='Chantler Total',
-                             kind='mirror', name='Au')
+    genericGR = xrt_material.Material('Ni', rho=8.908,
+                                      table='Chantler total',
+                                      kind='grating', name='generic grating',
+                                      efficiency=[(1, 1), (-1, 1)])  # eff.=1
 
-genericGR = xrt_material.Material('Ni', rho=8.908,
-                                  table='Chantler total',
-                                  kind='grating', name='generic grating',
-                                  efficiency=[(1, 1), (-1, 1)])  # efficiency=1
+    return {'nickel': nickel, 'gold': gold, 'genericGR': genericGR}
 
 
 # noinspection PyUnresolvedReferences
@@ -85,13 +263,55 @@ class AriModel:
     This class simulates the beam propagation along the ARI beamline and gives
     the beam properties at each beamline component.
 
+    The XRT BeamLine and the components are built when the class is
+    instantiated, so importing this module does not build any XRT objects.
+
     Parameters
     ----------
-    update_comp : argument, passed to the update method.
+    mirror1 : object, optional
+        The object whose attributes give the M1 motor positions (i.e. the
+        caproto IOC), see the TestM1 class in custom_devices.py. The default,
+        None, uses a TestM1 object with the default positions.
+    cache : BeamCache, optional
+        A beam_cache.BeamCache instance shared by all of the components to
+        store and re-use their outputs for previously seen parameter values.
+        The cache counters (cache.stats()) can be used to size the memory
+        budget. The default, None, disables caching.
+    compact : Boolean
+        If True each component drops the rays lost upstream of it before
+        tracing (see custom_devices.compact_beam). The default is False.
+    compact_dtype : np.dtype, optional
+        The dtype the compacted float arrays are cast to (not used for the
+        ID29OE components), the default keeps the original dtype.
+    ray_store : RayStore, optional
+        A ray_store.RayStore instance used by the source to save the rays it
+        generates to disk and map them back in on later starts. It is only
+        used if seed is not None.
+    seed : int, optional
+        The seed used by the source when generating rays for the ray_store.
+    sampling : str
+        The sampling used by the source, 'random' (the default), 'sobol' or
+        'halton' (see ID29Source).
+    reflectivity_table : dict, optional
+        If not None, the M1 coating material is wrapped in a
+        reflectivity.TabulatedMaterial with these keyword arguments (i.e.
+        {'tolerance': 1E-4, 'cache_dir': 'tables'}). The energy_range
+        defaults to the energy_value +/- 6 x energy_bandwidth. The default,
+        None, uses the exact material reflectivities.
+    acceptance : Boolean
+        If True the source only samples rays inside the angular acceptance of
+        M1, with the intensities scaled to keep the flux correct (see
+        ID29Source). This greatly increases the number of rays reaching M1
+        for the wide default source divergence. The default is False.
 
     Attributes
     ----------
     *attrs : many
+    generation : int
+        A counter that is incremented each time self.activate re-traces at
+        least one component.
+    last_traced : tuple
+        The names of the components re-traced by the last self.activate call.
 
     Methods
     -------
@@ -99,121 +319,733 @@ class AriModel:
 
     """
 
-    def __init__(self):
+    def __init__(self, mirror1=None, cache=None, compact=False,
+                 compact_dtype=None, ray_store=None, seed=None,
+                 sampling='random', reflectivity_table=None,
+                 acceptance=False):
+        # The input object (i.e. the caproto IOC) for the M1 parameters
+        if mirror1 is None:  # use a test object in place of the caproto IOC
+            mirror1 = TestM1({'Ry_coarse': np.radians(2), 'Ry_fine': 0,
+                              'Rz': 0, 'x': 0, 'y': 0})
+        self.mirror1 = mirror1
+        self.reflectivity_table = reflectivity_table
+        # The constructor arguments used by self.spec
+        self._config = {'compact': compact, 'compact_dtype': compact_dtype,
+                        'reflectivity_table': reflectivity_table,
+                        'acceptance': acceptance}
+        self._build_components()  # Build the beamline components
         # An ordered list of beamline components
         self.components = ['source', 'm1', 'm1_baffles', 'm1_diag',
                            'm1_diag_slit']
+        self.cache = cache  # optional BeamCache shared by the components
+        for item in self.components:
+            obj = getattr(self, item)
+            obj.cache = cache
+            if hasattr(obj, 'compact'):  # components with an upstream
+                obj.compact = compact
+                # The OE surface intersection search needs double precision.
+                if not isinstance(obj, ID29OE):
+                    obj.compact_dtype = compact_dtype
+        self.source.ray_store = ray_store
+        self.source.seed = seed
+        self.source.sampling = sampling
+        if acceptance:  # only sample the rays that can reach M1
+            self.source.acceptance = self.m1
+        self.generation = 0  # incremented each time any component re-traces
+        self._build_graph()  # Build the component dependency graph
         self.activate(updated=True)  # Initialize the beamline components
 
+    def _build_graph(self):
+        """
+        Build the dependency graph between the beamline components.
+
+        Each component's '_upstream' attribute defines an edge from that
+        upstream component to it. This method uses these edges to build the
+        mappings between each component and its upstream/downstream
+        components, an activation order where every component comes after its
+        upstream component (ties are broken by the order in self.components)
+        and the per-component dirty bits and generation stamps used by
+        self.activate. A component may also have a '_watches' attribute,
+        listing other components whose parameters it depends on (i.e. the
+        source with an acceptance optic), that are not upstream of it.
+        """
+        names = {id(getattr(self, item)): item for item in self.components}
+
+        self._upstream = {}
+        self._downstream = {item: [] for item in self.components}
+        for item in self.components:
+            upstream = getattr(getattr(self, item), '_upstream', None)
+            if upstream is None:
+                self._upstream[item] = None
+            elif id(upstream) in names:
+                self._upstream[item] = names[id(upstream)]
+                self._downstream[names[id(upstream)]].append(item)
+            else:
+                raise ValueError(f'The upstream component of {item} is not '
+                                 f'in {self.components}')
+
+        self._watches = {}
+        for item in self.components:
+            watches = getattr(getattr(self, item), '_watches', ())
+            self._watches[item] = [names[id(obj)] for obj in watches
+                                   if id(obj) in names]
+
+        self._order = []
+        remaining = list(self.components)
+        while remaining:
+            ready = [item for item in remaining
+                     if self._upstream[item] is None or
+                     self._upstream[item] in self._order]
+            if not ready:
+                raise ValueError(f'The upstream components of {remaining} '
+                                 f'form a loop')
+            self._order.extend(ready)
+            remaining = [item for item in remaining if item not in ready]
+
+        self._dirty = {item: True for item in self.components}
+        self._generations = {item: 0 for item in self.components}
+        self.last_traced = ()
+        self._parameters = ParameterBank(
+            [getattr(self, item)._parameters for item in self._order])
+
+    def downstream(self, item):
+        """
+        Return the names of all components downstream of a component.
+
+        Parameters
+        ----------
+        item : str
+            The name of the component, from self.components.
+
+        Returns
+        -------
+        downstream : list
+            The names of every component that (directly or indirectly) uses
+            the output of item, in activation order.
+        """
+        found = set()
+        pending = list(self._downstream[item])
+        while pending:
+            name = pending.pop()
+            if name not in found:
+                found.add(name)
+                pending.extend(self._downstream[name])
+
+        return [name for name in self._order if name in found]
+
+    def invalidate(self, item):
+        """
+        Mark a component, and everything downstream of it, as dirty.
+
+        Dirty components are re-traced on the next call to self.activate even
+        if none of their parameters have changed. This can be used when
+        something not covered by a components parameter_map (e.g. the
+        material of an optic) has been modified.
+
+        Parameters
+        ----------
+        item : str
+            The name of the component, from self.components.
+        """
+        for name in [item] + self.downstream(item):
+            self._dirty[name] = True
+
+    def generations(self):
+        """
+        Return the generation at which each component was last re-traced.
+
+        Returns
+        -------
+        generations : dict
+            A dictionary mapping the component names to the value of
+            self.generation when they were last re-traced.
+        """
+        return dict(self._generations)
+
     def activate(self, updated=False):
         """
         Activate the beamline components.
 
-        This method activates the required beamline components in order, as
-        specified by the updated attribute. It returns 'updated' as it may be
-        modified by the calls to the component activate methods. This is done
-        purely so that AriModel could potentially be used as a component in a
-        higher level beamline object.
+        This method walks the components dependency graph (built from each
+        components '_upstream' attribute) in order. The parameters of every
+        component are read and compared with those from the previous call in
+        one vectorized comparison, and components with no parameter changes
+        that don't need to be re-traced are skipped. A component is re-traced
+        if any of its parameters (or those of the components it watches, see
+        self._build_graph) have changed, if it has been marked as dirty
+        (see self.invalidate), or if its upstream component was re-traced
+        during this call. Components on other branches are left untouched, so
+        a parameter change only re-traces that component and those downstream
+        of it. Each call that re-traces at least one component increments
+        self.generation and stamps the re-traced components with it. It
+        returns 'updated' as it may be modified by the calls to the component
+        activate methods. This is done purely so that AriModel could
+        potentially be used as a component in a higher level beamline object.
 
         Parameters
         updated: a boolean, i.e., False (by default) or True.
             True means the outcome of all components needs to be updated
             otherwise it will only update items (and those downstream) for which
             some of the parameters have been changed.
+
+        Returns
+        -------
+        updated : Boolean
+            True if any of the components were re-traced.
         """
+        # One read of every components parameters and a single vectorized
+        # comparison finds the components with changed parameters. The values
+        # are only committed once every component has been activated, so the
+        # changes are picked up again by the next call if one of them fails.
+        values = self._parameters.read()
+        changed = dict(zip(self._order,
+                           self._parameters.changed(values, commit=False)))
 
+        traced = []
+        try:
+            for item in self._order:
+                item_changed = changed[item] or any(
+                    changed[name] for name in self._watches[item])
+                force = (updated or self._dirty[item] or
+                         self._upstream[item] in traced)
+                obj = getattr(self, item)
+                if force or item_changed:
+                    try:
+                        if obj.activate(updated=force):
+                            traced.append(item)
+                    except Exception:
+                        # The component may have applied its new parameters
+                        # before failing, so force it (and everything
+                        # downstream) to be re-traced by the next call.
+                        self.invalidate(item)
+                        raise
+                else:  # record the skip, as the component is not called
+                    obj.stats.record(0.0, skipped=True)
+                self._dirty[item] = False
+            self._parameters.commit(values)
+        finally:
+            if traced:
+                self.generation += 1
+                for item in traced:
+                    self._generations[item] = self.generation
+            self.last_traced = tuple(traced)
+
+        return bool(traced)
+
+    def stats(self, reset=False):
+        """
+        Return the activation statistics of every component.
+
+        Parameters
+        ----------
+        reset : Boolean
+            If True the statistics are cleared after they are read.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary mapping the component names to the summary of their
+            ActivationStats (see instrumentation.py), i.e. the 'last_time',
+            'mean_time' and 'max_time' of their activations, in seconds, and
+            the good rays in and out, bytes allocated and skip counts.
+        """
+        out = {}
         for item in self.components:
-            updated = getattr(self, item).activate(updated=updated)
-
-        return updated
-
-    # Initialize the beamline object
-    bl = xrt_raycing.BeamLine(azimuth=0.0, height=0.0, alignE=0)
-    energy_value = 850.0  # default energy in eV.
-    energy_bandwidth = 5.0  # default energy width in eV.
-
-    # Add the source to beamline object bl
-    # TODO: Consider a toroidal (donut) source profile.
-    source = ID29Source(bl=bl,
-                        name='source',
-                        center=(0, 0, 0),  # location (global XRT coords)
-                        nrays=10000,
-                        distx='normal', dx=0.30,  # source linear profile
-                        disty=None, dy=0,
-                        distz='normal', dz=0.001,
-                        distxprime='normal', dxprime=0.1,  # angular profile
-                        distzprime='normal', dzprime=0.1,
-                        # source energy profile below
-                        distE='normal',
-                        energies=(energy_value, energy_bandwidth),
-                        polarization='horizontal',
-                        filamentBeam=False,
-                        uniformRayDensity=False,
-                        parameter_map={'center': {'x': 0, 'y': 0, 'z': 0},
-                                       'angles': {'pitch': 0, 'roll': 0,
-                                                  'yaw': 0}},
-                        transform_matrix=transform_NSLS2XRT['upward'])
-
-    # Add the M1 to beamline object bl
-    # TODO: This should be an elliptical mirror that focuses the beam.
-    m1 = ID29OE(bl=bl,
-                name='m1',
-                center=(0, 27850, 0),  # location (global XRT coords)
-                yaw=0, roll=0, pitch=np.radians(2),
-                material=gold,
-                limPhysX=[-60/2+10, 60/2+10], limOptX=[-15/2, 15/2],
-                limPhysY=[-400/2, 400/2], limOptY=[-240/2, 240/2],
-                shape='rect', upstream=source,
-                parameter_map={'center': {'x': (mirror1, 'x'),
-                                          'y': (mirror1, 'y'),
-                                          'z': 0},
-                               'angles': {'pitch': (mirror1, 'Ry'),
-                                          'roll': (mirror1, 'Rz'),
-                                          'yaw': 0}},
-                transform_matrix=transform_NSLS2XRT['inboard'])
-
-    # Add the M1 Baffle slit to beamline object bl
-    m1_baffles = ID29Aperture(bl=bl,
-                              name='m1_baffles',
-                              center=(0, 31094.5, 0),  # location (XRT coords)
-                              x='auto', z='auto',
-                              kind=['left', 'right', 'bottom', 'top'],
-                              opening=[-20 / 2, 20 / 2,
-                                       -20 / 2, 20 / 2],
-                              upstream=m1,
-                              parameter_map={
-                                  'opening': {'left': (mirror1.baffles,
-                                                       'outboard'),
-                                              'right': (mirror1.baffles,
-                                                        'inboard'),
-                                              'bottom': (mirror1.baffles,
-                                                         'bottom'),
-                                              'top': (mirror1.baffles, 'top')}},
-                              transform_matrix=transform_NSLS2XRT['upward'])
-
-    # Add one screen at M1 diagnostic to monitor the beam
-    # NOTE: the IOC needs to select the right region based on diag position
-    # and potentially energy filter based on if a multilayer is inserted.
-    m1_diag = ID29Screen(bl=bl,
-                         name='m1_diag',
-                         center=(0, 31340.6, 0),  # location (global XRT coords)
-                         x=np.array([1, 0, 0]),
-                         z=np.array([0, 0, 1]),
-                         upstream=m1_baffles,
-                         parameter_map={},
-                         transform_matrix=transform_NSLS2XRT['upward'])
-
-    # Add slit at M1 diagnostic to block beam when diagnostic unit is in
-    m1_diag_slit = ID29Aperture(bl=bl,
-                                name='m1_diag_slit',
-                                center=(0, 31340.7, 0),  # 0.1mm offset to diag
-                                x='auto', z='auto',
-                                kind=['left', 'right', 'bottom', 'top'],
-                                opening=[-50, 50, -50, 50],
-                                upstream=m1_baffles,
-                                parameter_map={
-                                    'opening': {'left': -50, 'right': 50,
-                                                'bottom': -50,
-                                                'top': (mirror1.diagnostic,
-                                                        'multi_trans')}},
-                                transform_matrix=transform_NSLS2XRT['upward'])
+            obj = getattr(self, item)
+            out[item] = obj.stats.summary(reset=reset)
+
+        return out
+
+    def parameters(self):
+        """
+        Return the current parameter values of every component.
+
+        Returns
+        -------
+        parameters : dict
+            A dictionary mapping the component names to the values vector of
+            their ParameterMap (see parameter_map.py). These can be passed to
+            self.apply_parameters, potentially in another process, to
+            evaluate the model without access to the objects referenced in the
+            components parameter_map.
+        """
+        values = self._parameters.split(self._parameters.read())
+
+        return {item: value.copy() for item, value in zip(self._order, values)}
+
+    def apply_parameters(self, parameters=None):
+        """
+        Pin the parameter values of the components.
+
+        While pinned, the components use the given values instead of reading
+        the objects referenced in their parameter_map. The values are applied
+        on the next call to self.activate.
+
+        Parameters
+        ----------
+        parameters : dict or None
+            A dictionary mapping component names to values vectors, as returned
+            by self.parameters. Components not included are un-pinned. None
+            (the default) un-pins all of the components.
+        """
+        parameters = {} if parameters is None else parameters
+        for item in self.components:
+            value = parameters.get(item)
+            getattr(self, item)._parameters.override = (
+                None if value is None else np.asarray(value, dtype=float))
+
+    def spec(self):
+        """
+        Return a picklable description of the configuration of the model.
+
+        This is used to build an equivalent model in the process pool workers
+        (see self.from_spec). It holds the constructor arguments, except
+        mirror1 (the workers pin the parameter values instead, see
+        self.apply_parameters) and the cache and ray_store (which the
+        workers do not use), and the current source settings that the rays
+        depend on, except nrays which is set for each call.
+
+        Returns
+        -------
+        spec : dict
+            A dictionary with the constructor keyword arguments ('config')
+            and the source attribute values ('source').
+        """
+        source = {attribute: copy.deepcopy(getattr(self.source, attribute))
+                  for attribute in _source_settings}
+
+        return {'config': dict(self._config), 'source': source}
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Build a new AriModel from the output of AriModel.spec.
+
+        Parameters
+        ----------
+        spec : dict
+            The output of AriModel.spec.
+
+        Returns
+        -------
+        model : AriModel
+            A model with the same configuration, using the default mirror1.
+        """
+        model = cls(**spec['config'])
+        for attribute, value in spec['source'].items():
+            setattr(model.source, attribute, copy.deepcopy(value))
+        model.activate(updated=True)
+
+        return model
+
+    def trace_parallel(self, nrays, chunk_size=None, max_workers=None,
+                       seed=None, reducers=None):
+        """
+        Trace a large number of rays by splitting them into parallel chunks.
+
+        The rays are split into chunks of chunk_size rays, each with an
+        independent seed spawned from seed. Each chunk is traced through the
+        full source -> m1 -> baffles -> diag chain, using the configuration
+        (see self.spec) and the current parameter values of this model, in a
+        pool of worker processes. As the
+        chunks and their seeds depend only on nrays, chunk_size and seed the
+        result does not depend on the number of workers. The state of this
+        model (including its beamOut attributes) is not modified.
+
+        Parameters
+        ----------
+        nrays : int
+            The total number of rays to trace.
+        chunk_size : int, optional
+            The number of rays in each chunk, the default is self.source.nrays.
+        max_workers : int, optional
+            The number of worker processes, the default is the number of CPUs.
+            The pool is kept between calls, use self.close to shut it down.
+        seed : int, optional
+            The seed used to generate the seed for each chunk. If None a
+            different set of rays is generated on every call.
+        reducers : dict, optional
+            A dictionary mapping output names to reducers (see reducers.py).
+            The reducer outputs from each chunk are summed. If None the
+            beamOut of each component from every chunk are concatenated.
+
+        Returns
+        -------
+        output : dict
+            A dictionary mapping the reducer names to their summed outputs, or
+            the component names to their merged beamOut if reducers is None.
+        """
+        chunk_size = int(chunk_size or self.source.nrays)
+        sizes = [chunk_size] * (nrays // chunk_size)
+        if nrays % chunk_size:
+            sizes.append(nrays % chunk_size)
+        seeds = [int(child.generate_state(1)[0]) for child in
+                 np.random.SeedSequence(seed).spawn(len(sizes))]
+
+        spec, parameters = self.spec(), self.parameters()
+        executor = self._get_executor(max_workers)
+        results = executor.map(_trace_chunk, [spec] * len(sizes),
+                               [parameters] * len(sizes), sizes, seeds,
+                               [reducers] * len(sizes))
+
+        output = None
+        for result in results:
+            if output is None:
+                output = result
+            elif reducers is None:
+                for item, beam in result.items():
+                    output[item].concatenate(beam)
+            else:
+                for name, value in result.items():
+                    output[name] = output[name] + value
+
+        return output
+
+    def trace_streaming(self, nrays, reducers, chunk_size=None, seed=None):
+        """
+        Trace a large number of rays in fixed-size chunks with bounded memory.
+
+        The rays are generated and pushed through the chain chunk_size rays
+        at a time. After each chunk only the reducer outputs are kept (summed
+        over the chunks) and the beams of every component are released before
+        the next chunk, so the peak memory depends on chunk_size and not on
+        nrays. The components cache (if any) is bypassed while streaming. The
+        chunks and their seeds are the same as those used by
+        self.trace_parallel, so the results of the two agree. The global numpy
+        random state is restored after each seeded chunk. Once finished the
+        components are re-traced with the original number of rays.
+
+        Parameters
+        ----------
+        nrays : int
+            The total number of rays to trace.
+        reducers : dict
+            A dictionary mapping output names to reducers (see reducers.py).
+        chunk_size : int, optional
+            The number of rays in each chunk, the default is self.source.nrays.
+        seed : int, optional
+            The seed used to generate the seed for each chunk. If None a
+            different set of rays is generated on every call.
+
+        Returns
+        -------
+        output : dict
+            A dictionary mapping the reducer names to their summed outputs.
+        """
+        original_nrays = self.source.nrays
+        chunk_size = int(chunk_size or original_nrays)
+        sizes = [chunk_size] * (nrays // chunk_size)
+        if nrays % chunk_size:
+            sizes.append(nrays % chunk_size)
+        seeds = [int(child.generate_state(1)[0]) for child in
+                 np.random.SeedSequence(seed).spawn(len(sizes))]
+
+        output = {}
+        with self.uncached():
+            try:
+                for size, chunk_seed in zip(sizes, seeds):
+                    self._release_beams()
+                    self.source.nrays = size
+                    with seeded_random_state(chunk_seed):
+                        self.activate(updated=True)
+                    for name, reducer in reducers.items():
+                        value = reducer(self)  # may be re-used, so copied
+                        output[name] = (np.array(value) if name not in output
+                                        else output[name] + value)
+            finally:
+                self._release_beams()
+                self.source.nrays = original_nrays
+        self.activate(updated=True)
+
+        return output
+
+    @contextmanager
+    def uncached(self):
+        """
+        A context manager that bypasses the components cache while active.
+
+        This is used whenever the components are re-traced with new rays for
+        the same parameters (i.e. when streaming or refining a result), which
+        would otherwise return the cached beams (or the stored source rays).
+        """
+        ray_store = self.source.ray_store
+        self.source.ray_store = None
+        for item in self.components:
+            getattr(self, item).cache = None
+        try:
+            yield self
+        finally:
+            self.source.ray_store = ray_store
+            for item in self.components:
+                getattr(self, item).cache = self.cache
+
+    def _release_beams(self):
+        """
+        Release the Beam objects held by all of the components.
+
+        This includes the beams kept by the components to skip work on the
+        next activation, the compacted input beam (obj._compacted, see
+        custom_devices._get_beam_in) and the aperture plane hits
+        (obj._hits, see ID29Aperture._propagate), as these also hold the
+        full input beams.
+        """
+        for item in self.components:
+            obj = getattr(self, item)
+            for attribute in ('beamIn', 'beamOut', 'beamOutloc',
+                              '_compacted', '_hits'):
+                if hasattr(obj, attribute):
+                    setattr(obj, attribute, None)
+
+    def scan(self, axes, reducers, grid=True, max_workers=0, seed=None):
+        """
+        Evaluate the model for many parameter sets in one call.
+
+        Each parameter set is given by the values of the input objects (i.e.
+        the TestM1 attributes) referenced by the components parameter_map.
+        For each set the input attributes are set, the resulting component
+        parameters are recorded and the attributes are restored, so no ray
+        tracing is done while the sets are built. The sets are then sorted so
+        that those sharing the parameters of the upstream components are
+        adjacent, which means only the components whose parameters differ
+        from the previous set (and those downstream) are re-traced. The sets
+        are evaluated using a model with the same configuration (see
+        self.spec) and number of source rays as this one, either in this
+        process (kept for later scans with the same configuration) or split
+        into contiguous blocks evaluated in parallel in a pool of worker
+        processes. Either way this model, including its beams, is left
+        unchanged.
+
+        Parameters
+        ----------
+        axes : dict
+            A dictionary mapping (object, attribute name) tuples to 1D
+            arrays of values, i.e.
+            {(model.mirror1, 'Ry_fine'): np.linspace(-1E-3, 1E-3, 200),
+             (model.mirror1.baffles, 'top'): np.linspace(0, 20, 20)}.
+        reducers : dict
+            A dictionary mapping output names to reducers (see reducers.py)
+            that return the values to record at each parameter set.
+        grid : Boolean
+            If True (the default) every combination of the axes values is
+            evaluated, otherwise the axes must all have the same length and
+            are evaluated point by point.
+        max_workers : int
+            The number of worker processes to use, 0 (the default) evaluates
+            the sets in this process and None uses the number of CPUs.
+        seed : int, optional
+            If not None, the random state is seeded with this value before
+            each set is traced, so that the results do not depend on the
+            number of workers. If None the rays differ between calls.
+
+        Returns
+        -------
+        output : dict
+            A dictionary mapping the reducer names to arrays of their outputs
+            stacked with a shape of (len(axis0), len(axis1), ...) +
+            output shape if grid is True or (npoints,) + output shape if not.
+        """
+        keys = list(axes.keys())
+        values = [np.asarray(axes[key]) for key in keys]
+        if grid:
+            shape = tuple(len(value) for value in values)
+            mesh = np.meshgrid(*values, indexing='ij')
+            points = np.stack([axis.ravel() for axis in mesh], axis=-1)
+        else:
+            if len({len(value) for value in values}) > 1:
+                raise ValueError(f'With grid=False all axes must have the '
+                                 f'same length, got {[len(value) for value in values]}')
+            shape = (len(values[0]),)
+            points = np.stack(values, axis=-1)
+
+        # Find the component parameters for each point.
+        originals = [getattr(obj, attribute) for obj, attribute in keys]
+        snapshots = np.empty((len(points), len(self._parameters.read())))
+        try:
+            for i, point in enumerate(points):
+                for (obj, attribute), value in zip(keys, point):
+                    setattr(obj, attribute, value.item())
+                snapshots[i] = self._parameters.read()
+        finally:
+            for (obj, attribute), value in zip(keys, originals):
+                setattr(obj, attribute, value)
+
+        # Sort so points sharing upstream parameters are adjacent.
+        order = np.lexsort(snapshots.T[::-1])
+        ordered = [dict(zip(self._order, self._parameters.split(snapshot)))
+                   for snapshot in snapshots[order]]
+
+        spec = self.spec()
+        if max_workers == 0:
+            results = _scan_points(self._get_scan_model(spec), ordered,
+                                   reducers, seed, nrays=self.source.nrays)
+        else:
+            executor = self._get_executor(max_workers)
+            blocks = np.array_split(np.arange(len(ordered)),
+                                    min(len(ordered),
+                                        4 * self._executor_workers))
+            futures = [executor.submit(_scan_points, None,
+                                       [ordered[i] for i in block],
+                                       reducers, seed, spec,
+                                       self.source.nrays)
+                       for block in blocks if len(block)]
+            results = [result for future in futures
+                       for result in future.result()]
+
+        output = {}
+        for name in reducers:
+            stacked = np.stack([result[name] for result in results])
+            unsorted = np.empty_like(stacked)
+            unsorted[order] = stacked
+            output[name] = unsorted.reshape(shape + stacked.shape[1:])
+
+        return output
+
+    def _get_scan_model(self, spec):
+        """
+        Return the model used by self.scan to evaluate sets in this process.
+
+        Like the process pool workers (see _get_worker_model) the model is
+        built from spec on the first call, and re-built if the spec changes,
+        so the scan does not change the beams of this model.
+        """
+        key = pickle.dumps(spec)
+        scan_model = getattr(self, '_scan_model', None)
+        if scan_model is None or scan_model[0] != key:
+            scan_model = self._scan_model = (key, AriModel.from_spec(spec))
+
+        return scan_model[1]
+
+    def _get_executor(self, max_workers=None):
+        """
+        Return the process pool used by self.trace_parallel.
+
+        The pool is created on the first call, and re-created if max_workers
+        differs from the pool that already exists.
+        """
+        executor = getattr(self, '_executor', None)
+        if executor is not None and max_workers not in (
+                None, self._executor_workers):
+            self.close()
+            executor = None
+        if executor is None:
+            max_workers = max_workers or os.cpu_count() or 1
+            self._executor = ProcessPoolExecutor(max_workers=max_workers)
+            self._executor_workers = max_workers
+
+        return self._executor
+
+    def close(self):
+        """
+        Shut down the process pool used by self.trace_parallel (if any).
+
+        The model used by self.scan in this process (if any) is also released.
+        """
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown()
+            self._executor = None
+        self._scan_model = None
+
+    def _build_components(self):
+        """
+        Build the XRT BeamLine and the beamline components.
+
+        The components reference the attributes of self.mirror1 in their
+        parameter_map, so each AriModel instance has its own components.
+        """
+        # Initialize the beamline object
+        self.bl = xrt_raycing.BeamLine(azimuth=0.0, height=0.0, alignE=0)
+        self.energy_value = 850.0  # default energy in eV.
+        self.energy_bandwidth = 5.0  # default energy width in eV.
+        mirror1 = self.mirror1
+        m1_material = materials()['gold']
+        if self.reflectivity_table is not None:  # use tabulated amplitudes
+            kwargs = {'energy_range': (
+                self.energy_value - 6 * self.energy_bandwidth,
+                self.energy_value + 6 * self.energy_bandwidth)}
+            kwargs.update(self.reflectivity_table)
+            m1_material = TabulatedMaterial(m1_material, **kwargs)
+
+        # Add the source to beamline object bl
+        # TODO: Consider a toroidal (donut) source profile.
+        self.source = ID29Source(
+            bl=self.bl,
+            name='source',
+            center=(0, 0, 0),  # location (global XRT coords)
+            nrays=10000,
+            distx='normal', dx=0.30,  # source linear profile
+            disty=None, dy=0,
+            distz='normal', dz=0.001,
+            distxprime='normal', dxprime=0.1,  # angular profile
+            distzprime='normal', dzprime=0.1,
+            # source energy profile below
+            distE='normal',
+            energies=(self.energy_value, self.energy_bandwidth),
+            polarization='horizontal',
+            filamentBeam=False,
+            uniformRayDensity=False,
+            parameter_map={'center': {'x': 0, 'y': 0, 'z': 0},
+                           'angles': {'pitch': 0, 'roll': 0, 'yaw': 0}},
+            transform_matrix=transform_NSLS2XRT['upward'])
+
+        # Add the M1 to beamline object bl
+        # TODO: This should be an elliptical mirror that focuses the beam.
+        self.m1 = ID29OE(
+            bl=self.bl,
+            name='m1',
+            center=(0, 27850, 0),  # location (global XRT coords)
+            yaw=0, roll=0, pitch=np.radians(2),
+            material=m1_material,
+            limPhysX=[-60/2+10, 60/2+10], limOptX=[-15/2, 15/2],
+            limPhysY=[-400/2, 400/2], limOptY=[-240/2, 240/2],
+            shape='rect', upstream=self.source,
+            parameter_map={'center': {'x': (mirror1, 'x'),
+                                      'y': (mirror1, 'y'),
+                                      'z': 0},
+                           'angles': {'pitch': (mirror1, 'Ry'),
+                                      'roll': (mirror1, 'Rz'),
+                                      'yaw': 0}},
+            transform_matrix=transform_NSLS2XRT['inboard'])
+
+        # Add the M1 Baffle slit to beamline object bl
+        self.m1_baffles = ID29Aperture(
+            bl=self.bl,
+            name='m1_baffles',
+            center=(0, 31094.5, 0),  # location (XRT coords)
+            x='auto', z='auto',
+            kind=['left', 'right', 'bottom', 'top'],
+            opening=[-20 / 2, 20 / 2, -20 / 2, 20 / 2],
+            upstream=self.m1,
+            parameter_map={
+                'opening': {'left': (mirror1.baffles, 'outboard'),
+                            'right': (mirror1.baffles, 'inboard'),
+                            'bottom': (mirror1.baffles, 'bottom'),
+                            'top': (mirror1.baffles, 'top')}},
+            transform_matrix=transform_NSLS2XRT['upward'])
+
+        # Add one screen at M1 diagnostic to monitor the beam
+        # NOTE: the IOC needs to select the right region based on diag position
+        # and potentially energy filter based on if a multilayer is inserted.
+        self.m1_diag = ID29Screen(
+            bl=self.bl,
+            name='m1_diag',
+            center=(0, 31340.6, 0),  # location (global XRT coords)
+            x=np.array([1, 0, 0]),
+            z=np.array([0, 0, 1]),
+            upstream=self.m1_baffles,
+            parameter_map={},
+            transform_matrix=transform_NSLS2XRT['upward'])
+
+        # Add slit at M1 diagnostic to block beam when diagnostic unit is in
+        self.m1_diag_slit = ID29Aperture(
+            bl=self.bl,
+            name='m1_diag_slit',
+            center=(0, 31340.7, 0),  # 0.1mm offset to diag
+            x='auto', z='auto',
+            kind=['left', 'right', 'bottom', 'top'],
+            opening=[-50, 50, -50, 50],
+            upstream=self.m1_baffles,
+            parameter_map={
+                'opening': {'left': -50, 'right': 50, 'bottom': -50,
+                            'top': (mirror1.diagnostic, 'multi_trans')}},
+            transform_matrix=transform_NSLS2XRT['upward'])
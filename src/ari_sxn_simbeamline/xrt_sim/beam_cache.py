@@ -0,0 +1,207 @@
+from collections import OrderedDict
+import numpy as np
+
+
+def _beam_arrays(result):
+    """
+    Return the numpy arrays held by one or more Beam objects, keyed by id.
+
+    Views are replaced by the array that owns their memory, so arrays that
+    share memory (e.g. the beams re-masked on the aperture fast path, see
+    custom_devices.py) appear only once.
+
+    Parameters
+    ----------
+    result : Beam object or tuple of Beam objects.
+        The output of one of the XRT shine, reflect, propagate or expose
+        methods.
+
+    Returns
+    -------
+    arrays : dict
+        A {id(array): array} dictionary of the arrays owning the memory.
+    """
+    beams = result if isinstance(result, (tuple, list)) else (result,)
+    arrays = {}
+    for beam in beams:
+        for value in getattr(beam, '__dict__', {}).values():
+            if isinstance(value, np.ndarray):
+                if isinstance(value.base, np.ndarray):
+                    value = value.base
+                arrays[id(value)] = value
+
+    return arrays
+
+
+def beam_nbytes(result):
+    """
+    Return the number of bytes held in the arrays of one or more Beam objects.
+
+    Arrays shared between the Beam objects, or views of the same array, are
+    only counted once.
+
+    Parameters
+    ----------
+    result : Beam object or tuple of Beam objects.
+        The output of one of the XRT shine, reflect, propagate or expose
+        methods.
+
+    Returns
+    -------
+    nbytes : int
+        The total size, in bytes, of all of the numpy arrays held by the Beam
+        object(s).
+    """
+    return sum(array.nbytes for array in _beam_arrays(result).values())
+
+
+class BeamCache:
+    """
+    A least-recently-used cache of beamline component outputs.
+
+    This is used by the ID29* components (see custom_devices.py) to store the
+    output of their shine, reflect, propagate or expose method calls, keyed on
+    the resolved parameters of the component and of all of the components
+    upstream of it. When a scan returns to a previously visited set of motor
+    positions the stored beamOut (and beamOutloc) is returned instead of
+    re-tracing the rays. Entries are evicted, least recently used first, once
+    the total size of the stored arrays exceeds max_bytes. Arrays shared by
+    several entries are only counted once, and only stop counting towards
+    the total when the last entry holding them is removed.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The memory budget, in bytes, for the arrays held by the cache. The
+        default is 512 MB.
+
+    Attributes
+    ----------
+    hits : int
+        The number of self.get calls that found a stored result.
+    misses : int
+        The number of self.get calls that did not find a stored result.
+    evictions : int
+        The number of entries removed to keep within max_bytes.
+    nbytes : int
+        The total size, in bytes, of the arrays currently held by the cache.
+
+    Methods
+    -------
+    get(key) :
+        Return the stored result for key, or None if there isn't one.
+    put(key, result) :
+        Store a result, evicting the least recently used entries as required.
+    clear() :
+        Remove all of the stored results (the counters are not reset).
+    stats() :
+        Return a dictionary with the cache counters.
+    """
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()  # key: (result, array ids)
+        self._arrays = {}  # id(array): [array, number of entries holding it]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Return the stored result for key, or None if there isn't one.
+
+        Parameters
+        ----------
+        key : hashable
+            The key the result was stored under.
+
+        Returns
+        -------
+        result : Beam object, tuple of Beam objects or None.
+            The stored result.
+        """
+        try:
+            result, _ = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return result
+
+    def put(self, key, result):
+        """
+        Store a result, evicting the least recently used entries as required.
+
+        Results larger than max_bytes are not stored.
+
+        Parameters
+        ----------
+        key : hashable
+            The key to store the result under.
+        result : Beam object or tuple of Beam objects.
+            The result to store.
+        """
+        arrays = _beam_arrays(result)
+        if key in self._entries:
+            self._remove(key)
+        if sum(array.nbytes for array in arrays.values()) > self.max_bytes:
+            return
+
+        for array_id, array in arrays.items():
+            if array_id in self._arrays:
+                self._arrays[array_id][1] += 1
+            else:
+                self._arrays[array_id] = [array, 1]
+                self.nbytes += array.nbytes
+        self._entries[key] = (result, tuple(arrays))
+
+        while self.nbytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        """
+        Remove the entry for key, releasing the arrays no other entry holds.
+
+        Parameters
+        ----------
+        key : hashable
+            The key of the entry to remove.
+        """
+        _, array_ids = self._entries.pop(key)
+        for array_id in array_ids:
+            held = self._arrays[array_id]
+            held[1] -= 1
+            if not held[1]:
+                del self._arrays[array_id]
+                self.nbytes -= held[0].nbytes
+
+    def clear(self):
+        """
+        Remove all of the stored results (the counters are not reset).
+        """
+        self._entries.clear()
+        self._arrays.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Return a dictionary with the cache counters.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary with the 'hits', 'misses', 'evictions', 'entries',
+            'nbytes' and 'max_bytes' values for the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._entries),
+                'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
@@ -0,0 +1,245 @@
+import numpy as np
+
+
+class BeamBinner:
+    """
+    A fast histogram engine for binning Beam objects on uniform grids.
+
+    This replaces np.histogramdd for the common case of binning beam
+    attributes (i.e. x, z and E) on uniform grids. Rather than stacking the
+    attributes into an (N, D) array the integer bin index along each axis is
+    computed directly from each attribute (and corrected against the bin
+    edges, so that values on an edge go in the same bin as for
+    np.histogramdd), combined into a single flat index and added to the
+    histogram with np.bincount. The scratch arrays used for this, and the
+    bin edges for axes with a fixed range, are kept between calls, and when
+    an out array is given the counts are added to it in place with
+    np.add.at, so repeated calls with out (i.e. for each camera frame)
+    allocate no histogram sized arrays. Values equal to the upper edge of
+    the range are included in the last bin and values outside of the range
+    are ignored, as for np.histogramdd. As the scratch arrays are shared
+    between calls an instance must not be used by several threads at once.
+
+    Parameters
+    ----------
+    bins : tuple of int
+        The number of bins along each axis, i.e. (100, 100, 100).
+    output_range : tuple
+        The (min, max) range along each axis, with min < max, or None for an
+        axis whose range is set from the data on each call (i.e. ((-10, 10),
+        (-10, 10), None)).
+    fields : tuple of str
+        The Beam attributes to bin along each axis, i.e. ('x', 'z', 'E') (by
+        default).
+
+    Methods
+    -------
+    ranges(beam) :
+        Return the (min, max) range used along each axis for beam.
+    coords(ranges) :
+        Return the lower bin edges along each axis.
+    bin(beam, weights=None, mask=None, out=None) :
+        Return (or accumulate into out) the histogram of beam.
+    to_xarray(beam, weights=None, mask=None) :
+        Return the histogram of beam as an xarray.DataArray.
+    """
+    def __init__(self, bins, output_range, fields=('x', 'z', 'E')):
+        if not (len(bins) == len(output_range) == len(fields)):
+            raise ValueError(f'bins {bins}, output_range {output_range} and '
+                             f'fields {fields} must have the same length')
+        for field, field_range in zip(fields, output_range):
+            if field_range is not None and not (
+                    float(field_range[0]) < float(field_range[1])):
+                raise ValueError(f'The output_range {field_range} of '
+                                 f'{field} must have min < max')
+        self.bins = tuple(int(nbins) for nbins in bins)
+        self.output_range = tuple(output_range)
+        self.fields = tuple(fields)
+        self.shape = self.bins
+        self._strides = np.cumprod((1,) + self.bins[:0:-1])[::-1]
+        self._edges = {}  # ranges: bin edges, for re-use between calls
+        self._scratch = None  # the per-ray scratch arrays, see self._arrays
+
+    def ranges(self, beam, mask=None):
+        """
+        Return the (min, max) range used along each axis for beam.
+
+        Parameters
+        ----------
+        beam : Beam object
+            The beam to be binned.
+        mask : np.array, optional
+            A boolean array selecting the rays to be binned.
+
+        Returns
+        -------
+        ranges : tuple
+            The (min, max) range for each axis, for axes with a range of None
+            these are taken from the data (widened by 0.5 either side if the
+            data has no spread, as for np.histogramdd).
+        """
+        ranges = []
+        for field, output_range in zip(self.fields, self.output_range):
+            if output_range is None:
+                values = getattr(beam, field)
+                values = values if mask is None else values[mask]
+                if values.size:
+                    low, high = float(values.min()), float(values.max())
+                else:
+                    low, high = 0.0, 1.0
+                if low == high:
+                    low, high = low - 0.5, high + 0.5
+                output_range = (low, high)
+            ranges.append((float(output_range[0]), float(output_range[1])))
+
+        return tuple(ranges)
+
+    def coords(self, ranges):
+        """
+        Return the lower bin edges along each axis.
+
+        Parameters
+        ----------
+        ranges : tuple
+            The (min, max) range for each axis, as returned by self.ranges.
+
+        Returns
+        -------
+        coords : list
+            A list with a 1D array of the lower bin edges for each axis.
+        """
+        return [edges[:-1] for edges, _, _ in self._bounds(ranges)]
+
+    def _bounds(self, ranges):
+        """
+        Return the bin edges, lower bounds and upper bounds along each axis.
+
+        The lower (upper) bounds are the lower (upper) edges of each bin with
+        the first (last) replaced by -inf (inf), so that a value on the outer
+        edges is never moved to a neighbouring bin by self.bin.
+        """
+        if ranges not in self._edges:
+            if len(self._edges) > 16:  # only keep recently used ranges
+                self._edges.clear()
+            self._edges[ranges] = []
+            for (low, high), nbins in zip(ranges, self.bins):
+                edges = np.linspace(low, high, nbins + 1)
+                lower, upper = edges[:-1].copy(), edges[1:].copy()
+                lower[0], upper[-1] = -np.inf, np.inf
+                self._edges[ranges].append((edges, lower, upper))
+
+        return self._edges[ranges]
+
+    def _arrays(self, nrays):
+        """
+        Return the per-ray scratch arrays, re-allocated if nrays changes.
+
+        Returns
+        -------
+        scratch, index, flat, valid, test : np.array
+            The float, bin index, flat index, valid ray and comparison arrays
+            of length nrays.
+        """
+        if self._scratch is None or len(self._scratch[0]) != nrays:
+            self._scratch = (np.empty(nrays), np.empty(nrays, dtype=np.intp),
+                             np.empty(nrays, dtype=np.intp),
+                             np.empty(nrays, dtype=bool),
+                             np.empty(nrays, dtype=bool))
+
+        return self._scratch
+
+    def bin(self, beam, weights=None, mask=None, out=None, ranges=None):
+        """
+        Return (or accumulate into out) the histogram of beam.
+
+        Parameters
+        ----------
+        beam : Beam object
+            The beam to be binned.
+        weights : np.array, optional
+            A weight for each ray, i.e. its intensity. If None the rays are
+            counted.
+        mask : np.array, optional
+            A boolean array selecting the rays to be binned.
+        out : np.array, optional
+            A contiguous float array of shape self.shape to add the histogram
+            to in place.
+        ranges : tuple, optional
+            The (min, max) range for each axis, the default is
+            self.ranges(beam, mask).
+
+        Returns
+        -------
+        histogram : np.array
+            An array of shape self.shape with the (weighted) counts in each
+            bin, this is out if it was given.
+        """
+        ranges = self.ranges(beam, mask) if ranges is None else ranges
+        nrays = len(getattr(beam, self.fields[0]))
+        scratch, index, flat, valid, test = self._arrays(nrays)
+
+        flat[:] = 0
+        valid[:] = True if mask is None else mask
+        for field, (low, high), nbins, stride, (_, lower, upper) in zip(
+                self.fields, ranges, self.bins, self._strides,
+                self._bounds(ranges)):
+            values = getattr(beam, field)
+            valid &= np.greater_equal(values, low, out=test)
+            valid &= np.less_equal(values, high, out=test)
+            np.subtract(values, low, out=scratch)
+            np.multiply(scratch, nbins / (high - low), out=scratch)
+            # (fmax and fmin also replace NaN, and the cast truncates the
+            # remaining non-negative values, which is the floor)
+            np.fmax(scratch, 0, out=scratch)
+            np.fmin(scratch, nbins - 1, out=scratch)  # include upper edge
+            np.copyto(index, scratch, casting='unsafe')
+            # The rounding of the scaled values can put a value on (or next
+            # to) an edge in the neighbouring bin, so compare with the edges
+            # (the invalid rays are ignored).
+            np.take(lower, index, out=scratch, mode='clip')
+            index -= np.less(values, scratch, out=test)
+            np.take(upper, index, out=scratch, mode='clip')
+            index += np.greater_equal(values, scratch, out=test)
+            index *= stride
+            flat += index
+
+        index = flat[valid]
+        weights = None if weights is None else weights[valid]
+        if out is None:  # a new histogram, allocated by np.bincount
+            counts = np.bincount(index, weights=weights,
+                                 minlength=int(np.prod(self.bins)))
+            return counts.astype(float, copy=False).reshape(self.bins)
+        if not out.flags.c_contiguous:
+            raise ValueError('out must be a C contiguous array')
+        np.add.at(out.reshape(-1), index, 1 if weights is None else weights)
+
+        return out
+
+    def to_xarray(self, beam, weights=None, mask=None):
+        """
+        Return the histogram of beam as an xarray.DataArray.
+
+        Parameters
+        ----------
+        beam : Beam object
+            The beam to be binned.
+        weights : np.array, optional
+            A weight for each ray, i.e. its intensity. If None the rays are
+            counted.
+        mask : np.array, optional
+            A boolean array selecting the rays to be binned.
+
+        Returns
+        -------
+        beam_array : xarray.DataArray
+            The histogram with the lower bin edges as the coordinates of each
+            dimension, the dimensions are named after self.fields.
+        """
+        import xarray as xr
+
+        ranges = self.ranges(beam, mask)
+        data = self.bin(beam, weights=weights, mask=mask, ranges=ranges)
+        coords = self.coords(ranges)
+
+        return xr.DataArray(data, dims=list(self.fields),
+                            coords=dict(zip(self.fields, coords)))
@@ -1,6 +1,17 @@
+from beam_cache import beam_nbytes
+from contextlib import contextmanager
+import copy
+import inspect
+from instrumentation import ActivationStats
 import numpy as np
+from parameter_map import ParameterMap
 import random
+from reflectivity import TabulatedMaterial
+import time
+import warnings
+import xrt.backends.raycing as raycing
 import xrt.backends.raycing.sources as xrt_source
+import xrt.backends.raycing.sources_beams as xrt_beam
 import xrt.backends.raycing.apertures as xrt_aperture
 import xrt.backends.raycing.screens as xrt_screen
 import xrt.backends.raycing.oes as xrt_oes
@@ -102,6 +113,10 @@ transform_NSLS2XRT = {'inboard': np.array([[0, -1.0, 0], [0, 0, 1.0],
                       'upward': np.array([[-1.0, 0, 0], [0, 0, 1.0],
                                           [0, 1.0, 0]])}
 
+# The column of the quasi-random points used by ID29Source for each Beam axis
+# (a and c are x' and z'), fixed so that each axis always gets the same one.
+qmc_columns = {'y': 0, 'x': 1, 'z': 2, 'a': 3, 'c': 4, 'E': 5}
+
 
 def _update_parameters(obj, updated=False):
     """
@@ -109,6 +124,9 @@ def _update_parameters(obj, updated=False):
 
     Used in most of the custom XRT components below to update the parameters
     in the model based on the links in the objects parameter_map dictionary.
+    The parameter_map is compiled into a ParameterMap (obj._parameters) when
+    the object is created, so finding out that nothing has changed only costs
+    reading the linked values and a single array comparison.
 
     Parameters
     ----------
@@ -125,61 +143,243 @@ def _update_parameters(obj, updated=False):
         indicates a re-activation required.
 
     """
-    for parameter, origin in obj._parameter_map.items():
-        if parameter == 'center':
-            origin = np.dot(obj._transform_matrix, origin)
-            origin[1] += obj._y_offset
-            origin = tuple(origin)
-            current = getattr(obj, 'center')
-            if origin != current:
-                updated = True
-                setattr(obj, 'center', origin)
-        elif parameter == 'angles':
-            current = tuple([getattr(obj, angle)
-                             for angle in ['pitch', 'roll', 'yaw']])
-            if origin != current:
-                updated = True
-                for i, angle in enumerate(['pitch', 'roll', 'yaw']):
-                    setattr(obj, angle, origin[i])
-        else:
-            if getattr(obj, parameter) != origin:
-                updated = True
-                setattr(obj, parameter, origin)
+    if obj._parameters.apply(obj, obj._parameters.read()):
+        updated = True
 
     return updated
 
 
-def _parse_parameter_map(default_map):
+def _material_key(material):
+    """
+    Return a hashable key describing an XRT material (or None).
+
+    A TabulatedMaterial is described by the hash of the material and its table
+    settings (see TabulatedMaterial._key), any other material by its class and
+    the attributes that set its optical constants.
+    """
+    if material is None:
+        return None
+    if isinstance(material, TabulatedMaterial):
+        return ('TabulatedMaterial', material._key())
+
+    elements = tuple((getattr(element, 'name', None),
+                      getattr(element, 'table', None))
+                     for element in getattr(material, 'elements', ()))
+    return (type(material).__name__, getattr(material, 'name', None),
+            getattr(material, 'kind', None), getattr(material, 'rho', None),
+            getattr(material, 't', None),
+            tuple(getattr(material, 'quantities', ())), elements)
+
+
+def _config_key(obj):
     """
-    A method that parses the default parameter map into a parameter map.
+    Return the configuration of a custom XRT component as a hashable tuple.
+
+    These are the settings, not included in the parameter_map, that the output
+    of the components ray tracing method depends on: the compaction of the
+    input beam (compact and compact_dtype), the material (and reflectivity
+    table) and, for sources, the seed and the sampling mode.
+    """
+    dtype = getattr(obj, 'compact_dtype', None)
+    return (type(obj).__name__, bool(getattr(obj, 'compact', False)),
+            None if dtype is None else np.dtype(dtype).str,
+            _material_key(getattr(obj, 'material', None)),
+            getattr(obj, 'seed', None), getattr(obj, 'sampling', None))
+
+
+def _run_cached(obj, method, *args, extra=()):
+    """
+    Run one of the XRT ray tracing methods, re-using a cached result if found.
+
+    Used in the custom XRT components below to wrap the call to shine, reflect,
+    propagate or expose inside their activate methods. The components state
+    key, built from its name, its configuration (see _config_key), its
+    resolved parameter_map values, any extra values and the state key of its
+    upstream component, is stored as obj._state_key. If obj.cache is not None
+    the result is looked up in (or added to) the cache using this key.
 
     Parameters
     ----------
-    default_map : dict
-        The default parameter map to parse
-    """
-    out = {}
-    for key, value in default_map.items():
-        if type(value) is dict:  # value is a dictionary
-            temp_out = []
-            for axis, val in value.items():
-                if type(val) is float or type(val) is int:
-                    temp_out.append(val)
-                elif type(val) in [list, tuple] and len(val) == 2:
-                    temp_out.append(getattr(val[0], val[1]))
-                else:
-                    raise ValueError(f'Invalid value for {key} in '
-                                     f'{default_map}')
-            out[key] = tuple(temp_out)
-        elif type(value) is float or type(value) is int:
-            out[key] = value
-        elif type(value) in [list, tuple] and len(value) == 2:
-            out[key] = getattr(value[0], value[1])
-        else:
-            raise ValueError(f'Invalid value for {key} in '
-                             f'{default_map}')
+    obj : object
+        The custom XRT object whose method is to be run.
+    method : callable
+        The XRT method to run (e.g. obj.reflect).
+    *args : arguments
+        The arguments passed to method.
+    extra : tuple
+        Any extra (hashable) values, not included in the parameter_map, that
+        the result depends on.
+
+    Returns
+    -------
+    result : Beam object or tuple of Beam objects.
+        The output of method, either newly calculated or from the cache.
+    """
+    upstream = getattr(obj, '_upstream', None)
+    obj._state_key = (obj.name, _config_key(obj),
+                      obj._parameters.last.tobytes(), extra,
+                      getattr(upstream, '_state_key', None))
+
+    obj._cache_hit = False
+    if obj.cache is None:
+        return method(*args)
+
+    result = obj.cache.get(obj._state_key)
+    if result is None:
+        result = method(*args)
+        obj.cache.put(obj._state_key, result)
+    else:
+        obj._cache_hit = True
+
+    return result
+
+
+@contextmanager
+def seeded_random_state(seed):
+    """
+    A context manager that seeds the global numpy random state while active.
+
+    XRT samples the source rays from the global numpy random state, so this is
+    seeded to make the rays reproducible. The previous state is restored on
+    exit, so the random numbers drawn by the caller are not affected. If seed
+    is None the random state is left untouched.
+
+    Parameters
+    ----------
+    seed : int or None
+        The seed passed to np.random.seed.
+    """
+    if seed is None:
+        yield
+        return
+
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def _good_rays(beam):
+    """
+    Return the number of good rays (state 1 or 2) in a Beam object.
+    """
+    if beam is None:
+        return 0
+
+    return int(np.count_nonzero((beam.state == 1) | (beam.state == 2)))
+
+
+def _record_activation(obj, start, updated):
+    """
+    Record an activation of a custom XRT component in obj.stats.
+
+    Used at the end of the activate methods of the custom XRT components
+    below. The wall time since start, the good rays in beamIn and beamOut
+    and the bytes allocated for the output beam(s) (0 for a cache hit) are
+    recorded, or just a skipped entry if the component was not re-traced.
+
+    Parameters
+    ----------
+    obj : object
+        The custom XRT object that was activated.
+    start : float
+        The time.perf_counter() value at the start of the activation.
+    updated : Boolean
+        True if the component was re-traced.
+    """
+    elapsed = time.perf_counter() - start
+    if not updated:
+        obj.stats.record(elapsed, skipped=True)
+        return
+
+    outputs = [getattr(obj, name) for name in ('beamOut', 'beamOutloc')
+               if getattr(obj, name, None) is not None]
+    nbytes = 0 if obj._cache_hit else beam_nbytes(outputs)
+    rays_in = _good_rays(getattr(obj, 'beamIn', None))
+    obj.stats.record(elapsed, rays_in=rays_in,
+                     rays_out=_good_rays(obj.beamOut), nbytes=nbytes)
+
+
+def compact_beam(beam, dtype=None):
+    """
+    Return a copy of a Beam object holding only the rays still propagating.
+
+    The rays with state > 0 (i.e. not absorbed or lost) are copied into new
+    contiguous arrays, optionally converting the floating point arrays to a
+    smaller dtype (complex arrays are converted to the matching complex
+    dtype). Downstream propagate/expose/reflect calls then only process the
+    rays that can still reach them.
+
+    Parameters
+    ----------
+    beam : Beam object
+        The beam to compact, it is not modified.
+    dtype : numpy dtype, optional
+        If not None (the default) the floating point arrays are stored with
+        this dtype, i.e. np.float32.
+
+    Returns
+    -------
+    compacted : Beam object
+        The compacted beam.
+    ratio : float
+        The fraction of the rays that were kept.
+    """
+    keep = beam.state > 0
+    nrays = len(beam.state)
+    compacted = xrt_beam.Beam.__new__(xrt_beam.Beam)
+    for attribute, value in vars(beam).items():
+        if isinstance(value, np.ndarray) and value.shape[:1] == (nrays,):
+            value = value[keep]
+            if dtype is not None and value.dtype.kind == 'f':
+                value = value.astype(dtype)
+            elif dtype is not None and value.dtype.kind == 'c':
+                value = value.astype(np.result_type(dtype, np.complex64))
+        setattr(compacted, attribute, value)
+
+    return compacted, (float(keep.sum()) / nrays if nrays else 1.0)
+
+
+def _get_beam_in(obj):
+    """
+    Return the input beam for a component from its upstream component.
+
+    Used in the custom XRT components below, if obj.compact is True the
+    upstream beamOut is compacted (see compact_beam) and the fraction of rays
+    kept is stored in obj.rays_kept_ratio. The compacted beam is kept, with
+    the mask of the rays it holds, in obj._compacted and re-used while the
+    upstream beamOut object, its mask and compact_dtype are unchanged (i.e.
+    when only the parameters of obj have changed).
+
+    Parameters
+    ----------
+    obj : object
+        The custom XRT object whose input beam is required.
+
+    Returns
+    -------
+    beamIn : Beam object
+        The (potentially compacted) upstream beamOut.
+    """
+    beam = getattr(obj._upstream, 'beamOut')
+    if not obj.compact:
+        obj._compacted = None
+        obj.rays_kept_ratio = 1.0
+        return beam
 
-    return out
+    keep = beam.state > 0
+    cached = getattr(obj, '_compacted', None)
+    if (cached is None or cached[0] is not beam or
+            cached[1] != obj.compact_dtype or
+            not np.array_equal(cached[2], keep)):
+        compacted, ratio = compact_beam(beam, obj.compact_dtype)
+        cached = obj._compacted = (beam, obj.compact_dtype, keep, compacted,
+                                   ratio)
+    obj.rays_kept_ratio = cached[4]
+
+    return cached[3]
 
 
 class ID29Source(xrt_source.GeometricSource):
@@ -228,6 +428,39 @@ class ID29Source(xrt_source.GeometricSource):
         4.  The three 'angles' Rx, Ry and Rz should be provided as a 3 element
             list (called 'angles' as is done for 'center', with the default
             value, as a float of int, used for any non settable angles.
+    cache : BeamCache, optional
+        A beam_cache.BeamCache instance used to store and re-use the output of
+        activate for previously seen parameter values (see _run_cached). The
+        default, None, disables caching.
+    ray_store : RayStore, optional
+        A ray_store.RayStore instance used to save the generated rays to disk
+        and to map them back in on later starts instead of re-running shine.
+        It is only used if seed is not None.
+    seed : int, optional
+        The seed of the numpy random state used when generating the rays for
+        the ray_store, and of the scrambling of the quasi-random sequences.
+        The default, None, does not seed the random state.
+    sampling : str
+        'random' (the default) uses the XRT pseudo-random sampling. 'sobol'
+        or 'halton' map the points of a scrambled Sobol or Halton sequence
+        through the inverse CDFs of the 'normal' and 'flat' x, z, x', z' and
+        E distributions, which reduces the number of rays needed for a given
+        accuracy of integrated values (i.e. flux and centroids). Other
+        distributions (and uniformRayDensity) still use XRT's sampling.
+    acceptance : ID29OE, optional
+        If not None, the x' and z' of the rays are only sampled inside the
+        angular window subtended by the surface (limPhysX, limPhysY, so rays
+        landing outside of the optical area are kept) of this optic, widened
+        by acceptance_margin times the source size, and
+        the intensities (Jss, Jpp and Jsp) are scaled by the probability of a
+        ray falling inside the window so that the flux is unchanged. Only
+        'normal' and 'flat' angular distributions are restricted. The
+        window is recalculated (and the rays re-generated) whenever the
+        parameters of the optic change (see self.acceptance_window).
+    acceptance_margin : float
+        The number of source size standard deviations (or half widths for
+        'flat' distributions) used to widen the acceptance window, the
+        default is 5.
     center : list or tuple.
         A 3 element list or tuple that defines the x, y, z position of the
         center element in XRT coordinates, i.e., (x, y, z).
@@ -249,6 +482,13 @@ class ID29Source(xrt_source.GeometricSource):
         `xrt.backends.raycing.sources.GeometricSource` class.
     beamOut :
         Output of self.shine() method call inside self.activate.
+    stats : ActivationStats
+        The rolling statistics of the calls to self.activate (see
+        instrumentation.py).
+    acceptance_window : tuple or None
+        The ((low, high), (low, high)) cumulative probability bounds that the
+        x' and z' samples are restricted to (None for an unrestricted axis),
+        or None if the sampling is not restricted.
 
     Methods
     -------
@@ -261,19 +501,34 @@ class ID29Source(xrt_source.GeometricSource):
     """
     def __init__(self, parameter_map, *args, center=(0, 0, 0),
                  transform_matrix=np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
-                 **kwargs):
+                 cache=None, ray_store=None, seed=None, sampling='random',
+                 acceptance=None, acceptance_margin=5, **kwargs):
+        self._shine_calls = None  # used by _apply_distribution during shine
+        self._points = None  # used by _apply_distribution during shine
+        self._windows = None  # used by _apply_distribution during shine
         super().__init__(*args, center=center, **kwargs)
         self.beamOut = None  # Output in global coordinate!
+        self.cache = cache
+        self.stats = ActivationStats()  # see instrumentation.py
+        self.ray_store = ray_store
+        self.seed = seed
+        self.sampling = sampling
+        self.acceptance = acceptance
+        self.acceptance_margin = acceptance_margin
+        self.acceptance_window = None
+        self._acceptance_values = None  # the last acceptance parameters
         self._default_parameter_map = parameter_map
         self._transform_matrix = transform_matrix
         self._y_offset = center[1]
+        self._parameters = ParameterMap(parameter_map, transform_matrix,
+                                        center[1])
 
     @property
     def _parameter_map(self):
         """
         An attribute-like method that returns an updated parameter_map.
         """
-        return _parse_parameter_map(self._default_parameter_map)
+        return self._parameters.resolve(self._parameters.read())
 
     @_parameter_map.setter
     def _parameter_map(self, new_parameter_map): # used to take input manually
@@ -303,13 +558,314 @@ class ID29Source(xrt_source.GeometricSource):
 
         # TODO: Need to add the 'energies' tuple, with the form (energy,
         #  bandwidth), to this. Consider a look-up table for the bandwidth.
+        start = time.perf_counter()
         updated = _update_parameters(self, updated)
+        updated = self._update_acceptance(updated)
 
         if updated:
-            self.beamOut = self.shine()
+            self.beamOut = _run_cached(self, self._shine,
+                                       extra=(self.nrays, self.energies,
+                                              self.acceptance_window))
+
+        _record_activation(self, start, updated)
+
+        return updated
+
+    @property
+    def _watches(self):
+        """
+        The other components whose parameters this source depends on.
+
+        Used by AriModel to activate the source when the parameters of the
+        acceptance optic change.
+        """
+        return () if self.acceptance is None else (self.acceptance,)
+
+    def _update_acceptance(self, updated):
+        """
+        Update self.acceptance_window if the acceptance geometry has changed.
+
+        Parameters
+        ----------
+        updated : Boolean
+            True if the source parameters have changed.
+
+        Returns
+        -------
+        updated : Boolean
+            The input updated, set to True if the window has changed.
+        """
+        if self.acceptance is None:
+            self._acceptance_values = None
+            if self.acceptance_window is not None:
+                self.acceptance_window = None
+                updated = True
+            return updated
+
+        # Read the optic parameters directly, as the optic is only updated
+        # after the source is activated.
+        values = self.acceptance._parameters.read()
+        if (updated or self._acceptance_values is None or
+                not np.array_equal(values, self._acceptance_values)):
+            self._acceptance_values = values.copy()
+            window = self._acceptance_window(values)
+            if window != self.acceptance_window:
+                self.acceptance_window = window
+                updated = True
 
         return updated
 
+    def _acceptance_window(self, values):
+        """
+        Return the cumulative probability window for the acceptance optic.
+
+        The edges of the physical surface of self.acceptance, placed using the
+        parameters in values, are transformed to the local source coordinates
+        to find the range of ray slopes (x/y and z/y) that can reach it. This
+        range is widened by self.acceptance_margin times the source size and
+        converted to bounds on the cumulative probability of the x' and z'
+        distributions. As |a| <= |x/y| (and |c| <= |z/y|) for the normalized
+        ray directions this window contains every ray that can reach the
+        surface.
+
+        Parameters
+        ----------
+        values : np.array
+            The values vector of the acceptance optic parameters.
+
+        Returns
+        -------
+        window : tuple or None
+            The ((low, high), (low, high)) cumulative probability bounds for
+            x' and z' (None for an axis that is not restricted), or None if
+            the sampling can not be restricted.
+        """
+        if 'annulus' in (self.distx, self.distz, self.distxprime,
+                         self.distzprime):
+            return None
+
+        oe = self.acceptance
+        geometry = {'center': oe.center, 'pitch': oe.pitch,
+                    'roll': oe.roll, 'yaw': oe.yaw}
+        geometry.update(oe._parameters.xrt_parameters(values))
+
+        # Points along the edges of the surface, in local coordinates
+        limits_x = oe.limPhysX if oe.limPhysX is not None else oe.limOptX
+        limits_y = oe.limPhysY if oe.limPhysY is not None else oe.limOptY
+        edge = np.linspace(0, 1, 9)
+        x = np.concatenate([limits_x[0] + (limits_x[1] - limits_x[0]) * edge,
+                            np.full(9, limits_x[1]),
+                            limits_x[1] - (limits_x[1] - limits_x[0]) * edge,
+                            np.full(9, limits_x[0])])
+        y = np.concatenate([np.full(9, limits_y[0]),
+                            limits_y[0] + (limits_y[1] - limits_y[0]) * edge,
+                            np.full(9, limits_y[1]),
+                            limits_y[1] - (limits_y[1] - limits_y[0]) * edge])
+        z = np.asarray(oe.local_z(x, y), dtype=float) + np.zeros_like(x)
+
+        # local optic -> global, as for OE.local_to_global
+        if oe.extraPitch or oe.extraRoll or oe.extraYaw:
+            raycing.rotate_xyz(x, y, z,
+                               rotationSequence='-'+oe.extraRotationSequence,
+                               pitch=oe.extraPitch, roll=oe.extraRoll,
+                               yaw=oe.extraYaw)
+        raycing.rotate_xyz(x, y, z, rotationSequence='-'+oe.rotationSequence,
+                           pitch=geometry['pitch'],
+                           roll=geometry['roll'] + oe.positionRoll,
+                           yaw=geometry['yaw'])
+        sin_azimuth, cos_azimuth = self.bl.sinAzimuth, self.bl.cosAzimuth
+        x, y = raycing.rotate_z(x, y, cos_azimuth, -sin_azimuth)
+        center = geometry['center']
+
+        # global -> local source, the inverse of the transforms in shine
+        x, y = raycing.rotate_z(x + center[0] - self.center[0],
+                                y + center[1] - self.center[1],
+                                cos_azimuth, sin_azimuth)
+        z = z + center[2] - self.center[2]
+        if self.pitch or self.roll or self.yaw:
+            raycing.rotate_xyz(x, y, z, rotationSequence='-RzRyRx',
+                               pitch=-self.pitch, roll=-self.roll,
+                               yaw=-self.yaw)
+        if np.any(y <= 0):  # the optic is not entirely downstream
+            return None
+
+        window = []
+        for slope, dist, size, distprime, dprime in (
+                (x / y, self.distx, self.dx, self.distxprime, self.dxprime),
+                (z / y, self.distz, self.dz, self.distzprime, self.dzprime)):
+            size = size[0] if isinstance(size, (list, tuple)) else size
+            if dist == 'flat':
+                size = size / 2
+            elif dist is None:
+                size = 0
+            margin = self.acceptance_margin * abs(size) / y.min()
+            low, high = slope.min() - margin, slope.max() + margin
+            if distprime == 'normal' and not self.uniformRayDensity:
+                sigma = (dprime[0] if isinstance(dprime, (list, tuple))
+                         else dprime)
+                from scipy.special import ndtr  # only needed here
+
+                bounds = (float(ndtr(low / sigma)), float(ndtr(high / sigma)))
+            elif distprime == 'flat':
+                if isinstance(dprime, (list, tuple, np.ndarray)):
+                    flat_low, flat_high = dprime[0], dprime[1]
+                else:
+                    flat_low, flat_high = -dprime * 0.5, dprime * 0.5
+                bounds = tuple(float(np.clip((value - flat_low) /
+                                             (flat_high - flat_low), 0, 1))
+                               for value in (low, high))
+            else:  # not restricted
+                window.append(None)
+                continue
+            if bounds[1] <= bounds[0]:  # no rays can reach the optic
+                return None
+            window.append(bounds)
+
+        if window == [None, None]:
+            return None
+
+        return tuple(window)
+
+    def _shine(self):
+        """
+        Run self.shine, re-using (or saving) the rays in self.ray_store.
+        """
+        if self.ray_store is None or self.seed is None:
+            return self._sample()
+
+        key = self.ray_store.key(self, self.seed)
+        beam = self.ray_store.load(key)
+        if beam is None:
+            with seeded_random_state(self.seed):
+                beam = self._sample()
+            self.ray_store.save(key, beam)
+
+        return beam
+
+    def _sample(self):
+        """
+        Run self.shine using the sampling set by self.sampling.
+
+        If self.acceptance_window is set the x' and z' samples are restricted
+        to it and the intensities are scaled by the window probability.
+        """
+        window = self.acceptance_window
+        if self.sampling == 'random' and window is None:
+            return self.shine()
+
+        points = None
+        if self.sampling != 'random':
+            # scipy.stats is slow to import, so only import it when needed.
+            from scipy.stats import qmc
+
+            engines = {'sobol': qmc.Sobol, 'halton': qmc.Halton}
+            if self.sampling not in engines:
+                raise ValueError(f"sampling must be 'random', 'sobol' or "
+                                 f"'halton', got {self.sampling}")
+            # Unseeded sources take the scrambling seed from the global random
+            # state, so that AriModel.trace_parallel chunks are independent.
+            seed = (self.seed if self.seed is not None else
+                    np.random.randint(2**31))
+            engine = engines[self.sampling](d=6, scramble=True, seed=seed)
+            with warnings.catch_warnings():  # nrays need not be a power of 2
+                warnings.simplefilter('ignore', UserWarning)
+                points = engine.random(self.nrays)
+            # keep the points away from 0 and 1, where the normal ppf is
+            # infinite
+            points = np.clip(points, 1E-12, 1 - 1E-12)
+
+        self._shine_calls = iter(self._shine_axes())
+        self._points = points
+        if window is not None:
+            self._windows = dict(zip(('a', 'c'), window))
+        try:
+            beam = self.shine()
+        finally:
+            self._shine_calls = None
+            self._points = None
+            self._windows = None
+
+        column = None if points is None else points[:, qmc_columns['E']]
+        if column is not None and self.distE == 'normal':
+            from scipy.special import ndtri  # only needed here
+
+            beam.E[:] = self.energies[0] + self.energies[1] * ndtri(column)
+        elif column is not None and self.distE == 'flat':
+            beam.E[:] = self.energies[0] + (
+                self.energies[1] - self.energies[0]) * column
+
+        if window is not None:  # keep the flux of the restricted rays
+            weight = np.prod([high - low for low, high in
+                              (bounds for bounds in window
+                               if bounds is not None)])
+            beam.Jss *= weight
+            beam.Jpp *= weight
+            beam.Jsp *= weight
+
+        return beam
+
+    def _shine_axes(self):
+        """
+        Return the Beam axes shine calls _apply_distribution for, in order.
+
+        This follows GeometricSource.shine, which samples y, then x and z
+        (unless they have an 'annulus' distribution) and then x' and z' (the
+        Beam attributes a and c, unless they have an 'annulus' distribution).
+        """
+        axes = ['y']
+        for names, dist_x, dist_z, size in (
+                (('x', 'z'), self.distx, self.distz, self.dx),
+                (('a', 'c'), self.distxprime, self.distzprime, self.dxprime)):
+            if not ('annulus' in (dist_x, dist_z) and
+                    raycing.is_sequence(size)):
+                axes.extend(names)
+
+        return axes
+
+    def _apply_distribution(self, axis, distaxis, daxis, bo=None):
+        """
+        Fill axis with samples of a distribution (see GeometricSource).
+
+        While self._sample is running each call is matched to its Beam axis
+        (see self._shine_axes), which selects the fixed column of the
+        quasi-random points (see qmc_columns) used for the 'normal' and 'flat'
+        distributions, and the acceptance window bounds (if any) used to
+        restrict the samples.
+        """
+        if self._shine_calls is None:
+            return super()._apply_distribution(axis, distaxis, daxis, bo)
+
+        name = next(self._shine_calls)
+        if bo is not None and axis is not getattr(bo, name):
+            raise RuntimeError(f'GeometricSource.shine did not sample the '
+                               f'{name} axis in the expected order')
+        column = (None if self._points is None else
+                  self._points[:, qmc_columns[name]])
+        bounds = None if self._windows is None else self._windows.get(name)
+        if bounds is not None:  # map the samples into the window
+            if column is None:
+                column = np.random.random_sample(len(axis))
+            column = np.clip(bounds[0] + (bounds[1] - bounds[0]) * column,
+                             1E-12, 1 - 1E-12)
+
+        if column is None:
+            super()._apply_distribution(axis, distaxis, daxis, bo)
+        elif distaxis == 'normal' and not self.uniformRayDensity:
+            from scipy.special import ndtri  # only needed here
+
+            sigma = daxis[0] if isinstance(daxis, (list, tuple)) else daxis
+            axis[:] = sigma * ndtri(column)
+        elif distaxis == 'flat':
+            if isinstance(daxis, (list, tuple, np.ndarray)):
+                low, high = daxis[0], daxis[1]
+            elif daxis <= 0:
+                return
+            else:
+                low, high = -daxis * 0.5, daxis * 0.5
+            axis[:] = low + (high - low) * column
+        else:
+            super()._apply_distribution(axis, distaxis, daxis, bo)
+
 
 class ID29OE(xrt_oes.OE):
     """
@@ -356,6 +912,19 @@ class ID29OE(xrt_oes.OE):
         4.  The three 'angles' Rx, Ry and Rz should be provided as a 3 element
             list (called 'angles' as is done for 'center', with the default
             value, as a float of int, used for any non settable angles.
+    cache : BeamCache, optional
+        A beam_cache.BeamCache instance used to store and re-use the output of
+        activate for previously seen parameter values (see _run_cached). The
+        default, None, disables caching.
+    compact : Boolean
+        If True the upstream beamOut is compacted, keeping only the rays that
+        are still propagating, before it is used as beamIn (see compact_beam).
+        The default is False.
+    compact_dtype : numpy dtype, optional
+        The dtype used for the floating point arrays of the compacted beam,
+        i.e. np.float32. The default, None, keeps the original dtype. Note
+        that the surface intersection search in self.reflect may not converge
+        to the same result in single precision.
     center : list or tuple.
         A 3 element list or tuple that defines the x, y, z position of the
         center element in XRT coordinates, i.e., (x, y, z).
@@ -373,6 +942,8 @@ class ID29OE(xrt_oes.OE):
     ----------
     *attributes : many
         The attributes of the parent `xrt.backends.raycing.oes.OE` class.
+    rays_kept_ratio : float
+        The fraction of the upstream rays kept in beamIn when compact is True.
     beamIn :
         Input to use in the self.reflect() method call inside self.activate
         global coordinate.
@@ -382,6 +953,9 @@ class ID29OE(xrt_oes.OE):
     beamOutloc :
         Output of self.reflect() method call inside self.activate in XRT local
         co-ordinates.
+    stats : ActivationStats
+        The rolling statistics of the calls to self.activate (see
+        instrumentation.py).
 
     Methods
     -------
@@ -395,8 +969,15 @@ class ID29OE(xrt_oes.OE):
 
     def __init__(self, parameter_map, *args, center=(0, 0, 0),
                  transform_matrix=np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
-                 upstream=None, **kwargs):
+                 upstream=None, cache=None, compact=False, compact_dtype=None,
+                 **kwargs):
         super().__init__(*args, center=center, **kwargs)
+        self.cache = cache
+        self.stats = ActivationStats()  # see instrumentation.py
+        self.compact = compact
+        self.compact_dtype = compact_dtype
+        self.rays_kept_ratio = 1.0
+        self._compacted = None  # the compacted beamIn kept by _get_beam_in
 
         self.beamIn = None  # Input in global coordinate!
         self.beamOut = None  # Output in global coordinate!
@@ -405,13 +986,15 @@ class ID29OE(xrt_oes.OE):
         self._default_parameter_map = parameter_map
         self._upstream = upstream  # Object from modified XRT
         self._y_offset = center[1]
+        self._parameters = ParameterMap(parameter_map, transform_matrix,
+                                        center[1])
 
     @property
     def _parameter_map(self):
         """
         An attribute-like method that returns an updated parameter_map.
         """
-        return _parse_parameter_map(self._default_parameter_map)
+        return self._parameters.resolve(self._parameters.read())
 
     @_parameter_map.setter
     def _parameter_map(self, new_parameter_map): # used to take input manually
@@ -437,11 +1020,15 @@ class ID29OE(xrt_oes.OE):
             Potentially modified the input parameter updated if the update
             indicates a re-activation required.
         """
+        start = time.perf_counter()
         updated = _update_parameters(self, updated)
 
         if updated:
-            self.beamIn = getattr(self._upstream, 'beamOut')
-            self.beamOut, self.beamOutloc = self.reflect(self.beamIn)
+            self.beamIn = _get_beam_in(self)
+            self.beamOut, self.beamOutloc = _run_cached(self, self.reflect,
+                                                        self.beamIn)
+
+        _record_activation(self, start, updated)
 
         return updated
 
@@ -454,6 +1041,12 @@ class ID29Aperture(xrt_aperture.RectangularAperture):
     activate method and beamIn, beamOut, upstream, transform_matrix and
     parameter_map attributes. All are described below.
 
+    The coordinates at which the incoming rays cross the aperture plane do
+    not depend on the opening, so they are kept after each full propagate.
+    If only the opening has changed since (i.e. during a blade scan) the new
+    beamOut is found by re-checking these coordinates against the new
+    opening (see self._propagate), without re-calculating the intersections.
+
     Parameters
     ----------
     upstream : arguments, such as m1, pgm ...
@@ -495,6 +1088,17 @@ class ID29Aperture(xrt_aperture.RectangularAperture):
         4.  The three 'angles' Rx, Ry and Rz should be provided as a 3 element
             list (called 'angles' as is done for 'center', with the default
             value, as a float of int, used for any non settable angles.
+    cache : BeamCache, optional
+        A beam_cache.BeamCache instance used to store and re-use the output of
+        activate for previously seen parameter values (see _run_cached). The
+        default, None, disables caching.
+    compact : Boolean
+        If True the upstream beamOut is compacted, keeping only the rays that
+        are still propagating, before it is used as beamIn (see compact_beam).
+        The default is False.
+    compact_dtype : numpy dtype, optional
+        The dtype used for the floating point arrays of the compacted beam,
+        i.e. np.float32. The default, None, keeps the original dtype.
     center : list or tuple.
         A 3 element list or tuple that defines the x, y, z position of the
         center element in XRT coordinates, i.e., (x, y, z).
@@ -513,12 +1117,16 @@ class ID29Aperture(xrt_aperture.RectangularAperture):
     *attributes : many
         The attributes of the parent
         `xrt.backends.raycing.apertures.RectangularAperture` class.
+    rays_kept_ratio : float
+        The fraction of the upstream rays kept in beamIn when compact is True.
     beamIn :
         Input to use in the self.propagate() method call inside self.activate
         global coordinate.
     beamOut :
         Output of self.propagate() method call inside self.activate.
-
+    stats : ActivationStats
+        The rolling statistics of the calls to self.activate (see
+        instrumentation.py).
 
     Methods
     -------
@@ -532,8 +1140,16 @@ class ID29Aperture(xrt_aperture.RectangularAperture):
     """
     def __init__(self, parameter_map, *args, center=(0, 0, 0),
                  transform_matrix=np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
-                 upstream=None, **kwargs):
+                 upstream=None, cache=None, compact=False, compact_dtype=None,
+                 **kwargs):
         super().__init__(*args, center=center, **kwargs)
+        self.cache = cache
+        self.stats = ActivationStats()  # see instrumentation.py
+        self.compact = compact
+        self.compact_dtype = compact_dtype
+        self.rays_kept_ratio = 1.0
+        self._compacted = None  # the compacted beamIn kept by _get_beam_in
+        self._hits = None  # the plane coordinates kept by self._propagate
 
         self.beamIn = None  # Input in global coordinate!
         self.beamOut = None  # Output in global coordinate!
@@ -541,13 +1157,15 @@ class ID29Aperture(xrt_aperture.RectangularAperture):
         self._default_parameter_map = parameter_map
         self._upstream = upstream  # Object from modified XRT
         self._y_offset = center[1]
+        self._parameters = ParameterMap(parameter_map, transform_matrix,
+                                        center[1])
 
     @property
     def _parameter_map(self):
         """
         An attribute-like method that returns an updated parameter_map.
         """
-        return _parse_parameter_map(self._default_parameter_map)
+        return self._parameters.resolve(self._parameters.read())
 
     @_parameter_map.setter
     def _parameter_map(self, new_parameter_map): # used to take input manually
@@ -575,14 +1193,90 @@ class ID29Aperture(xrt_aperture.RectangularAperture):
             indicates a re-activation required.
 
         """
+        start = time.perf_counter()
         updated = _update_parameters(self, updated)
 
         if updated:
-            self.beamIn = getattr(self._upstream, 'beamOut')
-            self.beamOut = self.propagate(self.beamIn)
+            self.beamIn = _get_beam_in(self)
+            # propagate marks the blocked rays as lost on beamIn itself, the
+            # state is restored afterwards so that the upstream beamOut can
+            # be re-used if only this aperture (or a sibling) is re-traced.
+            state = self.beamIn.state.copy()
+            self.beamOut = _run_cached(self, self._propagate, self.beamIn)
+            self.beamIn.state[:] = state
+
+        _record_activation(self, start, updated)
 
         return updated
 
+    def _propagate(self, beam):
+        """
+        Run self.propagate, or re-mask the last result if only the opening
+        has changed.
+
+        After a full propagate the local beam, the input state and the x and
+        z plane coordinates of the rays that reached the aperture are kept in
+        self._hits. These are re-used while the input beam object, the
+        aperture position and kind are unchanged, in which case the returned
+        local beam shares all of its arrays, except state, with the kept one.
+        The side effects of propagate are kept: the blocked rays are given
+        the state self.lostNum (in beam and the returned beam), the
+        self.spotLimits are widened to include the rays that pass, the
+        alarms are checked (if self.alarmLevel is set) and the call is
+        recorded in the beamline flow.
+
+        Parameters
+        ----------
+        beam : Beam object
+            The input beam, in global coordinates.
+
+        Returns
+        -------
+        beamOut : Beam object
+            The beam in the local coordinates of the aperture.
+        """
+        key = (tuple(self.center), tuple(self.kind), self.x, self.z,
+               len(beam.state))
+        if (self._hits is None or self._hits[0] != key or
+                self._hits[1] is not beam or
+                not np.array_equal(self._hits[3], beam.state) or
+                raycing.is_auto_align_required(self)):
+            good = np.flatnonzero(beam.state > 0)
+            state = beam.state.copy()
+            local = self.propagate(beam)
+            self._hits = (key, beam, local, state, good,
+                          local.x[good], local.z[good])
+            return local
+
+        _, _, local, state, good, x, z = self._hits
+        blocked = np.zeros(len(good), dtype=bool)
+        for kind, edge in zip(self.kind, self.opening):
+            if kind.startswith('l'):
+                blocked |= x < edge
+            elif kind.startswith('r'):
+                blocked |= x > edge
+            elif kind.startswith('b'):
+                blocked |= z < edge
+            elif kind.startswith('t'):
+                blocked |= z > edge
+        out = copy.copy(local)  # shares the arrays of the kept local beam
+        out.state = state.copy()
+        out.state[good[blocked]] = self.lostNum
+
+        # The side effects of self.propagate
+        beam.state[good[blocked]] = self.lostNum
+        if not blocked.all():
+            x, z = x[~blocked], z[~blocked]
+            self.spotLimits = [min(self.spotLimits[0], x.min()),
+                               max(self.spotLimits[1], x.max()),
+                               min(self.spotLimits[2], z.min()),
+                               max(self.spotLimits[3], z.max())]
+        if self.alarmLevel is not None:
+            raycing.check_alarm(self, state > 0, beam)
+        raycing.append_to_flow(self.propagate, [out], inspect.currentframe())
+
+        return out
+
 
 class ID29Screen(xrt_screen.Screen):
     """
@@ -632,6 +1326,17 @@ class ID29Screen(xrt_screen.Screen):
         4.  The three 'angles' Rx, Ry and Rz should be provided as a 3 element
             list (called 'angles' as is done for 'center', with the default
             value, as a float of int, used for any non settable angles.
+    cache : BeamCache, optional
+        A beam_cache.BeamCache instance used to store and re-use the output of
+        activate for previously seen parameter values (see _run_cached). The
+        default, None, disables caching.
+    compact : Boolean
+        If True the upstream beamOut is compacted, keeping only the rays that
+        are still propagating, before it is used as beamIn (see compact_beam).
+        The default is False.
+    compact_dtype : numpy dtype, optional
+        The dtype used for the floating point arrays of the compacted beam,
+        i.e. np.float32. The default, None, keeps the original dtype.
     center : list or tuple.
         A 3 element list or tuple that defines the x, y, z position of the
         center element in XRT coordinates, i.e., (x, y, z).
@@ -649,11 +1354,16 @@ class ID29Screen(xrt_screen.Screen):
     ----------
     *attributes : many
         The attributes of the `xrt.backends.raycing.screens.Screen` class.
+    rays_kept_ratio : float
+        The fraction of the upstream rays kept in beamIn when compact is True.
     beamIn :
         Input to use in the self.expose() method call inside self.activate
         global coordinate.
     beamOut :
         Output of self.expose() method call inside self.activate.
+    stats : ActivationStats
+        The rolling statistics of the calls to self.activate (see
+        instrumentation.py).
 
     Methods
     -------
@@ -667,8 +1377,15 @@ class ID29Screen(xrt_screen.Screen):
     """
     def __init__(self, parameter_map, *args, center=(0, 0, 0),
                  transform_matrix=np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]]),
-                 upstream=None, **kwargs):
+                 upstream=None, cache=None, compact=False, compact_dtype=None,
+                 **kwargs):
         super().__init__(*args, center=center, **kwargs)
+        self.cache = cache
+        self.stats = ActivationStats()  # see instrumentation.py
+        self.compact = compact
+        self.compact_dtype = compact_dtype
+        self.rays_kept_ratio = 1.0
+        self._compacted = None  # the compacted beamIn kept by _get_beam_in
 
         self.beamIn = None  # Input in global coordinate!
         self.beamOut = None  # Output in global coordinate!
@@ -676,13 +1393,15 @@ class ID29Screen(xrt_screen.Screen):
         self._default_parameter_map = parameter_map
         self._upstream = upstream  # Object from modified XRT
         self._y_offset = center[1]
+        self._parameters = ParameterMap(parameter_map, transform_matrix,
+                                        center[1])
 
     @property
     def _parameter_map(self):
         """
         An attribute-like method that returns an updated parameter_map.
         """
-        return _parse_parameter_map(self._default_parameter_map)
+        return self._parameters.resolve(self._parameters.read())
 
     @_parameter_map.setter
     def _parameter_map(self, new_parameter_map): # used to take input manually
@@ -711,10 +1430,13 @@ class ID29Screen(xrt_screen.Screen):
             indicates a re-activation required.
 
         """
+        start = time.perf_counter()
         updated = _update_parameters(self, updated)
 
         if updated:
-            self.beamIn = getattr(self._upstream, 'beamOut')
-            self.beamOut = self.expose(self.beamIn)
+            self.beamIn = _get_beam_in(self)
+            self.beamOut = _run_cached(self, self.expose, self.beamIn)
+
+        _record_activation(self, start, updated)
 
         return updated
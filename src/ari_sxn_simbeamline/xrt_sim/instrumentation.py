@@ -0,0 +1,135 @@
+import numpy as np
+import threading
+
+
+class ActivationStats:
+    """
+    Rolling statistics of the activations of a beamline component.
+
+    Each ID29* component (see custom_devices.py) records one entry per call
+    to its activate method, and AriModel.activate records a skipped entry for
+    the components it does not need to call. The last window entries are
+    kept in a numpy ring buffer from which the rolling statistics are found.
+    The entries are recorded by the thread tracing the model (i.e. a
+    ModelRunner worker) while the statistics are read by another (i.e. the
+    SimStats IOC event loop), so recording, reading and clearing the entries
+    hold a lock.
+
+    Parameters
+    ----------
+    window : int
+        The number of most recent activations included in the rolling
+        statistics, the default is 100.
+
+    Attributes
+    ----------
+    activations : int
+        The total number of activations recorded (traced and skipped).
+    skipped : int
+        The total number of skipped activations recorded.
+    last : dict
+        The 'time', 'rays_in', 'rays_out', 'nbytes' and 'skipped' values of
+        the last traced (not skipped) activation.
+
+    Methods
+    -------
+    record(time, rays_in=0, rays_out=0, nbytes=0, skipped=False) :
+        Record an activation.
+    summary(reset=False) :
+        Return a dictionary of the rolling statistics.
+    reset() :
+        Clear all of the recorded activations.
+    """
+    fields = ('time', 'rays_in', 'rays_out', 'nbytes', 'skipped')
+
+    def __init__(self, window=100):
+        self.window = window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all of the recorded activations.
+        """
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        """
+        Clear all of the recorded activations, with self._lock held.
+        """
+        self._buffer = np.zeros((self.window, len(self.fields)))
+        self._index = 0
+        self.activations = 0
+        self.skipped = 0
+        self.last = dict.fromkeys(self.fields, 0)
+
+    def record(self, time, rays_in=0, rays_out=0, nbytes=0, skipped=False):
+        """
+        Record an activation.
+
+        Parameters
+        ----------
+        time : float
+            The wall time of the activation, in seconds.
+        rays_in : int
+            The number of good rays in the input beam.
+        rays_out : int
+            The number of good rays in the output beam.
+        nbytes : int
+            The number of bytes allocated for the output beam(s), 0 if they
+            were taken from the cache.
+        skipped : Boolean
+            True if the component was not re-traced.
+        """
+        with self._lock:
+            self._buffer[self._index % self.window] = (time, rays_in,
+                                                       rays_out, nbytes,
+                                                       skipped)
+            self._index += 1
+            self.activations += 1
+            if skipped:
+                self.skipped += 1
+            else:
+                self.last = {'time': time, 'rays_in': rays_in,
+                             'rays_out': rays_out, 'nbytes': nbytes,
+                             'skipped': False}
+
+    def summary(self, reset=False):
+        """
+        Return a dictionary of the rolling statistics.
+
+        Parameters
+        ----------
+        reset : Boolean
+            If True the recorded activations are cleared after they are read,
+            without losing any recorded in between.
+
+        Returns
+        -------
+        summary : dict
+            A dictionary with the total 'activations' and 'skipped' counts,
+            the last traced activation values (as 'last_time', 'last_rays_in',
+            'last_rays_out' and 'last_nbytes') and the 'mean_time',
+            'max_time', 'mean_rays_out', 'mean_nbytes' and 'skip_fraction' of
+            the entries in the rolling window ('mean_*' and 'max_*' only
+            include the traced activations).
+        """
+        with self._lock:  # a consistent snapshot of the recorded entries
+            entries = self._buffer[:min(self._index, self.window)].copy()
+            out = {'activations': self.activations, 'skipped': self.skipped}
+            out.update({f'last_{field}': self.last[field]
+                        for field in self.fields[:4]})
+            if reset:
+                self._reset()
+
+        traced = entries[entries[:, 4] == 0]
+        out['mean_time'] = float(traced[:, 0].mean()) if len(traced) else 0.0
+        out['max_time'] = float(traced[:, 0].max()) if len(traced) else 0.0
+        out['mean_rays_out'] = (float(traced[:, 2].mean()) if len(traced)
+                                else 0.0)
+        out['mean_nbytes'] = float(traced[:, 3].mean()) if len(traced) else 0.0
+        out['skip_fraction'] = (float(entries[:, 4].mean()) if len(entries)
+                                else 0.0)
+
+        return out
@@ -0,0 +1,335 @@
+import asyncio
+import copy
+import logging
+import numpy as np
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def copy_beam(beam):
+    """
+    Return a copy of a Beam object, with copies of all of its arrays.
+
+    The components modify some of the arrays of the beams passed between
+    them in place (i.e. ID29Aperture marks and then restores the state of
+    its input beam), so a beam read outside of the worker thread must be a
+    copy.
+
+    Parameters
+    ----------
+    beam : Beam object or None
+        The beam to copy.
+
+    Returns
+    -------
+    copied : Beam object or None
+        The copy, or None if beam is None.
+    """
+    if beam is None:
+        return None
+    copied = copy.copy(beam)
+    for attribute, value in vars(beam).items():
+        if isinstance(value, np.ndarray):
+            setattr(copied, attribute, value.copy())
+
+    return copied
+
+
+class ModelRunner:
+    """
+    Runs AriModel.activate in a worker thread, coalescing update requests.
+
+    This is intended to be used by the caproto IOCs so that motor writes never
+    run the ray tracing inside a putter. A putter calls self.request (which
+    returns immediately) and the worker thread runs model.activate. Requests
+    made while a recompute is in-flight are coalesced into a single queued
+    recompute, so N rapid writes produce at most one in-flight and one queued
+    call to model.activate. After each recompute the publish callback is
+    called with the version stamp of the latest request included in it and a
+    snapshot of the outputs, taken in the worker thread, so the callback never
+    reads the live model (which the next recompute may be modifying).
+
+    Parameters
+    ----------
+    model : AriModel
+        The model to run.
+    publish : callable or coroutine function, optional
+        Called as publish(version, outputs) after each recompute, where
+        outputs is a dictionary of the reducer outputs or, if reducers is
+        None, of copies of the beamOut of each component (see copy_beam, the
+        components modify some of the beam arrays in place while tracing, so
+        the live beams are not published). If loop is None it is
+        called in the worker thread, otherwise it is scheduled on loop (as a
+        task if it is a coroutine function). Caproto IOCs should pass an async
+        function that writes the PVs and their event loop.
+    loop : asyncio event loop, optional
+        The event loop to publish the results on.
+    reducers : dict, optional
+        A dictionary mapping output names to reducers (see reducers.py) that
+        are evaluated in the worker thread after each recompute.
+
+    Attributes
+    ----------
+    requested : int
+        The version stamp of the latest request.
+    completed : int
+        The version stamp of the latest finished recompute.
+    recomputes : int
+        The number of calls made to model.activate.
+    coalesced : int
+        The number of requests merged into an already queued recompute.
+
+    Methods
+    -------
+    request(updated=False) :
+        Request a recompute and return its version stamp.
+    wait(version=None, timeout=None) :
+        Block until the given version (default: latest) has been computed.
+    close() :
+        Stop the worker thread.
+    """
+    def __init__(self, model, publish=None, loop=None, reducers=None):
+        self.model = model
+        self.publish = publish
+        self.loop = loop
+        self.reducers = reducers
+        self.requested = 0
+        self.completed = 0
+        self.recomputes = 0
+        self.coalesced = 0
+        self._condition = threading.Condition()
+        self._pending = False
+        self._force = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='ModelRunner')
+        self._thread.start()
+
+    def request(self, updated=False):
+        """
+        Request a recompute and return its version stamp.
+
+        Parameters
+        ----------
+        updated : Boolean
+            Passed to model.activate, True forces every component to be
+            re-traced. Coalesced requests force a re-trace if any of them do.
+
+        Returns
+        -------
+        version : int
+            The version stamp of this request. The first published result with
+            a version greater than or equal to this includes the request.
+        """
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The ModelRunner has been closed')
+            self.requested += 1
+            if self._pending:
+                self.coalesced += 1
+            self._pending = True
+            self._force = self._force or updated
+            self._condition.notify_all()
+
+            return self.requested
+
+    def wait(self, version=None, timeout=None):
+        """
+        Block until the given version (default: latest) has been computed.
+
+        Parameters
+        ----------
+        version : int, optional
+            The version stamp to wait for, the default is self.requested.
+        timeout : float, optional
+            The maximum time to wait, in seconds.
+
+        Returns
+        -------
+        done : Boolean
+            True if the version has been computed.
+        """
+        with self._condition:
+            version = self.requested if version is None else version
+            return self._condition.wait_for(
+                lambda: self.completed >= version or self._closed, timeout)
+
+    def close(self):
+        """
+        Stop the worker thread, any queued recompute is discarded.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        """
+        The worker thread loop.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if self._closed:
+                    return
+                version, force = self.requested, self._force
+                self._pending, self._force = False, False
+
+            try:
+                self._recompute(version, force)
+            except Exception:
+                logger.exception('AriModel.activate failed for version %s',
+                                 version)
+                self._complete(version)
+
+    def _recompute(self, version, force):
+        """
+        Recompute the model for a request and publish the result.
+        """
+        self.model.activate(updated=force)
+        outputs = self._outputs()
+        self.recomputes += 1
+        self._complete(version)
+        self._publish(version, outputs)
+
+    def _outputs(self):
+        """
+        Return a snapshot of the model outputs, in the worker thread.
+
+        Returns
+        -------
+        outputs : dict
+            A dictionary mapping the reducer names to a copy of their outputs
+            (as some reducers re-use their output array), or the component
+            names to a copy of their beamOut if self.reducers is None.
+        """
+        if self.reducers is None:
+            return {item: copy_beam(getattr(self.model, item).beamOut)
+                    for item in self.model.components}
+
+        return {name: np.array(reducer(self.model))
+                for name, reducer in self.reducers.items()}
+
+    def _complete(self, version):
+        """
+        Record that the request with the given version has been computed.
+        """
+        with self._condition:
+            self.completed = version
+            self._condition.notify_all()
+
+    def _interrupted(self):
+        """
+        Return True if a new request is pending or the runner is closing.
+        """
+        with self._condition:
+            return self._pending or self._closed
+
+    def _publish(self, version, *args):
+        """
+        Publish the result of a recompute using self.publish.
+        """
+        if self.publish is None:
+            return
+        if self.loop is None:
+            self.publish(version, *args)
+        elif asyncio.iscoroutinefunction(self.publish):
+            asyncio.run_coroutine_threadsafe(self.publish(version, *args),
+                                             self.loop)
+        else:
+            self.loop.call_soon_threadsafe(self.publish, version, *args)
+
+
+class ProgressiveModelRunner(ModelRunner):
+    """
+    A ModelRunner that progressively refines the result of each request.
+
+    For each request a fast, low ray count, pass is traced and published
+    first. While no new request is pending, further passes with more rays are
+    then traced in the worker thread and their reducer outputs are added to
+    those of the previous passes, with the accumulated outputs published after
+    each pass. A new request (i.e. a motor moving again) cancels the pending
+    refinement, so the feedback stays fast while motors move and becomes
+    accurate once they settle. The components cache is bypassed as every
+    pass needs new rays.
+
+    Parameters
+    ----------
+    model : AriModel
+        The model to run.
+    reducers : dict
+        A dictionary mapping output names to reducers (see reducers.py). As
+        the outputs are summed over the passes consumers should normalize
+        them by the published ray count.
+    publish : callable or coroutine function, optional
+        Called as publish(version, outputs, nrays) after each pass, where
+        outputs is a dictionary of the accumulated reducer outputs and nrays is
+        the total number of rays they include. See ModelRunner for how it is
+        called.
+    loop : asyncio event loop, optional
+        The event loop to publish the results on.
+    coarse_nrays : int
+        The number of rays in the first (fast) pass, the default is 1000.
+    fine_nrays : int, optional
+        The number of rays in each refinement pass, the default is
+        model.source.nrays.
+    max_nrays : int
+        The total number of rays after which refinement stops, the default is
+        1000000.
+
+    Attributes
+    ----------
+    refinements : int
+        The number of refinement passes traced.
+    """
+    def __init__(self, model, reducers, publish=None, loop=None,
+                 coarse_nrays=1000, fine_nrays=None, max_nrays=1000000):
+        self.coarse_nrays = coarse_nrays
+        self.fine_nrays = fine_nrays or model.source.nrays
+        self.max_nrays = max_nrays
+        self.refinements = 0
+        super().__init__(model, publish=publish, loop=loop,
+                         reducers=reducers)
+
+    def _trace(self, nrays):
+        """
+        Trace a pass with nrays rays and return the reducer outputs.
+
+        The caller restores model.source.nrays (see self._recompute).
+        """
+        self.model.source.nrays = nrays
+        self.model.activate(updated=True)
+
+        return self._outputs()
+
+    def _recompute(self, version, force):
+        """
+        Trace the coarse pass then refine it until interrupted or complete.
+
+        Every pass re-traces all of the components with new rays, so force
+        (which only asks for that) is always implied. The source nrays is
+        restored afterwards, and the source marked as dirty so that the next
+        model.activate outside of the runner re-traces with it.
+        """
+        original_nrays = self.model.source.nrays
+        try:
+            with self.model.uncached():
+                outputs = self._trace(self.coarse_nrays)
+                nrays = self.coarse_nrays
+                self.recomputes += 1
+                self._complete(version)
+                self._publish(version, dict(outputs), nrays)
+
+                while nrays < self.max_nrays and not self._interrupted():
+                    refinement = self._trace(self.fine_nrays)
+                    if self._interrupted():  # parameters may have changed
+                        break
+                    for name, value in refinement.items():
+                        outputs[name] = outputs[name] + value
+                    nrays += self.fine_nrays
+                    self.refinements += 1
+                    self._publish(version, dict(outputs), nrays)
+        finally:
+            self.model.source.nrays = original_nrays
+            self.model.invalidate('source')
@@ -0,0 +1,342 @@
+import numpy as np
+
+# The xrt attributes set from the 3 elements of an 'angles' parameter.
+_angles = ('pitch', 'roll', 'yaw')
+
+
+class ParameterMap:
+    """
+    A compiled version of a components parameter_map dictionary.
+
+    The parameter_map (see the ID29* classes in custom_devices.py) is parsed
+    once, at construction, into a flat vector of values with a slice for each
+    xrt parameter. Fixed values are stored in a template vector, and the
+    (object, attribute) pairs are stored as a list of sources that are read
+    into a copy of the template by self.read. The last values applied to the
+    component are kept so that finding out that nothing has changed is a
+    single array comparison.
+
+    Parameters
+    ----------
+    parameter_map : dict
+        A dictionary mapping xrt parameters to python objects that return the
+        parameters values, see the ID29* classes in custom_devices.py.
+    transform_matrix : np.array
+        A 3x3 numpy array that is the transformation matrix between the input
+        'centre' coordinate system and the xrt coordinate system.
+    y_offset : float
+        The offset added to the y value of the transformed 'center'.
+
+    Attributes
+    ----------
+    keys : list
+        The xrt parameter names in the order they appear in the values vector.
+    slices : dict
+        A dictionary mapping each xrt parameter name to its slice of the
+        values vector.
+    size : int
+        The length of the values vector.
+    last : np.array or None
+        The values last applied to a component using self.apply, None if
+        self.apply has not been called.
+    override : np.array or None
+        If not None, self.read returns these values instead of reading the
+        sources. This allows a parameter set to be evaluated without
+        modifying the objects referenced in parameter_map.
+
+    Methods
+    -------
+    read() :
+        Return the current values vector.
+    resolve(values) :
+        Convert a values vector into the equivalent parameter dictionary.
+    changed(values) :
+        Return True if values differs from the last applied values.
+    xrt_parameters(values) :
+        Return the xrt attribute values that self.apply would set.
+    apply(obj, values) :
+        Set the xrt parameters of obj from values if they have changed.
+    """
+    def __init__(self, parameter_map, transform_matrix=np.eye(3),
+                 y_offset=0):
+        self.keys = []
+        self.slices = {}
+        self._nested = {}
+        self._sources = []  # (index, object, attribute name) tuples
+        template = []
+        for key, value in parameter_map.items():
+            start = len(template)
+            if type(value) is dict:  # value is a dictionary
+                for val in value.values():
+                    self._add_entry(key, val, parameter_map, template)
+            else:
+                self._add_entry(key, value, parameter_map, template)
+            self.keys.append(key)
+            self.slices[key] = slice(start, len(template))
+            self._nested[key] = type(value) is dict
+
+        self._template = np.array(template, dtype=float)
+        self.size = len(template)
+        self._transform = np.asarray(transform_matrix, dtype=float)
+        self._offset = np.array([0, y_offset, 0], dtype=float)
+        self.last = None
+        self.override = None
+
+    def _add_entry(self, key, value, parameter_map, template):
+        """
+        Add a single fixed value or (object, attribute) pair to the template.
+        """
+        if type(value) is float or type(value) is int:
+            template.append(value)
+        elif type(value) in [list, tuple] and len(value) == 2:
+            self._sources.append((len(template), value[0], value[1]))
+            template.append(0.0)
+        else:
+            raise ValueError(f'Invalid value for {key} in {parameter_map}')
+
+    def read(self):
+        """
+        Return the current values vector.
+
+        Returns
+        -------
+        values : np.array
+            A 1D array with the current value of every entry in the
+            parameter_map, or self.override if it is not None.
+        """
+        if self.override is not None:
+            return self.override
+
+        values = self._template.copy()
+        for index, obj, attribute in self._sources:
+            values[index] = getattr(obj, attribute)
+
+        return values
+
+    def resolve(self, values):
+        """
+        Convert a values vector into the equivalent parameter dictionary.
+
+        Parameters
+        ----------
+        values : np.array
+            A values vector, as returned by self.read.
+
+        Returns
+        -------
+        parameters : dict
+            A dictionary mapping the xrt parameter names to their values (a
+            tuple for 'center', 'angles' and any other dictionary entries).
+        """
+        out = {}
+        for key in self.keys:
+            if self._nested[key]:
+                out[key] = tuple(values[self.slices[key]].tolist())
+            else:
+                out[key] = values[self.slices[key]][0].item()
+
+        return out
+
+    def changed(self, values):
+        """
+        Return True if values differs from the last applied values.
+
+        Parameters
+        ----------
+        values : np.array
+            A values vector, as returned by self.read.
+
+        Returns
+        -------
+        changed : Boolean
+            True if self.apply has not been called or values differs from
+            the values it was last called with.
+        """
+        return self.last is None or not np.array_equal(values, self.last)
+
+    def _xrt_items(self, key, section):
+        """
+        Return the (xrt attribute, value) pairs for the section of key.
+        """
+        if key == 'center':
+            center = self._transform.dot(section) + self._offset
+            return [('center', tuple(center.tolist()))]
+        elif key == 'angles':
+            return list(zip(_angles, section.tolist()))
+        elif self._nested[key]:
+            return [(key, tuple(section.tolist()))]
+        else:
+            return [(key, section[0].item())]
+
+    def xrt_parameters(self, values):
+        """
+        Return the xrt attribute values that self.apply would set.
+
+        This allows the xrt geometry for a values vector to be found without
+        modifying the component (i.e. by an ID29Source whose sampling depends
+        on the geometry of a downstream optic).
+
+        Parameters
+        ----------
+        values : np.array
+            A values vector, as returned by self.read.
+
+        Returns
+        -------
+        parameters : dict
+            A dictionary mapping the xrt attribute names (i.e. 'center',
+            'pitch', 'roll' and 'yaw') to their values, 'center' is in XRT
+            coordinates.
+        """
+        out = {}
+        for key in self.keys:
+            out.update(self._xrt_items(key, values[self.slices[key]]))
+
+        return out
+
+    def apply(self, obj, values):
+        """
+        Set the xrt parameters of obj from values if they have changed.
+
+        Only the parameters whose slice of values differs from the last
+        applied values are set. The 'center' parameter is converted to XRT
+        coordinates using the precomputed transform and y offset.
+
+        Parameters
+        ----------
+        obj : object
+            The custom XRT object whose parameters are to be updated.
+        values : np.array
+            A values vector, as returned by self.read.
+
+        Returns
+        -------
+        updated : Boolean
+            True if any of the parameters were changed.
+        """
+        if not self.changed(values):
+            return False
+
+        for key in self.keys:
+            section = values[self.slices[key]]
+            if (self.last is not None and
+                    np.array_equal(section, self.last[self.slices[key]])):
+                continue
+            for attribute, value in self._xrt_items(key, section):
+                setattr(obj, attribute, value)
+
+        self.last = values.copy()
+
+        return True
+
+
+class ParameterBank:
+    """
+    A collection of ParameterMaps that can be checked for changes at once.
+
+    This is used by AriModel to find out which components have had parameter
+    changes with one read of all of the sources and a single vectorized
+    comparison against the values from the previous check.
+
+    Parameters
+    ----------
+    maps : list
+        The ParameterMap instances to include, in order.
+
+    Attributes
+    ----------
+    last : np.array or None
+        The concatenated values committed by the last call to self.changed
+        (or self.commit).
+
+    Methods
+    -------
+    read() :
+        Return the concatenated values vector of all of the maps.
+    changed(values, commit=True) :
+        Return a boolean array indicating which maps have changed values.
+    commit(values) :
+        Store values as the reference for the next call to self.changed.
+    """
+    def __init__(self, maps):
+        self.maps = list(maps)
+        sizes = [parameter_map.size for parameter_map in self.maps]
+        self._bounds = np.concatenate(([0], np.cumsum(sizes))).astype(int)
+        self.last = None
+
+    def read(self):
+        """
+        Return the concatenated values vector of all of the maps.
+
+        Returns
+        -------
+        values : np.array
+            The concatenation of the self.read() output of each map.
+        """
+        if not self.maps:
+            return np.zeros(0)
+
+        return np.concatenate([parameter_map.read()
+                               for parameter_map in self.maps])
+
+    def split(self, values):
+        """
+        Split a concatenated values vector into the values for each map.
+
+        Parameters
+        ----------
+        values : np.array
+            A values vector, as returned by self.read.
+
+        Returns
+        -------
+        values : list
+            A list with the values vector for each map.
+        """
+        return [values[start:stop]
+                for start, stop in zip(self._bounds[:-1], self._bounds[1:])]
+
+    def changed(self, values, commit=True):
+        """
+        Return a boolean array indicating which maps have changed values.
+
+        The comparison is made against the last committed values, which are
+        then replaced by values if commit is True.
+
+        Parameters
+        ----------
+        values : np.array
+            A values vector, as returned by self.read.
+        commit : Boolean
+            If True (the default) values are committed as the reference for
+            the next call. If False the caller should call self.commit(values)
+            once the changes have been successfully applied, so that they are
+            reported again if applying them fails.
+
+        Returns
+        -------
+        changed : np.array
+            A boolean array with True for each map whose values differ from
+            the previous call (all True on the first call).
+        """
+        if self.last is None or len(self.last) != len(values):
+            changed = np.ones(len(self.maps), dtype=bool)
+        else:
+            # a cumulative sum handles maps with no values (empty slices)
+            count = np.concatenate(([0], np.cumsum(values != self.last)))
+            changed = count[self._bounds[1:]] > count[self._bounds[:-1]]
+        if commit:
+            self.commit(values)
+
+        return changed
+
+    def commit(self, values):
+        """
+        Store values as the reference for the next call to self.changed.
+
+        Parameters
+        ----------
+        values : np.array
+            A values vector, as returned by self.read.
+        """
+        self.last = values.copy()
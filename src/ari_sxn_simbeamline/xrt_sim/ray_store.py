@@ -0,0 +1,173 @@
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import xrt.backends.raycing.sources_beams as xrt_beam
+
+# The source attributes that the output of GeometricSource.shine depends on.
+source_attributes = ('nrays', 'distx', 'dx', 'disty', 'dy', 'distz', 'dz',
+                     'distxprime', 'dxprime', 'distzprime', 'dzprime',
+                     'distE', 'energies', 'energyWeights', 'polarization',
+                     'filamentBeam', 'uniformRayDensity', 'center', 'pitch',
+                     'roll', 'yaw', 'sampling', 'acceptance_window')
+
+# Incremented whenever the stored layout changes, to invalidate old entries.
+_store_version = 1
+
+
+def _jsonable(value):
+    """
+    Convert a source attribute value to something json.dumps can encode.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.generic,)):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(val) for val in value]
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    return repr(value)
+
+
+class RayStore:
+    """
+    A persistent, memory-mapped, on-disk store of generated source rays.
+
+    The beamOut of an ID29Source is saved as one .npy file per Beam array in a
+    sub-directory of directory named after a hash of the source configuration
+    and the random seed used to generate it. Later calls to self.load (i.e.
+    on the next IOC start) map these files with np.load(mmap_mode='c')
+    instead of re-running shine. The mapping is copy-on-write, so components
+    that modify the arrays (i.e. the apertures setting beam.state) only
+    copy the pages they modify and several processes share the rest.
+
+    Parameters
+    ----------
+    directory : str
+        The directory holding the stored rays, it is created if required.
+
+    Attributes
+    ----------
+    hits : int
+        The number of self.load calls that found stored rays.
+    misses : int
+        The number of self.load calls that did not find stored rays.
+
+    Methods
+    -------
+    key(source, seed) :
+        Return the key for the rays generated by source with seed.
+    load(key) :
+        Return the stored Beam object for key, or None if there isn't one.
+    save(key, beam) :
+        Store the arrays of a Beam object under key.
+    clear() :
+        Remove all of the stored rays.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, seed):
+        """
+        Return the key for the rays generated by source with seed.
+
+        Parameters
+        ----------
+        source : ID29Source
+            The source, the attributes in source_attributes are used.
+        seed : int
+            The seed of the numpy random state used to generate the rays.
+
+        Returns
+        -------
+        key : str
+            The sha256 hex digest of the source configuration and seed.
+        """
+        config = {attribute: _jsonable(getattr(source, attribute, None))
+                  for attribute in source_attributes}
+        config.update({'class': type(source).__name__, 'seed': int(seed),
+                       'version': _store_version})
+        text = json.dumps(config, sort_keys=True)
+
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def load(self, key):
+        """
+        Return the stored Beam object for key, or None if there isn't one.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by self.key.
+
+        Returns
+        -------
+        beam : Beam object or None
+            A Beam object whose arrays are copy-on-write memory maps of the
+            stored files.
+        """
+        path = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(path, 'attributes.json')) as file:
+                attributes = json.load(file)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        beam = xrt_beam.Beam(nrays=0)
+        beam.__dict__.update(attributes['scalars'])
+        for name in attributes['arrays']:
+            setattr(beam, name, np.load(os.path.join(path, f'{name}.npy'),
+                                        mmap_mode='c'))
+        self.hits += 1
+
+        return beam
+
+    def save(self, key, beam):
+        """
+        Store the arrays of a Beam object under key.
+
+        The files are written to a temporary directory that is then renamed,
+        so a concurrent self.load never sees a partially written entry.
+
+        Parameters
+        ----------
+        key : str
+            The key returned by self.key.
+        beam : Beam object
+            The beam to store.
+        """
+        path = os.path.join(self.directory, key)
+        if os.path.exists(path):
+            return
+
+        temp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        attributes = {'arrays': [], 'scalars': {}}
+        for name, value in beam.__dict__.items():
+            if isinstance(value, np.ndarray):
+                np.save(os.path.join(temp, f'{name}.npy'), value)
+                attributes['arrays'].append(name)
+            elif isinstance(value, (bool, int, float, str, np.generic)):
+                attributes['scalars'][name] = _jsonable(value)
+        with open(os.path.join(temp, 'attributes.json'), 'w') as file:
+            json.dump(attributes, file)
+
+        try:
+            os.rename(temp, path)
+        except OSError:  # another process stored the same rays first
+            shutil.rmtree(temp, ignore_errors=True)
+
+    def clear(self):
+        """
+        Remove all of the stored rays.
+        """
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name),
+                          ignore_errors=True)
@@ -0,0 +1,241 @@
+from binning import BeamBinner
+import numpy as np
+
+# The XRT ray states counted as 'good' (1 = good, 2 = out of optical area).
+good_states = (1, 2)
+
+
+def _good(beam):
+    """
+    Return a boolean mask of the good rays in a Beam object.
+    """
+    return (beam.state == good_states[0]) | (beam.state == good_states[1])
+
+
+def _intensity(beam):
+    """
+    Return the intensity (Jss + Jpp) of each ray in a Beam object.
+    """
+    return beam.Jss + beam.Jpp
+
+
+class Flux:
+    """
+    A reducer returning the total intensity of the good rays in a beam.
+
+    Reducers are picklable callables that take an AriModel instance and
+    return a numpy array. The returned values are additive, so the results
+    from independently traced ray chunks can be combined by summing them (see
+    AriModel.trace_parallel). Some reducers (i.e. Histogram and BladeFlux)
+    re-use their output array, overwriting it on the next call, so callers
+    that keep the outputs of several calls must copy them.
+
+    Parameters
+    ----------
+    component : str
+        The name of the AriModel component whose beamOut is used.
+    """
+    def __init__(self, component):
+        self.component = component
+
+    def __call__(self, model):
+        beam = getattr(model, self.component).beamOut
+        good = _good(beam)
+
+        return np.array(_intensity(beam)[good].sum())
+
+
+class Histogram:
+    """
+    A reducer returning a histogram of the good rays in a beam.
+
+    The BeamBinner (see binning.py) and the output array are kept between
+    calls, the histogram is re-calculated in place in the output array on
+    each call.
+
+    Parameters
+    ----------
+    component : str
+        The name of the AriModel component whose beamOut is used.
+    fields : tuple of str
+        The Beam attributes to histogram, i.e. ('x', 'z') (by default).
+    bins : tuple of int
+        The number of bins along each field, i.e. (100, 100) (by default).
+    output_range : tuple of tuples
+        The (min, max) range of the histogram along each field, i.e.
+        ((-10, 10), (-10, 10)) (by default).
+    weighted : Boolean
+        If True (the default) each ray is weighted by its intensity,
+        otherwise the rays are counted.
+    """
+    def __init__(self, component, fields=('x', 'z'), bins=(100, 100),
+                 output_range=((-10, 10), (-10, 10)), weighted=True):
+        self.component = component
+        self.fields = tuple(fields)
+        self.bins = tuple(bins)
+        self.output_range = tuple(output_range)
+        self.weighted = weighted
+        self._binner = None
+        self._out = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the scratch and output arrays are not sent to workers
+        state['_binner'] = state['_out'] = None
+        return state
+
+    def __call__(self, model):
+        if self._binner is None:
+            self._binner = BeamBinner(self.bins, self.output_range,
+                                      fields=self.fields)
+            self._out = np.zeros(self._binner.shape)
+        else:
+            self._out.fill(0)
+        beam = getattr(model, self.component).beamOut
+        weights = _intensity(beam) if self.weighted else None
+
+        return self._binner.bin(beam, weights=weights, mask=_good(beam),
+                                out=self._out)
+
+
+class Transmission:
+    """
+    A reducer returning the flux into and out of a component.
+
+    The output is the 2 element array [flux in, flux out] of the good rays in
+    the components beamIn and beamOut. These are additive, the transmission
+    of the component is output[1] / output[0].
+
+    Parameters
+    ----------
+    component : str
+        The name of the AriModel component to use.
+    """
+    def __init__(self, component):
+        self.component = component
+
+    def __call__(self, model):
+        obj = getattr(model, self.component)
+        flux = []
+        for beam in (obj.beamIn, obj.beamOut):
+            good = _good(beam)
+            flux.append(_intensity(beam)[good].sum())
+
+        return np.array(flux)
+
+
+class Moments:
+    """
+    A reducer returning the intensity weighted moments of the good rays.
+
+    The output is the 3 element array [sum(I), sum(I * x), sum(I * z)] (for
+    the default fields) of the good rays in the components beamOut. These are
+    additive, the (x, z) centroid of the beam is output[1:] / output[0].
+
+    Parameters
+    ----------
+    component : str
+        The name of the AriModel component whose beamOut is used.
+    fields : tuple of str
+        The Beam attributes to find the moments of, i.e. ('x', 'z') (by
+        default).
+    """
+    def __init__(self, component, fields=('x', 'z')):
+        self.component = component
+        self.fields = tuple(fields)
+
+    def __call__(self, model):
+        beam = getattr(model, self.component).beamOut
+        good = _good(beam)
+        intensity = _intensity(beam)[good]
+        moments = [intensity.sum()]
+        moments.extend(intensity.dot(getattr(beam, field)[good])
+                       for field in self.fields)
+
+        return np.array(moments)
+
+
+class BladeFlux:
+    """
+    A reducer returning the flux absorbed by each blade of an aperture.
+
+    The rays absorbed by the aperture (those whose state is its lostNum) are
+    assigned to the blade they are furthest beyond, using their local
+    coordinates in the aperture plane, and their intensities are summed per
+    blade into an output array kept between calls.
+
+    Parameters
+    ----------
+    component : str
+        The name of an AriModel ID29Aperture component.
+
+    Returns
+    -------
+    flux : np.array
+        The absorbed flux for each blade, in the order of the apertures 'kind'
+        attribute, i.e. ['left', 'right', 'bottom', 'top'].
+    """
+    def __init__(self, component):
+        self.component = component
+        self._out = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_out'] = None  # the output array is not sent to workers
+        return state
+
+    def __call__(self, model):
+        aperture = getattr(model, self.component)
+        if self._out is None or len(self._out) != len(aperture.kind):
+            self._out = np.zeros(len(aperture.kind))
+        else:
+            self._out.fill(0)
+
+        return blade_flux(aperture, aperture.beamOut, out=self._out)
+
+
+def blade_flux(aperture, beam, out=None):
+    """
+    Return (or accumulate into out) the flux absorbed by each blade.
+
+    Parameters
+    ----------
+    aperture : ID29Aperture
+        The aperture, its kind, opening and lostNum attributes are used.
+    beam : Beam object
+        The output of aperture.propagate (in the aperture local coordinates).
+    out : np.array, optional
+        A float array with an element for each blade to add the flux to in
+        place.
+
+    Returns
+    -------
+    flux : np.array
+        The absorbed flux for each blade, in the order of aperture.kind, this
+        is out if it was given.
+    """
+    lost = beam.state == aperture.lostNum
+    x, z = beam.x[lost], beam.z[lost]
+    excess = np.empty((len(aperture.kind), len(x)))
+    for i, (kind, opening) in enumerate(zip(aperture.kind, aperture.opening)):
+        if kind.startswith('l'):
+            excess[i] = opening - x
+        elif kind.startswith('r'):
+            excess[i] = x - opening
+        elif kind.startswith('b'):
+            excess[i] = opening - z
+        elif kind.startswith('t'):
+            excess[i] = z - opening
+        else:  # xrt ignores any other kind, so it can't absorb any rays
+            excess[i] = -np.inf
+    blade = excess.argmax(axis=0) if len(x) else np.zeros(0, dtype=int)
+    weights = _intensity(beam)[lost]
+    if len(x):
+        weights = np.where(np.isinf(excess.max(axis=0)), 0, weights)
+
+    if out is None:  # a new array, allocated by np.bincount
+        return np.bincount(blade, weights=weights,
+                           minlength=len(aperture.kind))
+    np.add.at(out, blade, weights)
+
+    return out
@@ -0,0 +1,310 @@
+import hashlib
+import json
+import numpy as np
+import os
+import xrt
+
+# The material kinds whose amplitudes depend only on E and |beamInDotNormal|.
+tabulated_kinds = ('mirror', 'thin mirror', 'grating')
+
+
+def _locate(E, cos, energies, cosines):
+    """
+    Return the grid cell and bilinear weights for each (E, cos) point.
+
+    Parameters
+    ----------
+    E, cos : np.array
+        The 1D arrays of points to locate, all inside the grid.
+    energies, cosines : np.array
+        The uniformly spaced grid values along each axis.
+
+    Returns
+    -------
+    i : np.array
+        The index of the lower grid point along the energy axis.
+    k : np.array
+        The flat index of the lower (E, cos) grid point in the 2D tables.
+    fraction_E : np.array
+        The fractional position of each point between the energy grid points.
+    weights : tuple
+        The weights of the (i, j), (i, j+1), (i+1, j) and (i+1, j+1) points.
+    """
+    position_E = (E - energies[0]) * ((len(energies) - 1) /
+                                      (energies[-1] - energies[0]))
+    position_c = (cos - cosines[0]) * ((len(cosines) - 1) /
+                                       (cosines[-1] - cosines[0]))
+    i = np.minimum(position_E.astype(np.intp), len(energies) - 2)
+    j = np.minimum(position_c.astype(np.intp), len(cosines) - 2)
+    fraction_E = position_E - i
+    fraction_c = position_c - j
+
+    w11 = fraction_E * fraction_c
+    w10 = fraction_E - w11
+    w01 = fraction_c - w11
+    w00 = 1 - fraction_E - w01
+
+    return i, i * len(cosines) + j, fraction_E, (w00, w01, w10, w11)
+
+
+def _bilinear(table, k, weights):
+    """
+    Bilinearly interpolate a 2D (E, cos) table using the _locate output.
+
+    The corner values are gathered with np.take on the flattened table, which
+    is much faster than 2D fancy indexing.
+    """
+    flat = table.ravel()
+    n_c = table.shape[1]
+    values = np.take(flat, k)
+    values *= weights[0]
+    for offset, weight in zip((1, n_c, n_c + 1), weights[1:]):
+        corner = np.take(flat, k + offset)
+        corner *= weight
+        values += corner
+
+    return values
+
+
+def _linear(table, i, fraction_E):
+    """
+    Linearly interpolate a 1D (E) table using the _locate output.
+    """
+    low = np.take(table, i)
+
+    return low + (np.take(table, i + 1) - low) * fraction_E
+
+
+class TabulatedMaterial:
+    """
+    A drop-in wrapper for an XRT Material using tabulated reflectivities.
+
+    The s and p amplitudes returned by material.get_amplitude are computed
+    once on a uniform (E, |beamInDotNormal|) grid covering energy_range and
+    cos_range, and are then bilinearly interpolated for each ray. The grid
+    starts with 17 points along each axis and the number of points along an
+    axis is doubled until the interpolation error at the midpoints between
+    grid points is below tolerance (or max_points is reached). The tables can
+    be saved to (and loaded from) cache_dir, keyed by a hash of the material
+    and the table settings. Rays outside of the table, calls with
+    fromVacuum=False and material kinds other than those in tabulated_kinds
+    use the exact material.get_amplitude. All other attributes (i.e. kind or
+    efficiency) are those of material, so gratings with an efficiency still
+    use material.get_grating_efficiency.
+
+    Parameters
+    ----------
+    material : xrt.backends.raycing.materials.Material
+        The material to wrap.
+    energy_range : tuple
+        The (min, max) energy range of the table, in eV.
+    cos_range : tuple
+        The (min, max) range of |beamInDotNormal| of the table, the default
+        (0, 0.2) covers grazing angles up to ~11.5 degrees.
+    tolerance : float
+        The maximum absolute interpolation error of the complex amplitudes,
+        the default is 1E-4.
+    cache_dir : str, optional
+        The directory to save the tables to and load them from. The default,
+        None, computes the tables each time.
+    max_points : int
+        The maximum number of grid points along each axis, the default is
+        1025.
+
+    Attributes
+    ----------
+    energies : np.array
+        The energy grid of the table.
+    cosines : np.array
+        The |beamInDotNormal| grid of the table.
+    error : float
+        The maximum midpoint interpolation error of the table.
+
+    Methods
+    -------
+    get_amplitude(E, beamInDotNormal, fromVacuum=True) :
+        Return the amplitudes, as for material.get_amplitude.
+    """
+    def __init__(self, material, energy_range, cos_range=(0, 0.2),
+                 tolerance=1E-4, cache_dir=None, max_points=1025):
+        self.material = material
+        self.energy_range = tuple(float(value) for value in energy_range)
+        self.cos_range = tuple(float(value) for value in cos_range)
+        self.tolerance = tolerance
+        self.cache_dir = cache_dir
+        self.max_points = max_points
+
+        path = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            path = os.path.join(cache_dir, f'{self._key()}.npz')
+        if path is not None and os.path.exists(path):
+            with np.load(path) as tables:
+                self._set_tables(**tables)
+        else:
+            self._set_tables(**self._compute_tables())
+            if path is not None:
+                temp = f'{path}.{os.getpid()}.tmp.npz'
+                np.savez(temp, **self._tables())
+                os.replace(temp, path)
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the wrapper itself
+        if name == 'material':
+            raise AttributeError(name)
+        return getattr(self.material, name)
+
+    def _key(self):
+        """
+        Return a hash of the material and the table settings.
+        """
+        material = self.material
+        config = {'name': material.name, 'kind': material.kind,
+                  'rho': material.rho, 't': material.t,
+                  'quantities': list(material.quantities),
+                  'elements': [(element.name, element.table)
+                               for element in material.elements],
+                  'energy_range': self.energy_range,
+                  'cos_range': self.cos_range, 'tolerance': self.tolerance,
+                  'max_points': self.max_points, 'xrt': xrt.__version__}
+        text = json.dumps(config, sort_keys=True, default=repr)
+
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _exact(self, E, cos):
+        """
+        Return the exact (rs, rp, mu, phase) for each (E, cos) point.
+        """
+        return self.material.get_amplitude(E, cos)
+
+    def _grid(self, energies, cosines):
+        """
+        Return the exact rs and rp tables, and the E only terms, on a grid.
+        """
+        E, cos = np.meshgrid(energies, cosines, indexing='ij')
+        rs, rp, mu, phase = self._exact(E.ravel(), cos.ravel())
+        shape = E.shape
+
+        return (rs.reshape(shape), rp.reshape(shape),
+                np.reshape(mu, shape)[:, 0], np.reshape(phase, shape)[:, 0])
+
+    def _error(self, tables, energies, cosines):
+        """
+        Return the max interpolation error of tables on a grid of points.
+        """
+        rs, rp, _, _ = self._grid(energies, cosines)
+        E, cos = np.meshgrid(energies, cosines, indexing='ij')
+        _, k, _, weights = _locate(E.ravel(), cos.ravel(), tables[4],
+                                   tables[5])
+        error = 0.0
+        for table, exact in zip(tables[:2], (rs, rp)):
+            interpolated = _bilinear(table, k, weights)
+            error = max(error, np.abs(interpolated - exact.ravel()).max())
+
+        return error
+
+    def _compute_tables(self):
+        """
+        Compute the tables, refining the grid until within tolerance.
+        """
+        n_E = n_c = 17
+        while True:
+            energies = np.linspace(*self.energy_range, n_E)
+            cosines = np.linspace(*self.cos_range, n_c)
+            tables = self._grid(energies, cosines) + (energies, cosines)
+            mid_E = (energies[:-1] + energies[1:]) / 2
+            mid_c = (cosines[:-1] + cosines[1:]) / 2
+            error_E = self._error(tables, mid_E, cosines)
+            error_c = self._error(tables, energies, mid_c)
+            error = max(error_E, error_c,
+                        self._error(tables, mid_E, mid_c))
+
+            refine_E = error_E > self.tolerance / 2 or error > self.tolerance
+            refine_c = error_c > self.tolerance / 2 or error > self.tolerance
+            refine_E = refine_E and n_E < self.max_points
+            refine_c = refine_c and n_c < self.max_points
+            if not (refine_E or refine_c):
+                break
+            n_E = 2 * n_E - 1 if refine_E else n_E
+            n_c = 2 * n_c - 1 if refine_c else n_c
+
+        rs, rp, mu, phase, energies, cosines = tables
+
+        return {'rs': rs, 'rp': rp, 'mu': mu, 'phase': phase,
+                'energies': energies, 'cosines': cosines,
+                'error': np.array(error)}
+
+    def _set_tables(self, rs, rp, mu, phase, energies, cosines, error):
+        """
+        Set the table attributes.
+        """
+        self.energies, self.cosines = np.asarray(energies), np.asarray(cosines)
+        self.error = float(error)
+        self._rs, self._rp = np.ascontiguousarray(rs), np.ascontiguousarray(rp)
+        self._mu, self._phase = np.asarray(mu), np.asarray(phase)
+
+    def _tables(self):
+        """
+        Return the tables as a dictionary, for saving with np.savez.
+        """
+        return {'rs': self._rs, 'rp': self._rp, 'mu': self._mu,
+                'phase': self._phase, 'energies': self.energies,
+                'cosines': self.cosines,
+                'error': np.array(self.error)}
+
+    def _interpolate(self, E, cos):
+        """
+        Return the interpolated (rs, rp, mu, phase) for points in the table.
+        """
+        i, k, fraction_E, weights = _locate(E, cos, self.energies,
+                                            self.cosines)
+
+        return (_bilinear(self._rs, k, weights),
+                _bilinear(self._rp, k, weights),
+                _linear(self._mu, i, fraction_E),
+                _linear(self._phase, i, fraction_E))
+
+    def get_amplitude(self, E, beamInDotNormal, fromVacuum=True):
+        """
+        Return the amplitudes, as for material.get_amplitude.
+
+        Parameters
+        ----------
+        E : float or np.array
+            The energy of each ray, in eV.
+        beamInDotNormal : float or np.array
+            The cosine of the angle between each ray and the surface normal.
+        fromVacuum : Boolean
+            The direction of the interface, only True is tabulated.
+
+        Returns
+        -------
+        amplitudes : tuple
+            The (rs, rp, absorption coefficient, phase term) for each ray.
+        """
+        if not fromVacuum or self.material.kind not in tabulated_kinds:
+            return self.material.get_amplitude(E, beamInDotNormal, fromVacuum)
+
+        E, cos = np.broadcast_arrays(np.asarray(E, dtype=float),
+                                     np.abs(beamInDotNormal))
+        shape = E.shape
+        E, cos = E.ravel(), cos.ravel()
+        inside = ((E >= self.energies[0]) & (E <= self.energies[-1]) &
+                  (cos >= self.cosines[0]) & (cos <= self.cosines[-1]))
+
+        if inside.all():
+            rs, rp, mu, phase = self._interpolate(E, cos)
+        else:  # use the exact amplitudes for the rays outside of the table
+            rs = np.empty(len(E), dtype=complex)
+            rp = np.empty(len(E), dtype=complex)
+            mu, phase = np.empty(len(E)), np.empty(len(E))
+            outside = ~inside
+            interpolated = self._interpolate(E[inside], cos[inside])
+            exact = self._exact(E[outside], cos[outside])
+            for array, inner, outer in zip((rs, rp, mu, phase),
+                                           interpolated, exact):
+                array[inside] = inner
+                array[outside] = outer
+
+        return (rs.reshape(shape), rp.reshape(shape), mu.reshape(shape),
+                phase.reshape(shape))
@@ -0,0 +1,379 @@
+from bisect import bisect_right
+import numpy as np
+from scipy.interpolate import LinearNDInterpolator
+from scipy.stats import qmc
+
+
+def _resolve(model, name):
+    """
+    Return the (object, attribute name) pair for a dotted input name.
+
+    Parameters
+    ----------
+    model : AriModel
+        The model the name is relative to.
+    name : str
+        The dotted path to the input attribute, i.e. 'mirror1.Ry_fine' or
+        'mirror1.baffles.top'.
+
+    Returns
+    -------
+    pair : tuple
+        The (object, attribute name) pair, as used by AriModel.scan.
+    """
+    *path, attribute = name.split('.')
+    obj = model
+    for item in path:
+        obj = getattr(obj, item)
+
+    return obj, attribute
+
+
+def build_surrogate(model, axes, reducers, method='grid', npoints=None,
+                    max_workers=None, seed=None):
+    """
+    Sample an AriModel over a region of its input space to build a Surrogate.
+
+    The model is evaluated, using AriModel.scan (in parallel by default), at
+    each point of a regular grid or of a Latin hypercube sample of the input
+    attributes (i.e. the TestM1 and Test4Slit attributes) and the reducer
+    outputs are stored in the returned Surrogate.
+
+    Parameters
+    ----------
+    model : AriModel
+        The model to sample.
+    axes : dict
+        A dictionary mapping dotted input names, relative to model (i.e.
+        'mirror1.Ry_fine' or 'mirror1.baffles.top'), to a 1D array of values
+        if method is 'grid' or to a (min, max) tuple if method is 'lhs'.
+    reducers : dict
+        A dictionary mapping output names to reducers (see reducers.py).
+    method : str
+        'grid' (the default) evaluates every combination of the axes values,
+        'lhs' evaluates a Latin hypercube sample of npoints points.
+    npoints : int, optional
+        The number of points for the 'lhs' method.
+    max_workers : int, optional
+        The number of worker processes used by AriModel.scan, the default,
+        None, uses the number of CPUs and 0 evaluates in this process. The
+        workers trace a model with the configuration and source settings of
+        model (see AriModel.spec).
+    seed : int, optional
+        The seed for the Latin hypercube sample and for the source rays.
+
+    Returns
+    -------
+    surrogate : Surrogate
+        The surrogate, whose fallback uses model.
+    """
+    names = list(axes.keys())
+    pairs = [_resolve(model, name) for name in names]
+
+    if method == 'grid':
+        values = [np.unique(np.asarray(axes[name], dtype=float))
+                  for name in names]
+        outputs = model.scan(dict(zip(pairs, values)), reducers, grid=True,
+                             max_workers=max_workers, seed=seed)
+        return Surrogate(names, outputs, axes=values, reducers=reducers,
+                         model=model)
+    elif method == 'lhs':
+        if npoints is None:
+            raise ValueError("npoints is required for the 'lhs' method")
+        bounds = np.array([axes[name] for name in names], dtype=float)
+        sample = qmc.LatinHypercube(d=len(names), seed=seed).random(npoints)
+        points = qmc.scale(sample, bounds[:, 0], bounds[:, 1])
+        outputs = model.scan(dict(zip(pairs, points.T)), reducers,
+                             grid=False, max_workers=max_workers, seed=seed)
+        return Surrogate(names, outputs, points=points, reducers=reducers,
+                         model=model)
+    else:
+        raise ValueError(f"method must be 'grid' or 'lhs', got {method}")
+
+
+class Surrogate:
+    """
+    An interpolated response surface of reducer outputs over input space.
+
+    Answers queries for the reducer outputs at a set of input values (i.e.
+    the blade currents and diagnostic centroid at a set of M1 motor
+    positions) by interpolating the outputs stored by build_surrogate,
+    multi-linearly for a regular grid or linearly over a Delaunay
+    triangulation for scattered (Latin hypercube) points. Queries outside of
+    the sampled domain fall back to a full trace of model, if it is set.
+
+    Parameters
+    ----------
+    names : list of str
+        The dotted input names (relative to model), in the order of the axes.
+    outputs : dict
+        A dictionary mapping output names to arrays of the reducer outputs
+        with a shape of grid shape + output shape (if axes is given) or
+        (npoints,) + output shape (if points is given).
+    axes : list of np.array, optional
+        The ascending grid values along each input axis.
+    points : np.array, optional
+        The (npoints, len(names)) array of scattered input values.
+    reducers : dict, optional
+        The reducers used to build outputs, used for the full trace fallback.
+    model : AriModel, optional
+        The model used for the full trace fallback and to read the current
+        input values. If None, queries outside of the domain raise a
+        ValueError.
+
+    Attributes
+    ----------
+    hits : int
+        The number of queries answered by interpolation.
+    fallbacks : int
+        The number of queries answered by a full trace of model.
+
+    Methods
+    -------
+    inside(point) :
+        Return True if point is inside the sampled domain.
+    __call__(point=None) :
+        Return the outputs at point (default: the current model inputs).
+    save(path) :
+        Save the surrogate to a .npz file.
+    load(path, model=None) :
+        A classmethod returning a surrogate loaded from a .npz file.
+    """
+    def __init__(self, names, outputs, axes=None, points=None, reducers=None,
+                 model=None):
+        if (axes is None) == (points is None):
+            raise ValueError('Exactly one of axes or points is required')
+        self.names = list(names)
+        self.outputs = {name: np.asarray(value)
+                        for name, value in outputs.items()}
+        self.reducers = reducers
+        self.model = model
+        self.hits = 0
+        self.fallbacks = 0
+
+        if points is not None and len(self.names) == 1:
+            # a 1D scattered sample is a grid once sorted
+            order = np.argsort(points[:, 0])
+            axes = [np.asarray(points[order, 0], dtype=float)]
+            self.outputs = {name: value[order]
+                            for name, value in self.outputs.items()}
+            points = None
+        self.axes = None if axes is None else [np.asarray(axis, dtype=float)
+                                               for axis in axes]
+        self.points = None if points is None else np.asarray(points,
+                                                             dtype=float)
+        self._build_interpolator()
+
+    def _build_interpolator(self):
+        """
+        Build a single interpolator returning all of the outputs at once.
+        """
+        npoints = (len(self.points) if self.axes is None else
+                   int(np.prod([len(axis) for axis in self.axes])))
+        self._shapes = {}
+        self._slices = {}
+        columns = []
+        start = 0
+        for name, value in self.outputs.items():
+            lead = 1 if self.axes is None else len(self.axes)
+            self._shapes[name] = value.shape[lead:]
+            flat = value.reshape(npoints, -1)
+            self._slices[name] = slice(start, start + flat.shape[1])
+            start += flat.shape[1]
+            columns.append(flat)
+        values = np.concatenate(columns, axis=1).astype(float)
+
+        if self.axes is not None:
+            self._lower = np.array([axis[0] for axis in self.axes])
+            self._upper = np.array([axis[-1] for axis in self.axes])
+            self._values = values.reshape(
+                tuple(len(axis) for axis in self.axes) + (-1,))
+            self._axes_lists = [axis.tolist() for axis in self.axes]
+            self._interpolator = self._grid_interpolate
+        else:
+            self._lower = self.points.min(axis=0)
+            self._upper = self.points.max(axis=0)
+            self._interpolator = LinearNDInterpolator(self.points, values,
+                                                      fill_value=np.nan)
+
+    def _grid_interpolate(self, points):
+        """
+        Multi-linearly interpolate the grid values at one (1, ndim) point.
+
+        This avoids the per-call overhead of the scipy interpolators, only the
+        2**ndim grid values surrounding the point are read.
+        """
+        point = points[0]
+        if np.any(point < self._lower) or np.any(point > self._upper):
+            return np.full((1, self._values.shape[-1]), np.nan)
+
+        index, fractions = [], []
+        for axis, value in zip(self._axes_lists, point.tolist()):
+            if len(axis) == 1:
+                index.append(slice(0, 1))
+                fractions.append(None)
+                continue
+            i = min(bisect_right(axis, value) - 1, len(axis) - 2)
+            index.append(slice(i, i + 2))
+            fractions.append((value - axis[i]) / (axis[i + 1] - axis[i]))
+
+        block = self._values[tuple(index)]
+        for fraction in fractions:
+            if fraction is None:
+                block = block[0]
+            else:
+                block = block[0] + (block[1] - block[0]) * fraction
+
+        return block[np.newaxis]
+
+    def _current(self):
+        """
+        Return the current values of the inputs of self.model.
+        """
+        if self.model is None:
+            raise ValueError('A point is required if model is None')
+
+        return np.array([getattr(*_resolve(self.model, name))
+                         for name in self.names], dtype=float)
+
+    def _as_point(self, point):
+        """
+        Convert a point (dict, sequence or None) to an array of input values.
+        """
+        if point is None:
+            return self._current()
+        if isinstance(point, dict):
+            return np.array([point[name] for name in self.names], dtype=float)
+
+        return np.asarray(point, dtype=float).reshape(len(self.names))
+
+    def inside(self, point):
+        """
+        Return True if point is inside the sampled domain.
+
+        Parameters
+        ----------
+        point : dict, sequence or None
+            A dictionary mapping the input names to values, a sequence of
+            values in the order of self.names, or None for the current model
+            inputs.
+
+        Returns
+        -------
+        inside : Boolean
+            True if the outputs at point can be interpolated.
+        """
+        point = self._as_point(point)
+        if np.any(point < self._lower) or np.any(point > self._upper):
+            return False
+
+        return not np.isnan(self._interpolator(point[np.newaxis])[0, 0])
+
+    def __call__(self, point=None):
+        """
+        Return the outputs at point (default: the current model inputs).
+
+        Parameters
+        ----------
+        point : dict, sequence or None
+            A dictionary mapping the input names to values, a sequence of
+            values in the order of self.names, or None for the current model
+            inputs.
+
+        Returns
+        -------
+        outputs : dict
+            A dictionary mapping the output names to their (interpolated or
+            traced) values.
+        """
+        given = point is not None
+        point = self._as_point(point)
+        values = None
+        if np.all(point >= self._lower) and np.all(point <= self._upper):
+            values = self._interpolator(point[np.newaxis])[0]
+            if np.isnan(values).any():  # outside of the convex hull
+                values = None
+
+        if values is None:
+            return self._trace(point if given else None)
+
+        self.hits += 1
+
+        return {name: values[self._slices[name]].reshape(self._shapes[name])
+                for name in self.outputs}
+
+    def _trace(self, point):
+        """
+        Return the outputs at point using a full trace of self.model.
+
+        The outputs are copied, as some reducers re-use their output array.
+        """
+        if self.model is None or self.reducers is None:
+            raise ValueError(f'{dict(zip(self.names, point))} is outside of '
+                             f'the surrogate domain and no model/reducers '
+                             f'are set for a full trace')
+        self.fallbacks += 1
+        if point is None:  # the model inputs are already at the point
+            self.model.activate()
+            return {name: np.array(reducer(self.model))
+                    for name, reducer in self.reducers.items()}
+
+        pairs = [_resolve(self.model, name) for name in self.names]
+        originals = [getattr(obj, attribute) for obj, attribute in pairs]
+        try:
+            for (obj, attribute), value in zip(pairs, point):
+                setattr(obj, attribute, value.item())
+            self.model.activate()
+            return {name: np.array(reducer(self.model))
+                    for name, reducer in self.reducers.items()}
+        finally:
+            for (obj, attribute), value in zip(pairs, originals):
+                setattr(obj, attribute, value)
+
+    def save(self, path):
+        """
+        Save the surrogate to a .npz file (the model is not saved).
+
+        Parameters
+        ----------
+        path : str
+            The file to save to.
+        """
+        arrays = {f'output_{name}': value
+                  for name, value in self.outputs.items()}
+        if self.axes is not None:
+            arrays.update({f'axis_{i}': axis
+                           for i, axis in enumerate(self.axes)})
+        else:
+            arrays['points'] = self.points
+        np.savez(path, names=np.array(self.names),
+                 reducers=np.array([self.reducers], dtype=object), **arrays)
+
+    @classmethod
+    def load(cls, path, model=None):
+        """
+        Return a surrogate loaded from a .npz file written by self.save.
+
+        Parameters
+        ----------
+        path : str
+            The file to load, it is unpickled so must be trusted.
+        model : AriModel, optional
+            The model used for the full trace fallback.
+
+        Returns
+        -------
+        surrogate : Surrogate
+            The loaded surrogate.
+        """
+        with np.load(path, allow_pickle=True) as data:
+            names = [str(name) for name in data['names']]
+            outputs = {key[len('output_'):]: data[key] for key in data.files
+                       if key.startswith('output_')}
+            axes = [data[f'axis_{i}'] for i in range(len(names))
+                    if f'axis_{i}' in data.files] or None
+            points = data['points'] if 'points' in data.files else None
+            reducers = data['reducers'][0]
+
+        return cls(names, outputs, axes=axes, points=points,
+                   reducers=reducers, model=model)
@@ -0,0 +1,20 @@
+"""
+Shared configuration for the unit tests.
+
+The xrt_sim and caproto_servers modules use flat imports (i.e. 'from
+custom_devices import ...'), so their directories are added to sys.path
+here, as is done for the benchmarks (see benchmarks/conftest.py).
+"""
+import os
+import sys
+
+# The directories holding the (flat imported) modules.
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                       'src', 'ari_sxn_simbeamline')
+xrt_sim_dir = os.path.abspath(os.path.join(src_dir, 'xrt_sim'))
+caproto_dir = os.path.abspath(os.path.join(src_dir, 'caproto_servers'))
+for path in (xrt_sim_dir, caproto_dir):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
@@ -0,0 +1,274 @@
+"""
+Tests of the area detector PVGroups in caproto_servers/area_detector.
+"""
+import asyncio
+import numpy as np
+import pytest
+
+pytest.importorskip('caproto')
+from caproto import ChannelType  # noqa: E402
+from caproto.asyncio.server import AsyncioAsyncLayer  # noqa: E402
+from area_detector.cam_plugin import CamPlugin  # noqa: E402
+from area_detector.nd_array_pool import NDArrayPool  # noqa: E402
+from area_detector.stats_plugin import StatsPlugin  # noqa: E402
+
+
+def gaussian_frame(shape, center, sigma, rho, peak=60000):
+    """
+    Return a UInt16 frame of a correlated 2D Gaussian beam.
+    """
+    y, x = np.mgrid[:shape[0], :shape[1]].astype(float)
+    u, v = (x - center[0]) / sigma[0], (y - center[1]) / sigma[1]
+    frame = peak * np.exp(-(u ** 2 - 2 * rho * u * v + v ** 2) /
+                          (2 * (1 - rho ** 2)))
+
+    return frame.astype(np.uint16)
+
+
+def reference_statistics(frame):
+    """
+    Return the StatsPlugin values calculated by brute force in float64.
+    """
+    weights = frame.astype(float)
+    y, x = np.mgrid[:frame.shape[0], :frame.shape[1]]
+    total = weights.sum()
+    centroid_x = (weights * x).sum() / total
+    centroid_y = (weights * y).sum() / total
+    sigma_x = np.sqrt((weights * (x - centroid_x) ** 2).sum() / total)
+    sigma_y = np.sqrt((weights * (y - centroid_y) ** 2).sum() / total)
+    cross = (weights * (x - centroid_x) * (y - centroid_y)).sum() / total
+
+    return {'total': total, 'mean_value': weights.mean(),
+            'sigma': weights.std(), 'centroid_x': centroid_x,
+            'centroid_y': centroid_y, 'sigma_x': sigma_x, 'sigma_y': sigma_y,
+            'sigma_xy': cross / (sigma_x * sigma_y)}
+
+
+@pytest.mark.parametrize(('data_type', 'native_type', 'dtype'),
+                         [('UInt8', ChannelType.CHAR, np.uint8),
+                          ('UInt16', ChannelType.INT, np.int16),
+                          ('Float32', ChannelType.FLOAT, np.float32)])
+def test_array_data_native_type_follows_data_type(data_type, native_type,
+                                                  dtype):
+    """
+    The ArrayData PV is served with the native type of the image data type,
+    with 'UInt16' images reinterpreted (not converted) as SHORT.
+    """
+    async def acquire():
+        cam = CamPlugin(prefix='TEST:')
+        publisher = asyncio.create_task(cam.array_data._server_startup(
+            AsyncioAsyncLayer()))
+        await cam.data_type_setpoint.write(data_type)
+        array = cam._alloc_frame()
+        await cam._generate_image(array.data)
+        image = array.data.copy()
+        await cam._publish(array)
+        while cam._published is not array:
+            await asyncio.sleep(0)
+        publisher.cancel()
+        _, native = await cam.array_data.read(native_type)
+        _, double = await cam.array_data.read(ChannelType.DOUBLE)
+
+        return cam, image, native, double
+
+    cam, image, native, double = asyncio.run(acquire())
+    assert cam.array_data.data_type == native_type
+    np.testing.assert_array_equal(native, image.ravel().view(dtype))
+    np.testing.assert_array_equal(double, image.ravel().view(dtype))
+
+
+def test_data_type_is_fixed_while_acquiring():
+    """
+    DataType can't be changed during an acquisition, only once it is done.
+    """
+    async def change():
+        cam = CamPlugin(prefix='TEST:')
+        await cam.acquire.readback.write(1)  # i.e. a running acquisition
+        with pytest.raises(ValueError, match='while acquiring'):
+            await cam.data_type_setpoint.write('Float32')
+        await cam.data_type_setpoint.write('UInt8')  # unchanged
+        rejected = cam.data_type.value
+        await cam.acquire.readback.write(0)
+        await cam.data_type_setpoint.write('Float32')
+
+        return rejected, cam.data_type.value
+
+    assert asyncio.run(change()) == ('UInt8', 'Float32')
+
+
+@pytest.mark.parametrize(('mode', 'frames'), [('Single', 1),
+                                              ('Multiple', 3)])
+def test_acquisition_produces_and_publishes_frames(mode, frames):
+    """
+    Each Acquire put produces the frames of the image mode, publishes the
+    last one to ArrayData and returns Acquire and DetectorState to idle.
+    """
+    async def acquire():
+        cam = CamPlugin(prefix='TEST:')
+        await cam.array_size0.write(8)
+        await cam.array_size1.write(10)
+        await cam.image_mode.setpoint.write(mode)
+        await cam.num_images.setpoint.write(3)
+        await cam.acquire_time.setpoint.write(0.0)
+        tasks = [asyncio.create_task(pvproperty._server_startup(
+            AsyncioAsyncLayer())) for pvproperty in (cam.acquire.readback,
+                                                     cam.array_data)]
+        await asyncio.sleep(0)  # the startup hooks create the Events
+        counters = []
+        for _ in range(2):  # back to back acquisitions
+            await cam.acquire.setpoint.write(1)
+            while cam.acquire.readback.value == 1:
+                await asyncio.sleep(0.001)
+            while cam._frame is not None:  # the last frame is being written
+                await asyncio.sleep(0.001)
+            counters.append(cam.array_counter.readback.value)
+        for task in tasks:
+            task.cancel()
+
+        return cam, counters
+
+    cam, counters = asyncio.run(acquire())
+    assert counters == [frames, frames]
+    assert cam.detector_state.value == 'idle'
+    assert cam.acquire_period.readback.value == 0
+    np.testing.assert_array_equal(cam.array_data.value,
+                                  cam._published.data.ravel())
+
+
+def test_continuous_acquisition_stops_on_acquire_0():
+    """
+    A 'Continuous' acquisition produces frames until Acquire is set to 0.
+    """
+    async def acquire():
+        cam = CamPlugin(prefix='TEST:')
+        await cam.array_size0.write(8)
+        await cam.array_size1.write(10)
+        await cam.image_mode.setpoint.write('Continuous')
+        await cam.acquire_time.setpoint.write(0.0)
+        task = asyncio.create_task(cam.acquire.readback._server_startup(
+            AsyncioAsyncLayer()))
+        await asyncio.sleep(0)
+        await cam.acquire.setpoint.write(1)
+        while cam.array_counter.readback.value < 5:
+            await asyncio.sleep(0.001)
+        await cam.acquire.setpoint.write(0)
+        while cam.detector_state.value != 'idle':
+            await asyncio.sleep(0.001)
+        counter = cam.array_counter.readback.value
+        await asyncio.sleep(0.05)  # no frames after the stop
+        task.cancel()
+
+        return counter, cam.array_counter.readback.value
+
+    counter, later = asyncio.run(acquire())
+    assert counter >= 5
+    assert later == counter
+
+
+def test_acquire_period_follows_the_timing_pvs():
+    """
+    AcquirePeriod is the time of all the exposures of all the images.
+    """
+    async def update():
+        cam = CamPlugin(prefix='TEST:')
+        await cam.acquire_time.setpoint.write(0.5)
+        await cam.num_exposures.setpoint.write(2)
+        await cam.num_images.setpoint.write(3)
+
+        return cam.acquire_period.readback.value
+
+    assert asyncio.run(update()) == pytest.approx(3.0)
+
+
+@pytest.mark.parametrize('frame', [
+    gaussian_frame((2048, 2448), (2000, 1900), (3, 2), 0.5),
+    gaussian_frame((256, 320), (100, 140), (40, 25), -0.3),
+    (np.random.default_rng(1).integers(0, 4096, (200, 300)) +
+     60000).astype(np.uint16)],
+    ids=['narrow', 'broad', 'pedestal'])
+def test_stats_match_numpy(frame):
+    """
+    The statistics and centroid match a float64 brute force calculation, also
+    for a narrow beam far from the origin (or a small spread on a large
+    pedestal) where the raw second moments cancel catastrophically.
+    """
+    async def process():
+        stats = StatsPlugin(prefix='TEST:')
+        array = NDArrayPool(max_memory=frame.nbytes).alloc(frame.shape,
+                                                           frame.dtype)
+        array.data[:] = frame
+        await stats._process_array(array)
+
+        return stats
+
+    stats = asyncio.run(process())
+    for name, value in reference_statistics(frame).items():
+        assert getattr(stats, name).value == pytest.approx(value, rel=1E-5,
+                                                           abs=1E-6), name
+
+
+def test_pool_reuses_memory_after_the_last_release():
+    """
+    The memory of an array only returns to the pool once every holder has
+    released it, and is then re-used for the next array.
+    """
+    pool = NDArrayPool(max_buffers=2)
+    array = pool.alloc((4, 5), np.uint16)
+    array.reserve()  # i.e. a plugin queue
+    assert array.reference_count == 2
+    array.release()
+    assert array.data is not None and pool.num_free == 0
+    array.release()
+    assert array.data is None and pool.num_free == 1
+
+    again = pool.alloc((2, 5), np.uint8)
+    assert (pool.num_buffers, pool.num_free) == (1, 0)
+    assert again.unique_id == array.unique_id + 1
+
+
+def test_pool_is_bounded():
+    """
+    A full pool returns None, and discards free buffers that are too small
+    to make room for a larger array.
+    """
+    pool = NDArrayPool(max_buffers=2, max_memory=1000)
+    first, second = pool.alloc((10,), np.uint8), pool.alloc((10,), np.uint8)
+    assert pool.alloc((10,), np.uint8) is None
+    first.release()
+    large = pool.alloc((100,), np.uint8)
+    assert large is not None
+    assert (pool.num_buffers, pool.num_free, pool.memory) == (2, 0, 110)
+    assert pool.alloc((1000,), np.uint8) is None
+    second.release()
+    large.release()
+    assert pool.alloc((1001,), np.uint8) is None  # over max_memory
+    assert pool.alloc((1000,), np.uint8) is not None
+    assert (pool.num_buffers, pool.num_free, pool.memory) == (1, 0, 1000)
+
+
+def test_plugin_queue_holds_a_reference():
+    """
+    A queued array keeps its memory until the plugin has processed it, and
+    arrays arriving at a full queue are dropped without a reference.
+    """
+    async def receive():
+        pool = NDArrayPool()
+        plugin = StatsPlugin(prefix='TEST:')
+        await plugin.enable.readback.write(True)
+        await plugin.queue_size.write(1)
+        arrays = [pool.alloc((3, 4), np.uint16) for _ in range(2)]
+        for array in arrays:
+            array.data[:] = 1
+            await plugin._on_array(array)
+            array.release()  # the allocator is done with it
+        counts = [array.reference_count for array in arrays]
+        state = (pool.num_free, plugin.dropped_arrays.setpoint.value,
+                 plugin.queue_use.value)
+        plugin._flush_queue()
+
+        return pool, counts, state
+
+    pool, counts, state = asyncio.run(receive())
+    assert counts == [1, 0]
+    assert state == (1, 1, 1)
+    assert pool.num_free == 2
@@ -0,0 +1,248 @@
+"""
+Tests of the AriModel beamline simulation in xrt_sim/ari_sim.py.
+
+NOTE: the TestM1 baffles are shared by every AriModel built with the default
+mirror1, so the tests change them with monkeypatch to restore them after.
+"""
+import gc
+import numpy as np
+import os
+import pytest
+import subprocess
+import sys
+import weakref
+
+ari_sim = pytest.importorskip('ari_sim')
+reducers = pytest.importorskip('reducers')
+seeded_random_state = pytest.importorskip('custom_devices').seeded_random_state
+
+
+def test_import_is_light():
+    """
+    Importing ari_sim leaves the environment alone and defers scipy.stats.
+    """
+    code = ('import os, sys; import ari_sim; '
+            'print("scipy.stats" in sys.modules, "MPLBACKEND" in os.environ)')
+    env = {key: value for key, value in os.environ.items()
+           if key != 'MPLBACKEND'}
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    result = subprocess.run([sys.executable, '-c', code], env=env,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ['False', 'False']
+
+
+@pytest.fixture
+def open_baffles(monkeypatch):
+    """
+    Open the inboard and outboard baffles of the default TestM1.
+    """
+    baffles = ari_sim.TestM1.baffles
+    monkeypatch.setattr(baffles, 'inboard', 20)
+    monkeypatch.setattr(baffles, 'outboard', -20)
+
+
+def narrow_model(**kwargs):
+    """
+    Return an AriModel whose source divergence lets rays reach the baffles.
+    """
+    model = ari_sim.AriModel(**kwargs)
+    model.source.dxprime = model.source.dzprime = 1E-3
+    model.activate(updated=True)
+
+    return model
+
+
+@pytest.fixture
+def model(open_baffles):
+    """
+    An AriModel with a seeded source and enough rays reaching the baffles.
+    """
+    model = narrow_model(seed=1)
+    yield model
+    model.close()
+
+
+@pytest.fixture
+def chain_reducers():
+    """
+    Reducers of the beams along the chain.
+    """
+    return {'flux': reducers.Flux('m1_diag'),
+            'moments': reducers.Moments('m1_baffles'),
+            'blades': reducers.BladeFlux('m1_baffles')}
+
+
+def test_activate_only_retraces_changed_branches(model, monkeypatch):
+    """
+    A parameter change only re-traces its component and those downstream.
+    """
+    generations = model.generations()
+    assert not model.activate()
+    assert model.last_traced == ()
+    assert model.generations() == generations
+
+    steps = [((model.mirror1.diagnostic, 'multi_trans', 40),
+              ('m1_diag_slit',)),
+             ((model.mirror1.baffles, 'top', 5),
+              ('m1_baffles', 'm1_diag', 'm1_diag_slit')),
+             ((model.mirror1, 'x', model.mirror1.x + 0.1),
+              ('m1', 'm1_baffles', 'm1_diag', 'm1_diag_slit'))]
+    for (obj, attribute, value), traced in steps:
+        monkeypatch.setattr(obj, attribute, value)
+        assert model.activate()
+        assert model.last_traced == traced
+        new_generations = model.generations()
+        for item in model.components:
+            if item in traced:
+                assert new_generations[item] == model.generation
+            else:
+                assert new_generations[item] == generations[item]
+        generations = new_generations
+
+
+@pytest.mark.parametrize('compact_dtype', [None, np.float32])
+def test_compaction_keeps_the_results(open_baffles, chain_reducers,
+                                      compact_dtype):
+    """
+    Compacting the beams passed between components gives the same results,
+    while each component's beamOut still holds its lost rays.
+    """
+    with seeded_random_state(1):  # the same rays for both models
+        full = narrow_model()
+    with seeded_random_state(1):
+        compact = narrow_model(compact=True, compact_dtype=compact_dtype)
+    try:
+        for name, reducer in chain_reducers.items():
+            np.testing.assert_allclose(
+                reducer(compact), reducer(full),
+                rtol=0 if compact_dtype is None else 1E-5, err_msg=name)
+        assert compact.m1_diag.rays_kept_ratio < 1
+        baffles = compact.m1_baffles
+        assert np.any(baffles.beamOut.state == baffles.lostNum)
+        assert np.count_nonzero(compact.m1_diag.beamOut.state > 0) == \
+            np.count_nonzero(full.m1_diag.beamOut.state > 0)
+    finally:
+        full.close()
+        compact.close()
+
+
+def test_failed_activation_is_retried(model, monkeypatch):
+    """
+    Parameter changes are re-applied by the next activate if a trace fails.
+    """
+    def fail(beam):
+        raise RuntimeError('trace failed')
+
+    monkeypatch.setattr(model.mirror1.baffles, 'top', 0.5)
+    with monkeypatch.context() as patch:
+        patch.setattr(model.m1_baffles, '_propagate', fail)
+        with pytest.raises(RuntimeError, match='trace failed'):
+            model.activate()
+
+    assert model.activate()
+    assert model.last_traced == ('m1_baffles', 'm1_diag', 'm1_diag_slit')
+    state = model.m1_baffles.beamOut.state.copy()
+    assert not model.activate()
+    model.invalidate('m1_baffles')  # re-trace the same rays from scratch
+    assert model.activate()
+    np.testing.assert_array_equal(model.m1_baffles.beamOut.state, state)
+    assert 0 < np.count_nonzero(state > 0) < len(state)
+
+
+def test_trace_parallel_matches_trace_streaming(open_baffles, chain_reducers):
+    """
+    The worker processes trace a model with the same (non-default) config.
+    """
+    model = narrow_model(compact=True, sampling='sobol')
+    try:
+        streamed = model.trace_streaming(12000, chain_reducers,
+                                         chunk_size=4000, seed=3)
+        parallel = model.trace_parallel(12000, chunk_size=4000,
+                                        max_workers=2, seed=3,
+                                        reducers=chain_reducers)
+    finally:
+        model.close()
+
+    assert streamed['flux'] > 0
+    for name, value in streamed.items():
+        np.testing.assert_allclose(parallel[name], value)
+
+
+def test_streaming_releases_the_previous_chunks(open_baffles,
+                                                chain_reducers, monkeypatch):
+    """
+    Once the beams are released before the next chunk no beam of the
+    previous chunks is still referenced, including those kept by the
+    compaction and aperture hit caches.
+    """
+    model = narrow_model(compact=True)
+    beams = []  # weak references to the beams of each chunk
+
+    def record(model):
+        beams.extend(weakref.ref(getattr(model, item).beamOut)
+                     for item in model.components)
+        return np.zeros(1)
+
+    release = model._release_beams
+
+    def release_and_check():
+        release()
+        gc.collect()
+        assert [ref() for ref in beams] == [None] * len(beams)
+
+    monkeypatch.setattr(model, '_release_beams', release_and_check)
+    try:
+        output = model.trace_streaming(
+            9000, dict(chain_reducers, record=record), chunk_size=3000,
+            seed=1)
+    finally:
+        model.close()
+
+    assert output['flux'] > 0
+    assert len(beams) == 3 * len(model.components)
+    assert model.m1_baffles._hits is not None  # used again after streaming
+
+
+def test_seeded_trace_restores_random_state(model):
+    """
+    Seeding the rays does not re-seed the random numbers of the caller.
+    """
+    arguments = (model.spec(), model.parameters(), 1000, 7,
+                 {'flux': reducers.Flux('m1_baffles')})
+    first = ari_sim._trace_chunk(*arguments)  # builds the worker model
+    np.random.seed(5)
+    expected = np.random.random(3)
+    np.random.seed(5)
+    second = ari_sim._trace_chunk(*arguments)
+    np.testing.assert_array_equal(np.random.random(3), expected)
+    assert first == second
+
+
+def test_parallel_scan_matches_serial_scan(open_baffles, chain_reducers):
+    """
+    A scan gives the same result in this process and in the workers, and
+    neither changes the beams or parameters of the model.
+    """
+    model = narrow_model(compact=True)
+    model.source.nrays = 3000
+    model.activate(updated=True)
+    beams = [getattr(model, item).beamOut for item in model.components]
+    parameters = model._parameters.last.copy()
+    axes = {(model.mirror1.baffles, 'top'): np.linspace(-5, 15, 4),
+            (model.mirror1, 'Ry_fine'): np.radians([0, 0.01])}
+    try:
+        serial = model.scan(axes, chain_reducers, max_workers=0, seed=2)
+        assert [getattr(model, item).beamOut
+                for item in model.components] == beams
+        np.testing.assert_array_equal(model._parameters.last, parameters)
+        parallel = model.scan(axes, chain_reducers, max_workers=2, seed=2)
+        again = model.scan(axes, chain_reducers, max_workers=0, seed=2)
+    finally:
+        model.close()
+
+    assert serial['flux'].shape == (4, 2)
+    assert np.all(serial['flux'][1:] > 0)
+    assert np.all(np.diff(serial['flux'], axis=0) >= 0)
+    for name, value in serial.items():
+        np.testing.assert_allclose(parallel[name], value)
+        np.testing.assert_array_equal(again[name], value)
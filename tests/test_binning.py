@@ -0,0 +1,122 @@
+"""
+Tests of the BeamBinner histogram engine in xrt_sim/binning.py.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+binning = pytest.importorskip('binning')
+ari_sim = pytest.importorskip('ari_sim')
+
+
+class FakeBeam:
+    """
+    A stand-in for an XRT Beam with random x, z and E attributes.
+    """
+    def __init__(self, nrays, seed):
+        rng = np.random.default_rng(seed)
+        self.x = rng.normal(0, 3, nrays)
+        self.z = rng.normal(1, 2, nrays)
+        self.E = rng.normal(850, 1, nrays)
+        self.x[:5] = [-10, 10, 10.5, -11, 0]  # the edges and outside
+        self.Jss = rng.random(nrays)
+        self.Jpp = rng.random(nrays)
+
+
+@pytest.mark.parametrize('output_range', [((-10, 10), (-5, 5), (845, 855)),
+                                          ((-10, 10), (-5, 5), None),
+                                          (None, None, None)])
+def test_bin_matches_histogramdd(output_range):
+    """
+    The weighted and masked histograms agree with np.histogramdd.
+    """
+    beam = FakeBeam(20000, 1)
+    mask = beam.Jss > 0.2
+    weights = beam.Jss + beam.Jpp
+    binner = binning.BeamBinner((20, 15, 10), output_range)
+
+    ranges = binner.ranges(beam, mask)
+    sample = np.stack([beam.x, beam.z, beam.E], axis=-1)[mask]
+    expected, edges = np.histogramdd(sample, bins=(20, 15, 10),
+                                     range=ranges, weights=weights[mask])
+    result = binner.bin(beam, weights=weights, mask=mask)
+
+    np.testing.assert_allclose(result, expected)
+    for coords, edge in zip(binner.coords(ranges), edges):
+        np.testing.assert_allclose(coords, edge[:-1])
+
+
+@pytest.mark.parametrize('bins', [(20, 1), (15, 7), (37, 3)])
+def test_bin_matches_histogram2d_on_the_edges(bins):
+    """
+    Rays on (and next to) every bin edge, and rays with zero intensity, go
+    in the np.histogram2d bins, and the flux of the rays in range is kept,
+    also when accumulated into out.
+    """
+    output_range = ((-5, 5), (-0.3, 0.7))
+    edges = [np.linspace(low, high, nbins + 1)
+             for (low, high), nbins in zip(output_range, bins)]
+    x, z = np.meshgrid(*[np.concatenate([edge, np.nextafter(edge, -np.inf),
+                                         np.nextafter(edge, np.inf)])
+                         for edge in edges])
+    beam = FakeBeam(x.size, 3)
+    beam.x, beam.z = x.ravel(), z.ravel()
+    weights = beam.Jss.copy()
+    weights[::3] = 0  # rays with zero intensity
+    binner = binning.BeamBinner(bins, output_range, fields=('x', 'z'))
+
+    expected, _, _ = np.histogram2d(beam.x, beam.z, bins=bins,
+                                    range=output_range, weights=weights)
+    counted, _, _ = np.histogram2d(beam.x, beam.z, bins=bins,
+                                   range=output_range)
+    inside = ((beam.x >= -5) & (beam.x <= 5) & (beam.z >= -0.3) &
+              (beam.z <= 0.7))
+    out = np.zeros(bins)
+    for _ in range(2):  # the accumulation re-uses the scratch arrays
+        binner.bin(beam, weights=weights, out=out)
+
+    np.testing.assert_array_equal(binner.bin(beam), counted)
+    np.testing.assert_allclose(binner.bin(beam, weights=weights), expected,
+                               rtol=1E-12)
+    np.testing.assert_allclose(out, 2 * expected, rtol=1E-12)
+    assert out.sum() == pytest.approx(2 * weights[inside].sum(), rel=1E-12)
+
+
+@pytest.mark.parametrize('output_range', [((0, 0), None, None),
+                                          ((1, -1), None, None)])
+def test_empty_range_is_rejected(output_range):
+    """
+    A fixed range must have min < max.
+    """
+    with pytest.raises(ValueError, match='min < max'):
+        binning.BeamBinner((10, 10, 10), output_range)
+
+
+def test_beam_to_xarray_in_threads():
+    """
+    Concurrent calls from several threads give the single thread results.
+    """
+    beams = [FakeBeam(nrays, seed) for seed, nrays in
+             enumerate([5000, 7000, 9000, 11000] * 4)]
+    arguments = {'bins': (10, 10, 10),
+                 'output_range': ((-10, 10), (-5, 5), (845, 855))}
+    expected = [ari_sim.beam_to_xarray(beam, **arguments).data
+                for beam in beams]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(
+            lambda beam: ari_sim.beam_to_xarray(beam, **arguments).data,
+            beams))
+
+    for result, value in zip(results, expected):
+        np.testing.assert_array_equal(result, value)
+
+
+def test_beam_to_xarray_keeps_few_binners():
+    """
+    Only the most recently used binners are kept.
+    """
+    beam = FakeBeam(1000, 2)
+    for nbins in range(2, 2 + 3 * ari_sim._max_binners):
+        ari_sim.beam_to_xarray(beam, bins=(nbins, 5, 5))
+
+    assert len(ari_sim._binners.binners) == ari_sim._max_binners
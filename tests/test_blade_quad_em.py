@@ -0,0 +1,57 @@
+"""
+Tests of the simulated blade photocurrents in caproto_servers/blade_quad_em.py.
+
+NOTE: the TestM1 baffles are shared by every AriModel built with the default
+mirror1, so the tests change them with monkeypatch to restore them after.
+"""
+import asyncio
+import pytest
+
+pytest.importorskip('caproto')
+ari_sim = pytest.importorskip('ari_sim')
+from blade_quad_em import BladeQuadEM  # noqa: E402
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """
+    An AriModel whose source divergence lets rays reach the open baffles.
+    """
+    baffles = ari_sim.TestM1.baffles
+    monkeypatch.setattr(baffles, 'inboard', 20)
+    monkeypatch.setattr(baffles, 'outboard', -20)
+    model = ari_sim.AriModel(seed=1)
+    model.source.dxprime = model.source.dzprime = 1E-3
+    model.activate(updated=True)  # the divergence is not a parameter
+    yield model
+    model.close()
+
+
+def test_unchanged_inputs_reuse_the_currents(model, monkeypatch):
+    """
+    Reading with unchanged inputs neither recomputes nor re-converts, while
+    a blade move is picked up by the next published result.
+    """
+    async def read():
+        quad_em = BladeQuadEM(prefix='TEST:', model=model)
+        first = await quad_em._generate_currents()
+        second = await quad_em._generate_currents()
+        runner = quad_em._runner
+        counts = (runner.recomputes, quad_em.cache_hits)
+
+        monkeypatch.setattr(model.mirror1.baffles, 'top', 0.5)
+        await quad_em._generate_currents()  # requests the recompute
+        await asyncio.to_thread(runner.wait)
+        while quad_em._published[0] < runner.requested:  # the publish task
+            await asyncio.sleep(0.01)
+        moved = await quad_em._generate_currents()
+        runner.close()
+
+        return first, second, counts, moved, runner.recomputes
+
+    first, second, counts, moved, recomputes = asyncio.run(read())
+    assert counts == (1, 1)
+    assert second == first
+    assert first[0] > 0
+    assert recomputes == 2
+    assert moved[0] > first[0]  # the top blade is closed further
@@ -22,10 +22,18 @@ ioc_example_to_info = {"ARI_SXN_SimBeamline.caproto_servers.ari_m1":
                        dict(group_cls='BaffleSlit',
                             kwargs={},
                             marks=[pytest.mark.skipif(numpy is None, reason="Requires numpy")],),
+                       "ARI_SXN_SimBeamline.caproto_servers.blade_quad_em":
+                       dict(group_cls='BladeQuadEM',
+                            kwargs={},
+                            marks=[pytest.mark.skipif(numpy is None, reason="Requires numpy")],),
                        "ARI_SXN_SimBeamline.caproto_servers.diagnostic":
                        dict(group_cls='Diagnostic',
                             kwargs={},
                             marks=[pytest.mark.skipif(numpy is None, reason="Requires numpy")],),
+                       "ARI_SXN_SimBeamline.caproto_servers.sim_stats":
+                       dict(group_cls='SimStats',
+                            kwargs={},
+                            marks=[pytest.mark.skipif(numpy is None, reason="Requires numpy")],),
                        "ARI_SXN_SimBeamline.caproto_servers.area_detector.plugin_base":
                        dict(group_cls='PluginBase',
                             kwargs={},
@@ -0,0 +1,178 @@
+"""
+Tests of the custom XRT components in xrt_sim/custom_devices.py.
+
+NOTE: the TestM1 baffles are shared by every AriModel built with the default
+mirror1, so the tests change them with monkeypatch to restore them after.
+"""
+import numpy as np
+import pytest
+import warnings
+from types import SimpleNamespace
+
+ari_sim = pytest.importorskip('ari_sim')
+beam_cache = pytest.importorskip('beam_cache')
+custom_devices = pytest.importorskip('custom_devices')
+qmc = pytest.importorskip('scipy.stats').qmc
+ndtri = pytest.importorskip('scipy.special').ndtri
+
+
+def test_cache_hit_returns_the_same_beams(monkeypatch):
+    """
+    Moving the baffles back re-uses the cached beams of the first position.
+    """
+    cache = beam_cache.BeamCache()
+    model = ari_sim.AriModel(cache=cache, seed=1)
+    baffles = model.mirror1.baffles
+    first = model.m1_baffles.beamOut
+    monkeypatch.setattr(baffles, 'top', 2.0)
+    model.activate()
+    assert not model.m1_baffles._cache_hit
+    assert model.m1_baffles.beamOut is not first
+    monkeypatch.setattr(baffles, 'top', 20)
+    model.activate()
+    assert model.m1_baffles._cache_hit
+    assert model.m1_baffles.beamOut is first
+    assert model.last_traced == ('m1_baffles', 'm1_diag', 'm1_diag_slit')
+
+
+def test_cache_counts_shared_arrays_once():
+    """
+    Arrays shared between cached beams (or views of them) are counted once,
+    and only released with the last entry holding them.
+    """
+    x, state = np.zeros(1000), np.ones(1000)
+    first = SimpleNamespace(x=x, state=state)
+    second = SimpleNamespace(x=x[:500], state=state.copy())
+    assert beam_cache.beam_nbytes((first, second)) == 3 * x.nbytes
+
+    cache = beam_cache.BeamCache(max_bytes=3 * x.nbytes)
+    cache.put('first', first)
+    cache.put('second', second)
+    assert (len(cache), cache.nbytes, cache.evictions) == (2, 3 * x.nbytes, 0)
+    cache.put('first', None)  # i.e. x is still held by second
+    assert cache.nbytes == 2 * x.nbytes
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+@pytest.mark.parametrize(('kwargs', 'first_changed'),
+                         [({'seed': 2}, 'source'),
+                          ({'sampling': 'sobol'}, 'source'),
+                          ({'compact': True}, 'm1'),
+                          ({'reflectivity_table': {}}, 'm1')])
+def test_cache_key_includes_configuration(kwargs, first_changed):
+    """
+    Models with a different configuration only share the unaffected beams.
+    """
+    cache = beam_cache.BeamCache()
+    reference = ari_sim.AriModel(cache=cache, seed=1)
+    model = ari_sim.AriModel(cache=cache, **{'seed': 1, **kwargs})
+    index = model.components.index(first_changed)
+    for name in model.components[:index]:
+        assert getattr(model, name)._cache_hit
+    for name in model.components[index:]:
+        assert not getattr(model, name)._cache_hit
+        assert (getattr(model, name)._state_key !=
+                getattr(reference, name)._state_key)
+
+
+@pytest.mark.parametrize(('distx', 'dx'), [('normal', 0.3),
+                                           ('annulus', (0.1, 0.3))])
+def test_quasi_random_columns_are_fixed_per_axis(distx, dx):
+    """
+    Each source axis uses the same quasi-random column for any distribution.
+    """
+    model = ari_sim.AriModel(sampling='sobol', seed=4)
+    model.source.distx, model.source.dx = distx, dx
+    model.activate(updated=True)
+    with warnings.catch_warnings():  # nrays need not be a power of 2
+        warnings.simplefilter('ignore', UserWarning)
+        points = qmc.Sobol(d=6, scramble=True,
+                           seed=4).random(model.source.nrays)
+    points = np.clip(points, 1E-12, 1 - 1E-12)
+    columns = custom_devices.qmc_columns
+
+    beam = model.source.beamOut
+    np.testing.assert_allclose(
+        beam.a, 0.1 * ndtri(points[:, columns['a']]))
+    np.testing.assert_allclose(
+        beam.c, 0.1 * ndtri(points[:, columns['c']]))
+    np.testing.assert_allclose(
+        beam.E, 850 + 5 * ndtri(points[:, columns['E']]))
+
+
+@pytest.fixture
+def open_model(monkeypatch):
+    """
+    A function returning an AriModel with rays reaching open baffles.
+    """
+    baffles = ari_sim.TestM1.baffles
+    monkeypatch.setattr(baffles, 'inboard', 20)
+    monkeypatch.setattr(baffles, 'outboard', -20)
+
+    def build(**kwargs):
+        model = ari_sim.AriModel(seed=1, **kwargs)
+        model.source.dxprime = model.source.dzprime = 1E-3
+        model.activate(updated=True)
+        return model
+
+    return build
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_aperture_fast_path_matches_propagate(open_model, monkeypatch,
+                                              compact):
+    """
+    Re-masking the kept hits gives the results (and side effects) of
+    propagate.
+    """
+    model = open_model(compact=compact)
+    aperture = model.m1_baffles
+    aperture.alarmLevel = 0.1
+    monkeypatch.setattr(model.mirror1.baffles, 'top', 2.0)
+
+    def trace():
+        aperture.spotLimits = [0, 0, 0, 0]
+        del model.bl.alarms[:]
+        upstream = aperture.beamIn.state.copy()
+        model.activate()
+        np.testing.assert_array_equal(aperture.beamIn.state, upstream)
+        return (aperture.beamOut, list(aperture.spotLimits),
+                list(model.bl.alarms), model.m1_diag.beamOut)
+
+    fast, fast_limits, fast_alarms, fast_diag = trace()
+    assert fast.x is aperture._hits[2].x  # the kept beam was re-masked
+    assert fast_alarms
+
+    aperture._hits = None  # force a full propagate
+    model.invalidate('m1_baffles')
+    slow, slow_limits, slow_alarms, slow_diag = trace()
+    assert slow.x is not fast.x
+
+    assert 0 < np.count_nonzero(slow.state > 0) < len(slow.state)
+    np.testing.assert_array_equal(fast.state, slow.state)
+    for field in ('x', 'z', 'Jss', 'Jpp'):
+        np.testing.assert_array_equal(getattr(fast, field),
+                                      getattr(slow, field))
+        np.testing.assert_array_equal(getattr(fast_diag, field),
+                                      getattr(slow_diag, field))
+    np.testing.assert_allclose(fast_limits, slow_limits)
+    assert fast_alarms == slow_alarms
+
+
+def test_compacted_beam_is_reused(open_model, monkeypatch):
+    """
+    Only moving the baffles re-uses the compacted copy of the M1 beamOut.
+    """
+    model = open_model(compact=True)
+    beam_in = model.m1_baffles.beamIn
+    assert len(beam_in.state) < len(model.m1.beamOut.state)
+    monkeypatch.setattr(model.mirror1.baffles, 'top', 2.0)
+    model.activate()
+    assert model.m1_baffles.beamIn is beam_in
+    monkeypatch.setattr(model.mirror1, 'Ry_fine', 1E-5)
+    model.activate()
+    assert model.m1_baffles.beamIn is not beam_in
+    assert model.m1_baffles.rays_kept_ratio == pytest.approx(
+        np.count_nonzero(model.m1.beamOut.state > 0) /
+        len(model.m1.beamOut.state))
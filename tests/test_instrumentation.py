@@ -0,0 +1,91 @@
+"""
+Tests of the activation statistics in xrt_sim/instrumentation.py and of
+the SimStats PVs that publish them (caproto_servers/sim_stats.py).
+"""
+import asyncio
+import pytest
+import threading
+
+instrumentation = pytest.importorskip('instrumentation')
+
+
+def test_summary_of_the_rolling_window():
+    """
+    The means and maxima only include the traced activations in the window,
+    while the counts include every activation recorded.
+    """
+    stats = instrumentation.ActivationStats(window=3)
+    assert stats.summary()['mean_time'] == 0.0  # nothing recorded
+    stats.record(9.0, rays_in=90, rays_out=80, nbytes=900)  # rolled out
+    stats.record(1.0, rays_in=10, rays_out=8, nbytes=100)
+    stats.record(0.0, skipped=True)
+    stats.record(3.0, rays_in=30, rays_out=6, nbytes=0)
+
+    assert stats.summary() == {
+        'activations': 4, 'skipped': 1, 'last_time': 3.0,
+        'last_rays_in': 30, 'last_rays_out': 6, 'last_nbytes': 0,
+        'mean_time': 2.0, 'max_time': 3.0, 'mean_rays_out': 7.0,
+        'mean_nbytes': 50.0, 'skip_fraction': pytest.approx(1 / 3)}
+
+    assert stats.summary(reset=True)['activations'] == 4
+    assert stats.summary() == instrumentation.ActivationStats().summary()
+
+
+def test_summaries_read_while_recording():
+    """
+    Summaries read (and reset) while another thread records are consistent
+    snapshots, and no activation is lost between a read and its reset.
+    """
+    stats = instrumentation.ActivationStats(window=10)
+    total = 20000
+
+    def recorder():
+        for i in range(total):  # rays_out is always twice the time
+            stats.record(float(i), rays_in=i, rays_out=2 * i)
+
+    thread = threading.Thread(target=recorder)
+    thread.start()
+    counted = 0
+    while thread.is_alive():
+        summary = stats.summary(reset=True)
+        counted += summary['activations']
+        assert summary['mean_rays_out'] == 2 * summary['mean_time']
+    thread.join()
+    counted += stats.summary()['activations']
+
+    assert counted == total
+
+
+def test_sim_stats_pvs(monkeypatch):
+    """
+    SimStats publishes the statistics of each model component to its PVs.
+    """
+    pytest.importorskip('caproto')
+    ari_sim = pytest.importorskip('ari_sim')
+    from sim_stats import SimStats
+
+    model = ari_sim.AriModel()
+    # (the default mirror1 is shared, so monkeypatch restores it after)
+    monkeypatch.setattr(model.mirror1, 'Ry_fine',
+                        model.mirror1.Ry_fine + 1E-6)  # not the source
+    model.activate()
+    expected = model.stats()
+
+    async def publish():
+        ioc = SimStats(prefix='TEST:', model=model)
+        await ioc.publish()
+        return ioc
+
+    ioc = asyncio.run(publish())
+    for name in ('source', 'm1', 'm1_baffles'):
+        group, summary = getattr(ioc, name), expected[name]
+        assert group.activations.value == summary['activations']
+        assert group.skipped.value == summary['skipped']
+        assert group.rays_out.value == summary['last_rays_out']
+        assert group.last_trace_time.value == pytest.approx(
+            summary['last_time'])
+        assert group.skip_fraction.value == pytest.approx(
+            summary['skip_fraction'])
+    assert ioc.source.skipped.value == 1
+    assert ioc.m1.skipped.value == 0
+    assert ioc.source.rays_out.value == model.source.nrays
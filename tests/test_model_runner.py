@@ -0,0 +1,97 @@
+"""
+Tests of the background model runners in xrt_sim/model_runner.py.
+"""
+import numpy as np
+import pytest
+import threading
+
+ari_sim = pytest.importorskip('ari_sim')
+model_runner = pytest.importorskip('model_runner')
+reducers = pytest.importorskip('reducers')
+
+
+@pytest.fixture(scope='module')
+def model():
+    """
+    An AriModel shared by the tests.
+    """
+    return ari_sim.AriModel(seed=1)
+
+
+def test_publishes_a_snapshot_of_the_beams(model):
+    """
+    Without reducers copies of the beams of each recompute are published, so
+    in place changes made by the next recompute are not seen.
+    """
+    published = []
+    runner = model_runner.ModelRunner(
+        model, publish=lambda *args: published.append(args))
+    try:
+        assert runner.wait(runner.request(updated=True), timeout=30)
+        states = {item: getattr(model, item).beamOut.state.copy()
+                  for item in model.components}
+        assert runner.wait(runner.request(updated=True), timeout=30)
+    finally:
+        runner.close()
+
+    assert [version for version, _ in published] == [1, 2]
+    for item, beam in published[0][1].items():
+        live = getattr(model, item).beamOut
+        assert beam is not live
+        assert not np.shares_memory(beam.state, live.state)
+        np.testing.assert_array_equal(beam.state, states[item])
+    state = model.source.beamOut.state
+    saved = state.copy()
+    state[:] = -1  # i.e. modified in place by the next recompute
+    try:
+        assert np.all(published[1][1]['source'].state != -1)
+    finally:
+        state[:] = saved
+
+
+def test_publishes_the_reducer_outputs(model):
+    """
+    With reducers their outputs, evaluated in the worker, are published.
+    """
+    published = []
+    runner = model_runner.ModelRunner(
+        model, publish=lambda *args: published.append(args),
+        reducers={'flux': reducers.Flux('source')})
+    try:
+        assert runner.wait(runner.request(), timeout=30)
+    finally:
+        runner.close()
+
+    version, outputs = published[0]
+    assert version == 1
+    np.testing.assert_allclose(outputs['flux'],
+                               reducers.Flux('source')(model))
+
+
+def test_progressive_runner_restores_nrays(model):
+    """
+    The refinement passes do not change the number of source rays.
+    """
+    published = []
+    finished = threading.Event()
+
+    def publish(version, outputs, total):
+        published.append((version, outputs, total))
+        if total >= 1600:
+            finished.set()
+
+    nrays = model.source.nrays
+    runner = model_runner.ProgressiveModelRunner(
+        model, {'flux': reducers.Flux('source')}, publish=publish,
+        coarse_nrays=100, fine_nrays=500, max_nrays=1600)
+    try:
+        runner.request()
+        assert finished.wait(timeout=30)
+    finally:
+        runner.close()
+
+    assert model.source.nrays == nrays
+    assert [total for _, _, total in published] == [100, 600, 1100, 1600]
+    np.testing.assert_allclose(published[-1][1]['flux'], 1600)
+    model.activate()
+    assert len(model.source.beamOut.state) == nrays
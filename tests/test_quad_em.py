@@ -0,0 +1,99 @@
+"""
+Tests of the QuadEM electrometer PVGroup in caproto_servers/area_detector.
+"""
+import asyncio
+import numpy as np
+import pytest
+
+pytest.importorskip('caproto')
+from caproto.asyncio.server import AsyncioAsyncLayer  # noqa: E402
+from area_detector.quad_em import QuadEM  # noqa: E402
+
+
+class CountingQuadEM(QuadEM):
+    """
+    A QuadEM whose samples are numbered, sample k having the currents k.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.samples = 0
+
+    async def _generate_samples(self, count):
+        values = np.arange(self.samples, self.samples + count, dtype=float)
+        self.samples += count
+
+        return np.repeat(values[:, np.newaxis], 4, axis=1)
+
+
+async def quad_em(size=4):
+    """
+    Return a CountingQuadEM with size samples per 1 s reading.
+    """
+    device = CountingQuadEM(prefix='TEST:')
+    await device.num_average.write(size)
+
+    return device
+
+
+async def read(device, elapsed):
+    """
+    Do one reading and return (mean current, num_averaged, ring_overflows).
+    """
+    await device._read(elapsed)
+
+    return (device.current1.mean_value.value, device.num_averaged.value,
+            device.ring_overflows.value)
+
+
+def test_readings_average_the_oldest_unread_samples():
+    """
+    A held up reading leaves its extra samples in the ring buffer, which are
+    averaged by the next reading before the newer samples.
+    """
+    async def readings():
+        device = await quad_em()
+        return [await read(device, elapsed) for elapsed in (1, 1.5, 0.5, 1)]
+
+    np.testing.assert_allclose(asyncio.run(readings()),
+                               [(1.5, 4, 0),  # samples 0-3
+                                (5.5, 4, 0),  # samples 4-7 (8-9 unread)
+                                (9.5, 4, 0),  # samples 8-11
+                                (13.5, 4, 0)])  # samples 12-15
+
+
+def test_only_overwritten_unread_samples_are_overflows():
+    """
+    Samples only count as overflows when they overwrite unread samples.
+    """
+    async def readings():
+        device = await quad_em()
+        return [await read(device, elapsed) for elapsed in (1, 0.5, 3, 2)]
+
+    np.testing.assert_allclose(asyncio.run(readings()),
+                               [(1.5, 4, 0),  # samples 0-3
+                                (4.5, 2, 0),  # samples 4-5
+                                (11.5, 4, 4),  # 6-9 overwritten, 14-17 unread
+                                (19.5, 4, 8)])  # 14-17 overwritten
+
+
+def test_each_acquire_put_starts_an_acquisition():
+    """
+    Back to back Acquire puts each start one (Single mode) acquisition.
+    """
+    async def acquire():
+        device = QuadEM(prefix='TEST:')
+        await device.averaging_time.readback.write(0.0)
+        task = asyncio.create_task(
+            device.acquire._server_startup(AsyncioAsyncLayer()))
+        await asyncio.sleep(0)  # the startup hook creates the Event
+        acquired = []
+        for _ in range(3):
+            await device.acquire.write(1)
+            while device.acquire.value == 1:
+                await asyncio.sleep(0.001)
+            acquired.append(device.num_acquired.value)
+        task.cancel()
+
+        return acquired
+
+    assert asyncio.run(acquire()) == [1, 1, 1]
@@ -0,0 +1,88 @@
+"""
+Tests of the on-disk source ray store in xrt_sim/ray_store.py.
+"""
+import hashlib
+import numpy as np
+import os
+import pytest
+
+ari_sim = pytest.importorskip('ari_sim')
+ray_store = pytest.importorskip('ray_store')
+
+
+def stored_model(store, seed=1):
+    """
+    Return an AriModel whose source rays are kept in store.
+    """
+    return ari_sim.AriModel(ray_store=store, seed=seed)
+
+
+def digests(directory):
+    """
+    Return the sha256 digest of each file below directory.
+    """
+    files = {}
+    for path, _, names in os.walk(directory):
+        for name in names:
+            with open(os.path.join(path, name), 'rb') as file:
+                files[os.path.join(path, name)] = hashlib.sha256(
+                    file.read()).hexdigest()
+
+    return files
+
+
+def test_key_is_stable(tmp_path):
+    """
+    The key only depends on the source configuration and the seed.
+    """
+    store = ray_store.RayStore(tmp_path)
+    first, second = (ari_sim.AriModel(seed=1).source for _ in range(2))
+    key = store.key(first, 1)
+
+    assert store.key(first, 1) == key
+    assert store.key(second, 1) == key  # an equal source of another model
+    assert store.key(first, 2) != key
+    second.dxprime *= 2
+    assert store.key(second, 1) != key
+
+
+def test_parameter_change_misses(tmp_path):
+    """
+    A second model with the same source loads the stored rays, until a
+    source parameter is changed.
+    """
+    store = ray_store.RayStore(tmp_path)
+    first = stored_model(store)
+    second = stored_model(store)
+    assert (store.hits, store.misses) == (1, 1)
+    for name in ('x', 'z', 'a', 'c', 'E', 'Jss'):
+        np.testing.assert_array_equal(getattr(second.source.beamOut, name),
+                                      getattr(first.source.beamOut, name))
+
+    second.source.dzprime *= 2
+    second.activate(updated=True)
+    assert (store.hits, store.misses) == (1, 2)
+    assert len(os.listdir(tmp_path)) == 2
+    assert not np.array_equal(second.source.beamOut.c,
+                              first.source.beamOut.c)
+
+
+def test_loads_never_write_back(tmp_path):
+    """
+    Changing the arrays of a loaded beam (i.e. an aperture setting state)
+    leaves the stored files unchanged.
+    """
+    store = ray_store.RayStore(tmp_path)
+    stored_model(store)
+    before = digests(tmp_path)
+    key = os.listdir(tmp_path)[0]
+
+    beam = store.load(key)
+    assert isinstance(beam.x, np.memmap) and beam.x.mode == 'c'
+    beam.state[:] = 0
+    beam.x *= 2
+    beam.x.flush()
+    del beam
+
+    assert digests(tmp_path) == before
+    assert np.all(store.load(key).state == 1)
@@ -0,0 +1,102 @@
+"""
+Tests of the model output reducers in xrt_sim/reducers.py.
+"""
+import numpy as np
+import pytest
+from types import SimpleNamespace
+
+reducers = pytest.importorskip('reducers')
+
+
+@pytest.mark.parametrize('unknown', ['', 'nothing'])
+def test_blade_flux_ignores_unknown_kinds(unknown):
+    """
+    Blocked rays go to the blade they are furthest beyond, while unknown kinds
+    (which xrt does not use to block rays) get none of the flux.
+    """
+    aperture = SimpleNamespace(kind=[unknown, 'left', 'right', 'bottom',
+                                     'top'],
+                               opening=[0, -1, 1, -1, 1], lostNum=-1001)
+    beam = SimpleNamespace(x=np.array([-3., 2., 0., 0., -2., 5., 0.]),
+                           z=np.array([0., 0., -4., 3., 3., 3., 0.]),
+                           state=np.array([-1001] * 6 + [1]),
+                           Jss=np.ones(7), Jpp=np.arange(7.))
+    flux = reducers.blade_flux(aperture, beam)
+    np.testing.assert_allclose(flux, [0, 1, 2 + 6, 3, 4 + 5])
+
+
+def test_blade_flux_without_known_kinds():
+    """
+    An aperture without any known kind absorbs no flux.
+    """
+    aperture = SimpleNamespace(kind=['nothing'], opening=[0], lostNum=-1001)
+    beam = SimpleNamespace(x=np.ones(3), z=np.ones(3),
+                           state=np.full(3, -1001), Jss=np.ones(3),
+                           Jpp=np.zeros(3))
+    np.testing.assert_allclose(reducers.blade_flux(aperture, beam), [0])
+
+
+def known_beam(seed, nrays=1000):
+    """
+    Return a beam of random rays, a tenth of them lost (state 3).
+    """
+    rng = np.random.default_rng(seed)
+    return SimpleNamespace(x=rng.normal(0, 4, nrays),
+                           z=rng.normal(1, 3, nrays),
+                           state=rng.choice([1, 2, 3], nrays,
+                                            p=[0.6, 0.3, 0.1]),
+                           Jss=rng.random(nrays), Jpp=rng.random(nrays))
+
+
+def test_reducers_match_a_direct_calculation():
+    """
+    The reducers match numpy on a known beam, also when the output array of
+    the previous call is re-used.
+    """
+    histogram = reducers.Histogram('screen', bins=(20, 10),
+                                   output_range=((-10, 10), (-5, 5)))
+    outputs = []
+    for seed in (1, 2):
+        beam = known_beam(seed)
+        model = SimpleNamespace(screen=SimpleNamespace(beamIn=beam,
+                                                       beamOut=beam))
+        good = beam.state < 3
+        intensity = (beam.Jss + beam.Jpp)[good]
+        expected, _, _ = np.histogram2d(beam.x[good], beam.z[good],
+                                        bins=(20, 10),
+                                        range=((-10, 10), (-5, 5)),
+                                        weights=intensity)
+        outputs.append(histogram(model))
+        np.testing.assert_allclose(outputs[-1], expected)
+
+        np.testing.assert_allclose(reducers.Flux('screen')(model),
+                                   intensity.sum())
+        np.testing.assert_allclose(reducers.Transmission('screen')(model),
+                                   [intensity.sum()] * 2)
+        np.testing.assert_allclose(
+            reducers.Moments('screen')(model),
+            [intensity.sum(), intensity.dot(beam.x[good]),
+             intensity.dot(beam.z[good])])
+    assert outputs[1] is outputs[0]
+
+
+def test_blade_flux_reducer_re_uses_its_output():
+    """
+    The BladeFlux output matches blade_flux for each beam, in the same array.
+    """
+    aperture = SimpleNamespace(kind=['left', 'right', 'bottom', 'top'],
+                               opening=[-2, 2, -1, 3], lostNum=3)
+    model = SimpleNamespace(slit=aperture)
+    reducer = reducers.BladeFlux('slit')
+    outputs = []
+    for seed in (1, 2):
+        aperture.beamOut = beam = known_beam(seed)
+        lost = beam.state == 3
+        x, z = beam.x[lost], beam.z[lost]
+        excess = np.stack([-2 - x, x - 2, -1 - z, z - 3])
+        expected = np.bincount(excess.argmax(axis=0),
+                               weights=(beam.Jss + beam.Jpp)[lost],
+                               minlength=4)
+        outputs.append(reducer(model))
+        np.testing.assert_allclose(outputs[-1], expected)
+    assert outputs[1] is outputs[0]
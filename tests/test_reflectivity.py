@@ -0,0 +1,102 @@
+"""
+Tests of the TabulatedMaterial wrapper in xrt_sim/reflectivity.py.
+"""
+import numpy as np
+import os
+import pytest
+
+ari_sim = pytest.importorskip('ari_sim')
+reflectivity = pytest.importorskip('reflectivity')
+
+settings = {'energy_range': (800, 900), 'cos_range': (0, 0.05),
+            'tolerance': 1E-3}
+
+
+@pytest.fixture(scope='module')
+def gold():
+    """
+    The gold coating of M1 (see ari_sim.materials).
+    """
+    return ari_sim.materials()['gold']
+
+
+@pytest.fixture(scope='module')
+def table(gold):
+    """
+    A TabulatedMaterial of gold, without a cache.
+    """
+    return reflectivity.TabulatedMaterial(gold, **settings)
+
+
+def random_rays(nrays, seed, energy_range, cos_range):
+    """
+    Return random (E, beamInDotNormal) values inside the given ranges.
+    """
+    rng = np.random.default_rng(seed)
+    E = rng.uniform(*energy_range, nrays)
+    cos = rng.uniform(*cos_range, nrays) * rng.choice([-1, 1], nrays)
+
+    return E, cos
+
+
+def test_amplitudes_within_tolerance(gold, table):
+    """
+    The interpolated amplitudes of random rays in the table are within
+    tolerance of the exact amplitudes.
+    """
+    E, cos = random_rays(20000, 1, settings['energy_range'],
+                         settings['cos_range'])
+    rs, rp, mu, phase = table.get_amplitude(E, cos)
+    exact = gold.get_amplitude(E, cos)
+
+    assert table.error <= settings['tolerance']
+    assert np.abs(rs - exact[0]).max() <= settings['tolerance']
+    assert np.abs(rp - exact[1]).max() <= settings['tolerance']
+    np.testing.assert_allclose(mu, exact[2], rtol=1E-3)
+    np.testing.assert_allclose(phase, exact[3], rtol=1E-3)
+
+
+def test_exact_outside_of_the_table(gold, table):
+    """
+    Rays outside of the table, and calls with fromVacuum=False, use the exact
+    amplitudes, while the rays inside are still interpolated.
+    """
+    E, cos = random_rays(1000, 2, (700, 1000), (0, 0.1))
+    outside = ((E < 800) | (E > 900) | (np.abs(cos) > 0.05))
+    assert 0 < outside.sum() < len(E)
+
+    amplitudes = table.get_amplitude(E, cos)
+    exact = gold.get_amplitude(E, cos)
+    for value, expected in zip(amplitudes, exact):
+        np.testing.assert_array_equal(value[outside], expected[outside])
+    assert not np.array_equal(amplitudes[0][~outside], exact[0][~outside])
+
+    for value, expected in zip(table.get_amplitude(E, cos, fromVacuum=False),
+                               gold.get_amplitude(E, cos, fromVacuum=False)):
+        np.testing.assert_array_equal(value, expected)
+
+
+def test_cache_round_trip(gold, table, tmp_path, monkeypatch):
+    """
+    The tables saved to cache_dir are loaded, not recomputed, by a second
+    TabulatedMaterial with the same settings.
+    """
+    first = reflectivity.TabulatedMaterial(gold, cache_dir=tmp_path,
+                                           **settings)
+    assert os.listdir(tmp_path) == [f'{first._key()}.npz']
+
+    def recompute(self):
+        raise AssertionError('The cached tables were not used')
+
+    monkeypatch.setattr(reflectivity.TabulatedMaterial, '_compute_tables',
+                        recompute)
+    second = reflectivity.TabulatedMaterial(gold, cache_dir=tmp_path,
+                                            **settings)
+    assert second.error == first.error
+    for name, value in first._tables().items():
+        np.testing.assert_array_equal(second._tables()[name], value)
+    E, cos = random_rays(100, 3, settings['energy_range'],
+                         settings['cos_range'])
+    for value, expected in zip(second.get_amplitude(E, cos),
+                               table.get_amplitude(E, cos)):
+        np.testing.assert_array_equal(value, expected)
@@ -0,0 +1,67 @@
+"""
+Tests of the Surrogate response surface in xrt_sim/surrogate.py.
+
+NOTE: the TestM1 baffles are shared by every AriModel built with the default
+mirror1, so the tests change them with monkeypatch to restore them after.
+"""
+import numpy as np
+import pytest
+
+ari_sim = pytest.importorskip('ari_sim')
+reducers = pytest.importorskip('reducers')
+surrogate = pytest.importorskip('surrogate')
+seeded_random_state = pytest.importorskip('custom_devices').seeded_random_state
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """
+    An AriModel whose source divergence lets rays reach the open baffles.
+    """
+    baffles = ari_sim.TestM1.baffles
+    monkeypatch.setattr(baffles, 'inboard', 20)
+    monkeypatch.setattr(baffles, 'outboard', -20)
+    model = ari_sim.AriModel()
+    model.source.dxprime = model.source.dzprime = 1E-3
+    model.source.nrays = 20000
+    model.activate(updated=True)
+    yield model
+    model.close()
+
+
+def trace(model, top, seed):
+    """
+    Return the reducer outputs of a direct trace with the top blade at top.
+    """
+    model.mirror1.baffles.top = top
+    with seeded_random_state(seed):  # the source rays of the scan
+        model.activate(updated=True)
+
+    return {'flux': reducers.Flux('m1_diag')(model),
+            'blades': reducers.BladeFlux('m1_baffles')(model)}
+
+
+def test_interpolation_matches_direct_traces(model, monkeypatch):
+    """
+    A surrogate built in the worker processes reproduces direct traces at
+    the grid points, and is within a few percent of them between the grid
+    points.
+    """
+    chain_reducers = {'flux': reducers.Flux('m1_diag'),
+                      'blades': reducers.BladeFlux('m1_baffles')}
+    grid = np.linspace(-2, 6, 9)
+    response = surrogate.build_surrogate(
+        model, {'mirror1.baffles.top': grid}, chain_reducers, max_workers=2,
+        seed=2)
+    monkeypatch.setattr(model.mirror1.baffles, 'top', 0)  # restored after
+
+    for top in np.linspace(-2, 6, 17):
+        direct = trace(model, top, 2)
+        interpolated = response({'mirror1.baffles.top': top})
+        tolerance = 1E-12 if top in grid else 0.03
+        for name, value in direct.items():
+            np.testing.assert_allclose(interpolated[name], value,
+                                       rtol=tolerance,
+                                       atol=tolerance * value.max())
+    assert response.hits == 17 and response.fallbacks == 0
+    assert direct['flux'] > 0